@@ -1,5 +1,6 @@
 # encoding=utf-8
 import os
+import sys
 import time
 import re
 import math
@@ -9,26 +10,29 @@ import numpy as np
 import tensorflow as tf
 
 import utils
-from tensorflow_utils import load_tfrecord
+from tensorflow_utils import load_shards, generic_cnn_model
 import key_label_dict
 
 
 if __name__ == "__main__":
     AUTOTUNE = tf.data.experimental.AUTOTUNE
-    image_count = 1756
     batch_size = 64
-    steps_per_epoch = math.ceil(image_count/batch_size)
-    tfrecord_filename = 'hiragana_ds_2019-05-04_16-34-09.tfrecord'
+    # written by `export-shards.py --format tfrecord`
+    manifest_filepath = sys.argv[1] if len(sys.argv) > 1 else 'manifest.json'
 
-    ds = load_tfrecord(tfrecord_filename)
+    ds, manifest = load_shards(manifest_filepath)
+    image_count = manifest['num_records']
+    steps_per_epoch = math.ceil(image_count/batch_size)
 
+    # the shards are already shuffled so a smaller buffer is enough to
+    # shuffle again in every epoch
     ds = ds.cache()
     ds = ds.apply(tf.data.experimental.shuffle_and_repeat(
-        buffer_size=image_count,
+        buffer_size=min(image_count, 16384),
     ))
     ds = ds.batch(batch_size).prefetch(buffer_size=AUTOTUNE)
 
-    model = utils.generic_cnn_model('HRGN')
+    model = generic_cnn_model('HRGN', tuple(manifest['image_shape']), manifest['num_labels'])
     model.compile(
         optimizer='adam',
         loss='sparse_categorical_crossentropy',
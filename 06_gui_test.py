@@ -15,11 +15,8 @@ import matplotlib.pyplot as plt
 
 from PIL import Image
 
-import tensorflow as tf
-tf.enable_eager_execution()
-
 import key_label_dict
-import utils
+import numpy_inference
 
 pen = None
 CANVAS_WIDTH = None
@@ -206,22 +203,11 @@ if __name__ == "__main__":
         fill='black',
     )
     #=================== load the trained model ===================#
-    # model_filename = 'hiragana_model_2019-05-04_17-05-26.h5'
-    # model = tf.keras.models.load_model(model_filename)
-    # model.summary()
-    #===================  or load model_weights ===================#
-    model_weights_filename = 'hiragana_model_weights_2019-05-04_17-05-26.h5'
-    model = utils.generic_cnn_model('HRGN')
-    model.load_weights(model_weights_filename)
-    model.compile(
-        optimizer='adam',
-        loss='sparse_categorical_crossentropy',
-        metrics=['accuracy'],
-    )
+    # the model is executed with NumPy so we don't have to wait for
+    # TensorFlow to start up
+    model_filename = 'hiragana_model_2019-05-04_17-05-26.h5'
+    model = numpy_inference.load_model(model_filename)
     model.summary()
-    #=================== warm up tensorflow ===================#
-    img = np.ones((1, 64, 64, 1), dtype=np.float)
-    model.predict(img)
 
     #=================== available kana ListBox ===================#
     kana_scrollbar = tk.Scrollbar(
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# Score how much every record looks unlike the other records of its label
+# so the reviewers can look at the most suspicious ones first. Tofu
+# boxes, wrong glyphs and fallback shapes are far from the label's
+# centroid image.
+#
+# The scores are saved as a float32 array aligned with the records of the
+# metadata (`anomaly-scores.npy` next to it) for `inspection-server.py`.
+import os
+import time
+import argparse
+import multiprocessing
+from collections import defaultdict
+from typing import List
+
+from tqdm import tqdm
+import numpy as np
+
+from constants import *
+from logger import *
+from utils import *
+from argtypes import *
+
+CENTROID_METHODS = ('median', 'mean')
+# images are compared at this size to tolerate small shifts
+THUMBNAIL_SIZE = 32
+
+
+def downsample(images: np.ndarray, size: int) -> np.ndarray:
+    """Average-pool (N, H, W) images to (N, size, size)."""
+    num_images, height, width = images.shape
+    return images.reshape(num_images, size, height // size, size, width // size).mean(axis=(2, 4))
+
+
+def score_images(images: np.ndarray, method: str) -> np.ndarray:
+    """
+    Return the robust z-score of the distance from every image to the
+    centroid (the per-pixel median or mean image) of all the images.
+    """
+    thumbnails = downsample(images, THUMBNAIL_SIZE).reshape(len(images), -1)
+
+    if method == 'median':
+        centroid = np.median(thumbnails, axis=0)
+    else:
+        centroid = thumbnails.mean(axis=0)
+
+    distances = np.sqrt(np.mean(np.square(thumbnails - centroid), axis=1))
+
+    # the median absolute deviation is not skewed by the outliers
+    median_distance = np.median(distances)
+    mad = np.median(np.abs(distances - median_distance)) * 1.4826
+
+    return ((distances - median_distance) / max(mad, 1e-6)).astype(np.float32)
+
+
+def score_label(args):
+    """Read, decode and score the records of a label (in a worker process)."""
+    records, packed_image_filepath, method = args
+
+    png_images = []
+    for _, batch_png_images in iter_png_batches(records, packed_image_filepath, len(records)):
+        png_images.extend(batch_png_images)
+
+    # `iter_png_batches` reads in file order
+    sorted_records = sorted(records, key=lambda record: record['seek_start'])
+    images = decode_images(png_images, input_shape=(IMAGE_SIZE, IMAGE_SIZE))
+
+    record_ids = np.array([record['record_id'] for record in sorted_records])
+    return record_ids, score_images(images, method)
+
+
+def compute_anomaly_scores(
+    records: List[dict],
+    packed_image_filepath: str,
+    method='median',
+    num_workers=1,
+) -> np.ndarray:
+    """Return the anomaly score of every record (higher is more suspicious)."""
+    records_by_label = defaultdict(list)
+    for record_id, record in enumerate(records):
+        records_by_label[record['char']].append({**record, 'record_id': record_id})
+
+    scores = np.zeros(len(records), dtype=np.float32)
+    tasks = [(label_records, packed_image_filepath, method) for label_records in records_by_label.values()]
+
+    with multiprocessing.Pool(num_workers) as pool:
+        for record_ids, label_scores in tqdm(pool.imap_unordered(score_label, tasks), total=len(tasks)):
+            scores[record_ids] = label_scores
+
+    return scores
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Score the records by how much they differ from the other records of their label.',
+    )
+
+    parser.add_argument(
+        '--metadata',
+        dest='metadata_filepath',
+        default='metadata.json',
+        help='Default is \'metadata.json\'.',
+    )
+
+    parser.add_argument(
+        '--images',
+        dest='packed_image_filepath',
+        default='images.bin',
+        help=(
+            f'The packed images (\'images.bin\') or the serialized dataset '
+            f'({repr(SERIALIZED_DATASET_FILENAME)}). Default is \'images.bin\'.'
+        ),
+    )
+
+    parser.add_argument(
+        '--centroid',
+        dest='method',
+        choices=CENTROID_METHODS,
+        default='median',
+        help='The centroid of a label is the per-pixel median (default) or mean image.',
+    )
+
+    parser.add_argument(
+        '--workers',
+        dest='num_workers',
+        type=positive_int,
+        default=os.cpu_count() or 1,
+        help='Number of processes (one label at a time). Default is the number of CPUs.',
+    )
+
+    args = parser.parse_args()
+    print(args)
+
+    if not os.path.exists(args.packed_image_filepath):
+        raise Exception(args.packed_image_filepath + ' does not exist!')
+
+    out_filepath = os.path.join(os.path.dirname(args.metadata_filepath), ANOMALY_SCORES_FILENAME)
+
+    records = load_dataset_metadata(args.metadata_filepath)['records']
+
+    start_time = time.time()
+    scores = compute_anomaly_scores(records, args.packed_image_filepath, args.method, args.num_workers)
+
+    if os.path.exists(out_filepath):
+        backup_file_by_modified_date(out_filepath)
+
+    np.save(out_filepath, scores)
+
+    info(f'Scored {len(records)} records in {time.time() - start_time:.1f}s.')
+
+    info('The most suspicious records:')
+    for record_id in np.argsort(-scores)[:20]:
+        record = records[record_id]
+        print(f'{scores[record_id]:.2f}', record['char'], record['font'], record['hash'], sep='\t')
+
+    info(f'The scores are saved in {repr(out_filepath)}.')
+
+
+if __name__ == '__main__':
+    main()
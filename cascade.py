@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# Two-stage cascade classifier.
+#
+# The first stage is a cheap model which predicts a cluster of visually
+# similar labels. A small head for that cluster then resolves the final
+# label so most of the predictions don't pay for the full softmax over
+# all the labels.
+import os
+import json
+import argparse
+from typing import Dict, List
+
+from tqdm import tqdm
+import numpy as np
+
+import tensorflow as tf
+
+from constants import *
+from logger import *
+from utils import *
+from argtypes import *
+from tensorflow_utils import separable_cnn_model, count_model_macs
+import evaluate_model
+
+CASCADE_CONFIG_FILENAME = 'cascade.json'
+
+
+def compute_label_features(
+    records: List[Dict],
+    packed_image_filepath: str,
+    label_to_index: Dict[str, int],
+    num_classes: int,
+    pool_size=4,
+    batch_size=1024,
+):
+    """
+    Compute the mean image of every label (downsampled by `pool_size`)
+    by streaming the packed images.
+    """
+    feature_size = IMAGE_SIZE // pool_size
+    feature_sums = np.zeros((num_classes, feature_size * feature_size), dtype=np.float64)
+    label_counts = np.zeros(num_classes, dtype=np.int64)
+
+    records = [record for record in records if record['char'] in label_to_index]
+
+    for batch_records, batch_image_data in tqdm(iter_record_batches(records, packed_image_filepath, batch_size)):  # noqa
+        images = decode_images(batch_image_data, (IMAGE_SIZE, IMAGE_SIZE))
+        # average pooling with reshape
+        pooled = images.reshape(-1, feature_size, pool_size, feature_size, pool_size).mean(axis=(2, 4))
+        labels = np.array([label_to_index[record['char']] for record in batch_records], dtype=np.int64)
+
+        np.add.at(feature_sums, labels, pooled.reshape(len(labels), -1))
+        label_counts += np.bincount(labels, minlength=num_classes)
+
+    return feature_sums / np.maximum(label_counts, 1)[:, None]
+
+
+def cluster_labels(features: np.ndarray, num_clusters: int, num_iterations=50, seed=0):
+    """K-means over the label features. Return the cluster id of every label."""
+    rng = np.random.RandomState(seed)
+    num_labels = features.shape[0]
+    num_clusters = min(num_clusters, num_labels)
+
+    centroids = features[rng.choice(num_labels, size=num_clusters, replace=False)].copy()
+    squared_norms = np.sum(features * features, axis=1)
+
+    assignments = np.zeros(num_labels, dtype=np.int64)
+    for _ in range(num_iterations):
+        # squared euclidean distances without materializing the differences
+        distances = squared_norms[:, None] - 2 * features @ centroids.T + np.sum(centroids * centroids, axis=1)[None, :]  # noqa
+        new_assignments = np.argmin(distances, axis=1)
+
+        cluster_sizes = np.bincount(new_assignments, minlength=num_clusters)
+        for cluster_id in np.nonzero(cluster_sizes == 0)[0]:
+            # re-seed empty clusters with the worst fitted label
+            farthest_label = np.argmax(distances[np.arange(num_labels), new_assignments])
+            new_assignments[farthest_label] = cluster_id
+            distances[farthest_label] = 0
+
+        if np.array_equal(new_assignments, assignments):
+            break
+
+        assignments = new_assignments
+        cluster_sizes = np.bincount(assignments, minlength=num_clusters)
+        centroid_sums = np.zeros_like(centroids)
+        np.add.at(centroid_sums, assignments, features)
+        centroids = centroid_sums / np.maximum(cluster_sizes, 1)[:, None]
+
+    return assignments
+
+
+class CascadeClassifier:
+    def __init__(
+        self,
+        stage1: tf.keras.Model,
+        heads: List[tf.keras.Model],
+        clusters: List[List[int]],
+        num_classes: int,
+    ):
+        self.stage1 = stage1
+        self.heads = heads
+        # label indices of every cluster
+        self.clusters = [np.array(cluster, dtype=np.int64) for cluster in clusters]
+        self.num_classes = num_classes
+
+        self.stage1_macs = count_model_macs(stage1)
+        self.head_macs = [count_model_macs(head) for head in heads]
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_images = 0
+        self.num_early_exits = 0
+        self.total_macs = 0
+
+    def predict(self, images: np.ndarray, confidence_threshold=0.9, max_clusters=2):
+        """
+        Return the label scores `p(cluster) * p(label | cluster)`. Only
+        the head of the most probable cluster is evaluated when the first
+        stage is confident. Otherwise, the heads of the `max_clusters`
+        most probable clusters are evaluated.
+        """
+        num_images = images.shape[0]
+        cluster_probs = np.asarray(self.stage1.predict_on_batch(images))
+
+        max_clusters = min(max_clusters, cluster_probs.shape[1])
+        top_clusters = np.argsort(-cluster_probs, axis=1)[:, :max_clusters]
+        confident = cluster_probs[np.arange(num_images), top_clusters[:, 0]] >= confidence_threshold
+
+        scores = np.zeros((num_images, self.num_classes), dtype=np.float32)
+        total_macs = self.stage1_macs * num_images
+
+        for rank in range(max_clusters):
+            selected = np.ones(num_images, dtype=bool) if rank == 0 else ~confident
+            cluster_ids = top_clusters[:, rank]
+
+            for cluster_id in np.unique(cluster_ids[selected]):
+                rows = np.nonzero(selected & (cluster_ids == cluster_id))[0]
+                head_probs = np.asarray(self.heads[cluster_id].predict_on_batch(images[rows]))
+
+                scores[np.ix_(rows, self.clusters[cluster_id])] = cluster_probs[rows, cluster_id, None] * head_probs  # noqa
+                total_macs += self.head_macs[cluster_id] * len(rows)
+
+        self.num_images += num_images
+        self.num_early_exits += int(np.count_nonzero(confident))
+        self.total_macs += total_macs
+
+        return scores
+
+    def save(self, out_dir: str):
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+        head_filenames = []
+        for cluster_id, head in enumerate(self.heads):
+            head_filename = f'head_{cluster_id:04d}.h5'
+            head.save(os.path.join(out_dir, head_filename))
+            head_filenames.append(head_filename)
+
+        self.stage1.save(os.path.join(out_dir, 'stage1.h5'))
+
+        config = {
+            'num_classes': self.num_classes,
+            'clusters': [cluster.tolist() for cluster in self.clusters],
+            'stage1': 'stage1.h5',
+            'heads': head_filenames,
+        }
+
+        with open(os.path.join(out_dir, CASCADE_CONFIG_FILENAME), mode='w', encoding='utf-8') as outfile:
+            json.dump(config, outfile, indent='\t')
+
+    @classmethod
+    def load(cls, cascade_dir: str):
+        config_filepath = os.path.join(cascade_dir, CASCADE_CONFIG_FILENAME)
+        if not os.path.exists(config_filepath):
+            raise Exception(config_filepath + ' does not exist!')
+
+        config = json.load(open(config_filepath, mode='r', encoding='utf-8'))
+
+        stage1 = tf.keras.models.load_model(os.path.join(cascade_dir, config['stage1']))
+        heads = [
+            tf.keras.models.load_model(os.path.join(cascade_dir, head_filename))
+            for head_filename in config['heads']
+        ]
+
+        return cls(stage1, heads, config['clusters'], config['num_classes'])
+
+
+def load_training_data(records: List[Dict], packed_image_filepath: str, label_to_index: Dict[str, int]):
+    records = [record for record in records if record['char'] in label_to_index]
+
+    images = np.empty((len(records), IMAGE_SIZE, IMAGE_SIZE, 1), dtype=np.float32)
+    labels = np.empty(len(records), dtype=np.int64)
+
+    offset = 0
+    for batch_records, batch_image_data in tqdm(iter_record_batches(records, packed_image_filepath, 1024)):  # noqa
+        batch_size = len(batch_records)
+        images[offset:offset + batch_size] = decode_images(batch_image_data)
+        labels[offset:offset + batch_size] = [label_to_index[record['char']] for record in batch_records]  # noqa
+        offset += batch_size
+
+    return images, labels
+
+
+def compile_model(model: tf.keras.Model):
+    model.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=0.001),
+        loss=tf.keras.losses.SparseCategoricalCrossentropy(),
+        metrics=['accuracy'],
+    )
+
+
+def train(args):
+    label_list, label_to_index = load_labels(args.labeling_filepath)
+    num_classes = len(label_list)
+    records = load_dataset_metadata(args.metadata_filepath)['records']
+
+    info('Clustering labels.')
+    features = compute_label_features(records, args.packed_image_filepath, label_to_index, num_classes)
+    assignments = cluster_labels(features, args.num_clusters)
+    num_clusters = int(assignments.max()) + 1
+    clusters = [np.nonzero(assignments == cluster_id)[0] for cluster_id in range(num_clusters)]
+
+    info(f'{num_clusters} clusters, largest cluster has {max(len(c) for c in clusters)} labels.')
+
+    images, labels = load_training_data(records, args.packed_image_filepath, label_to_index)
+    input_shape = images.shape[1:]
+
+    info('Training the first stage.')
+    stage1 = separable_cnn_model(
+        prefix='Cascade_stage1',
+        input_shape=input_shape,
+        num_outputs=num_clusters,
+        width_multiplier=args.stage1_width_multiplier,
+    )
+    compile_model(stage1)
+    stage1.fit(x=images, y=assignments[labels], batch_size=64, shuffle=True, epochs=args.epochs)
+
+    heads = []
+    for cluster_id, cluster in enumerate(clusters):
+        info(f'Training the head for cluster {cluster_id} ({len(cluster)} labels).')
+
+        # map the global label indices to the indices in the cluster
+        local_index = np.full(num_classes, -1, dtype=np.int64)
+        local_index[cluster] = np.arange(len(cluster))
+        selected = local_index[labels] >= 0
+
+        head = separable_cnn_model(
+            prefix=f'Cascade_head_{cluster_id}',
+            input_shape=input_shape,
+            num_outputs=len(cluster),
+            width_multiplier=args.head_width_multiplier,
+            block_filters=(32, 64, 128),
+        )
+        compile_model(head)
+        head.fit(x=images[selected], y=local_index[labels[selected]], batch_size=64, shuffle=True, epochs=args.epochs)  # noqa
+        heads.append(head)
+
+    cascade = CascadeClassifier(stage1, heads, clusters, num_classes)
+    cascade.save(args.out_dir)
+    info(f'Saved the cascade to {repr(args.out_dir)}.')
+
+
+def benchmark(args):
+    label_list, label_to_index = load_labels(args.labeling_filepath)
+    num_classes = len(label_list)
+    records = load_dataset_metadata(args.metadata_filepath)['records']
+
+    cascade = CascadeClassifier.load(args.cascade_dir)
+
+    def cascade_predict(images):
+        return cascade.predict(
+            images,
+            confidence_threshold=args.confidence_threshold,
+            max_clusters=args.max_clusters,
+        )
+
+    info('Evaluating the cascade.')
+    cascade_result = evaluate_model.evaluate(
+        predict_fn=cascade_predict,
+        records=records,
+        packed_image_filepath=args.packed_image_filepath,
+        label_to_index=label_to_index,
+        num_classes=num_classes,
+        batch_size=args.batch_size,
+    )
+
+    cascade_accuracy = cascade_result.accuracy()
+    cascade_macs = cascade.total_macs / max(cascade.num_images, 1)
+    early_exit_rate = cascade.num_early_exits / max(cascade.num_images, 1)
+
+    info(f'Cascade accuracy: {cascade_accuracy:.6f}')
+    info(f'Cascade MACs per image: {cascade_macs:.0f} (first stage {cascade.stage1_macs})')
+    info(f'Early exit rate: {early_exit_rate:.4f}')
+
+    if args.baseline is None:
+        return
+
+    baseline_model = tf.keras.models.load_model(args.baseline)
+    baseline_macs = count_model_macs(baseline_model)
+
+    info('Evaluating the baseline model.')
+    baseline_result = evaluate_model.evaluate(
+        predict_fn=baseline_model.predict_on_batch,
+        records=records,
+        packed_image_filepath=args.packed_image_filepath,
+        label_to_index=label_to_index,
+        num_classes=num_classes,
+        batch_size=args.batch_size,
+    )
+
+    baseline_accuracy = baseline_result.accuracy()
+
+    info(f'Baseline accuracy: {baseline_accuracy:.6f}')
+    info(f'Baseline MACs per image: {baseline_macs}')
+    info(f'Accuracy change: {cascade_accuracy - baseline_accuracy:+.6f}')
+    info(f'MACs saved: {1 - cascade_macs / baseline_macs:.2%}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Train or benchmark the two-stage cascade classifier.',
+    )
+
+    parser.add_argument('--metadata', dest='metadata_filepath', default='metadata.json')
+    parser.add_argument('--images', dest='packed_image_filepath', default='images.bin')
+    parser.add_argument('--labels', dest='labeling_filepath', default='japanese-characters.txt')
+
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    train_parser = subparsers.add_parser('train', help='Cluster the labels and train the cascade.')
+    train_parser.add_argument('--num-clusters', dest='num_clusters', type=positive_int, default=32)
+    train_parser.add_argument('--epochs', dest='epochs', type=positive_int, default=10)
+    train_parser.add_argument('--stage1-width-multiplier', dest='stage1_width_multiplier', type=float, default=0.5)
+    train_parser.add_argument('--head-width-multiplier', dest='head_width_multiplier', type=float, default=0.5)
+    train_parser.add_argument('--out-dir', dest='out_dir', default='cascade_model')
+    train_parser.set_defaults(func=train)
+
+    benchmark_parser = subparsers.add_parser('benchmark', help='Report the accuracy and MACs of the cascade.')
+    benchmark_parser.add_argument('cascade_dir', type=directory)
+    benchmark_parser.add_argument('--baseline', dest='baseline', default=None, help='A Keras model (.h5) to compare with.')
+    benchmark_parser.add_argument('--confidence-threshold', dest='confidence_threshold', type=float, default=0.9)
+    benchmark_parser.add_argument('--max-clusters', dest='max_clusters', type=positive_int, default=2)
+    benchmark_parser.add_argument('--batch-size', dest='batch_size', type=positive_int, default=256)
+    benchmark_parser.set_defaults(func=benchmark)
+
+    args = parser.parse_args()
+    print(args)
+
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
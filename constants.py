@@ -18,7 +18,26 @@ LABEL_FILENAME = 'labels.json'
 DATASETS_DIR = 'datasets'
 SERIALIZED_DATASET_FILENAME = 'dataset.xformat'
 METADATA_FILENAME = 'metadata.json'
-INSPECTED_DATASET_FILENAME = 'inspected-dataset.tfrecord'
+INSPECTED_DATASET_FILENAME = 'inspected-dataset.xformat'
+INSPECTED_METADATA_FILENAME = 'inspected-metadata.json'
 FONTS_DIR = 'fonts'
 FONT_SIZE = 64
 IMAGE_SIZE = 64
+# codepoints that no font should map, rendering one of them draws the
+# font's `.notdef` glyph
+NOTDEF_PROBE_CHARS = ('\U0010FFFD', '\U000FFFFD', '\uFFFF', '\uFDD0')
+REPLACEMENT_CHAR = '\uFFFD'
+# maximum mean absolute pixel difference (0-255) for a rendered image
+# to be considered the same as the font's fallback glyph
+FALLBACK_GLYPH_TOLERANCE = 1.0
+# start to be used in `inspection-server.py`
+REVIEW_JOURNAL_FILENAME = 'review-journal.jsonl'
+# start to be used in `near_duplicates.py`
+NEAR_DUPLICATES_FILENAME = 'near-duplicates.json'
+# start to be used in `anomaly_scores.py`
+ANOMALY_SCORES_FILENAME = 'anomaly-scores.npy'
+# start to be used in `embeddings.py`
+EMBEDDINGS_FILENAME = 'embeddings.npy'
+EMBEDDING_INDEX_FILENAME = 'embedding-index.npz'
+# start to be used in `export-shards.py`
+SHARD_MANIFEST_FILENAME = 'manifest.json'
@@ -147,6 +147,16 @@ def main():
 
                 continue
 
+            # the font maps the character but draws the tofu shape
+            if is_fallback_glyph(image, font, image_size):
+                warn(f'{font.name} gives the fallback glyph for {repr(c)}!')
+                dataset_metadata['unsupported_combinations'].append({
+                    'char': c,
+                    'font': font.name,
+                })
+
+                continue
+
             buffer = io.BytesIO()
             image.save(buffer, format='PNG')
             encoded_image = buffer.getvalue()
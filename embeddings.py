@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# Extract the penultimate layer features of a trained model for every
+# record and build an approximate nearest neighbor index on them so
+# `inspection-server.py` can find the records which look like a given
+# one (mislabeled glyphs, confusable labels and fonts that render the
+# wrong glyph).
+#
+# The embeddings are L2-normalized and saved as a float16 matrix aligned
+# with the records of the metadata (`embeddings.npy` next to it) which is
+# written and read memory-mapped. The index (`embedding-index.npz`) is an
+# inverted file with product quantization (IVF-PQ):
+#
+# - the embeddings are assigned to the nearest of `num_lists` k-means
+# centroids (the inverted lists)
+# - the residual to the centroid is split into `num_subquantizers`
+# sub-vectors and each of them is replaced by the id (a byte) of the
+# nearest of 256 k-means centroids of that sub-space
+#
+# A query only scans the codes of the `nprobe` nearest lists with a
+# lookup table of the sub-vector distances and the best candidates are
+# re-ranked with the exact distances from the memory-mapped embeddings.
+import os
+import time
+import argparse
+from typing import List
+
+from tqdm import tqdm
+import numpy as np
+
+from constants import *
+from logger import *
+from utils import *
+from argtypes import *
+
+# the number of centroids of each sub-quantizer (the codes are bytes)
+NUM_PQ_CENTROIDS = 256
+
+
+def squared_distances(x: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Return the (len(x), len(centroids)) squared L2 distances."""
+    distances = np.sum(np.square(x), axis=1, keepdims=True) - 2 * (x @ centroids.T)
+    distances += np.sum(np.square(centroids), axis=1)
+    return np.maximum(distances, 0, out=distances)
+
+
+def nearest_centroids(x: np.ndarray, centroids: np.ndarray, batch_size=16384) -> np.ndarray:
+    assignments = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), batch_size):
+        batch = np.asarray(x[start:start + batch_size], dtype=np.float32)
+        assignments[start:start + len(batch)] = np.argmin(squared_distances(batch, centroids), axis=1)
+
+    return assignments
+
+
+def kmeans(x: np.ndarray, k: int, num_iterations=20, seed=0) -> np.ndarray:
+    """Lloyd's algorithm, return the (k, dimensions) centroids."""
+    rng = np.random.RandomState(seed)
+    x = np.asarray(x, dtype=np.float32)
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+
+    for _ in range(num_iterations):
+        assignments = nearest_centroids(x, centroids)
+
+        # sum the points of every cluster with one pass over the sorted points
+        order = np.argsort(assignments, kind='stable')
+        cluster_ids, starts, counts = np.unique(assignments[order], return_index=True, return_counts=True)
+        sums = np.add.reduceat(x[order], starts, axis=0)
+
+        new_centroids = centroids.copy()
+        new_centroids[cluster_ids] = sums / counts[:, None]
+
+        # restart the empty clusters from random points
+        empty = np.setdiff1d(np.arange(k), cluster_ids)
+        if len(empty) > 0:
+            new_centroids[empty] = x[rng.choice(len(x), size=len(empty), replace=False)]
+
+        if np.allclose(new_centroids, centroids):
+            centroids = new_centroids
+            break
+
+        centroids = new_centroids
+
+    return centroids
+
+
+class IVFPQIndex:
+    """
+    An inverted file index with product quantized residuals.
+
+    - `coarse_centroids` - (num_lists, dimensions)
+    - `pq_centroids` - (num_subquantizers, 256, dimensions / num_subquantizers)
+    - `list_offsets` - the codes of list `i` are `codes[list_offsets[i]:list_offsets[i + 1]]`
+    - `record_ids` - the record of every code
+    - `codes` - (number of records, num_subquantizers) uint8
+    """
+
+    def __init__(
+        self,
+        coarse_centroids: np.ndarray,
+        pq_centroids: np.ndarray,
+        list_offsets: np.ndarray,
+        record_ids: np.ndarray,
+        codes: np.ndarray,
+    ):
+        self.coarse_centroids = coarse_centroids
+        self.pq_centroids = pq_centroids
+        self.list_offsets = list_offsets
+        self.record_ids = record_ids
+        self.codes = codes
+
+    @property
+    def num_lists(self):
+        return len(self.coarse_centroids)
+
+    @property
+    def num_subquantizers(self):
+        return len(self.pq_centroids)
+
+    def __len__(self):
+        return len(self.record_ids)
+
+    def split(self, x: np.ndarray) -> np.ndarray:
+        """(N, dimensions) -> (N, num_subquantizers, sub-vector dimensions)"""
+        return x.reshape(len(x), self.num_subquantizers, -1)
+
+    def encode(self, residuals: np.ndarray) -> np.ndarray:
+        sub_vectors = self.split(residuals)
+        codes = np.empty(sub_vectors.shape[:2], dtype=np.uint8)
+        for m in range(self.num_subquantizers):
+            codes[:, m] = nearest_centroids(sub_vectors[:, m], self.pq_centroids[m])
+
+        return codes
+
+    @classmethod
+    def build(
+        cls,
+        embeddings: np.ndarray,
+        num_lists: int,
+        num_subquantizers: int,
+        sample_size=100000,
+        batch_size=65536,
+        seed=0,
+    ):
+        """Train the quantizers on a sample and encode all the (memory-mapped) embeddings."""
+        num_records, dimensions = embeddings.shape
+        if dimensions % num_subquantizers != 0:
+            raise Exception(f'The embedding dimensions ({dimensions}) must be divisible by the number of sub-quantizers ({num_subquantizers})!')  # noqa
+
+        rng = np.random.RandomState(seed)
+        sample_ids = np.sort(rng.choice(num_records, size=min(sample_size, num_records), replace=False))
+        sample = np.asarray(embeddings[sample_ids], dtype=np.float32)
+
+        num_lists = min(num_lists, len(sample))
+        info(f'Training {num_lists} coarse centroids on {len(sample)} embeddings.')
+        coarse_centroids = kmeans(sample, num_lists, seed=seed)
+
+        residuals = sample - coarse_centroids[nearest_centroids(sample, coarse_centroids)]
+        residuals = residuals.reshape(len(sample), num_subquantizers, -1)
+        num_pq_centroids = min(NUM_PQ_CENTROIDS, len(sample))
+
+        info(f'Training {num_subquantizers} sub-quantizers.')
+        pq_centroids = np.stack([
+            kmeans(residuals[:, m], num_pq_centroids, seed=seed)
+            for m in tqdm(range(num_subquantizers))
+        ])
+
+        index = cls(coarse_centroids, pq_centroids, None, None, None)
+
+        list_ids = np.empty(num_records, dtype=np.int64)
+        codes = np.empty((num_records, num_subquantizers), dtype=np.uint8)
+
+        info(f'Encoding {num_records} embeddings.')
+        for start in tqdm(range(0, num_records, batch_size)):
+            batch = np.asarray(embeddings[start:start + batch_size], dtype=np.float32)
+            batch_list_ids = nearest_centroids(batch, coarse_centroids)
+            list_ids[start:start + len(batch)] = batch_list_ids
+            codes[start:start + len(batch)] = index.encode(batch - coarse_centroids[batch_list_ids])
+
+        # store the codes of every list contiguously
+        order = np.argsort(list_ids, kind='stable')
+        index.list_offsets = np.searchsorted(list_ids[order], np.arange(num_lists + 1)).astype(np.int64)
+        index.record_ids = order.astype(np.int64)
+        index.codes = codes[order]
+
+        return index
+
+    def search(self, query: np.ndarray, k: int, nprobe=8, embeddings: np.ndarray = None, rerank_factor=4):
+        """
+        Return the record ids and the squared distances of the (about)
+        `k` nearest neighbors of the query, the nearest first. The
+        candidates are re-ranked with the exact distances when the
+        embeddings are given.
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+
+        nprobe = min(nprobe, self.num_lists)
+        coarse_distances = squared_distances(query[None], self.coarse_centroids)[0]
+        probes = np.argpartition(coarse_distances, nprobe - 1)[:nprobe]
+
+        starts = self.list_offsets[probes]
+        stops = self.list_offsets[probes + 1]
+        sizes = stops - starts
+        if sizes.sum() == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        # (nprobe, num_subquantizers, 256) distances of the sub-vectors
+        # of every residual to the sub-quantizer centroids
+        residuals = self.split(query[None] - self.coarse_centroids[probes])
+        lookup_tables = np.sum(np.square(residuals[:, :, None, :] - self.pq_centroids[None]), axis=-1)
+
+        candidate_positions = np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)])
+        candidate_probes = np.repeat(np.arange(nprobe), sizes)
+
+        candidate_codes = self.codes[candidate_positions]
+        subquantizer_ids = np.arange(self.num_subquantizers)
+        distances = lookup_tables[candidate_probes[:, None], subquantizer_ids, candidate_codes].sum(axis=1)
+
+        num_candidates = min(len(distances), k if embeddings is None else k * rerank_factor)
+        best = np.argpartition(distances, num_candidates - 1)[:num_candidates]
+        record_ids = self.record_ids[candidate_positions[best]]
+        distances = distances[best]
+
+        if embeddings is not None:
+            candidate_embeddings = np.asarray(embeddings[np.sort(record_ids)], dtype=np.float32)
+            record_ids = np.sort(record_ids)
+            distances = np.sum(np.square(candidate_embeddings - query), axis=1)
+
+        order = np.argsort(distances, kind='stable')[:k]
+        return record_ids[order], distances[order].astype(np.float32)
+
+    def save(self, filepath: str):
+        np.savez(
+            filepath,
+            coarse_centroids=self.coarse_centroids,
+            pq_centroids=self.pq_centroids,
+            list_offsets=self.list_offsets,
+            record_ids=self.record_ids,
+            codes=self.codes,
+        )
+
+    @classmethod
+    def load(cls, filepath: str):
+        with np.load(filepath) as npz:
+            return cls(
+                coarse_centroids=npz['coarse_centroids'],
+                pq_centroids=npz['pq_centroids'],
+                list_offsets=npz['list_offsets'],
+                record_ids=npz['record_ids'],
+                codes=npz['codes'],
+            )
+
+
+def extract_embeddings(
+    model,
+    records: List[dict],
+    packed_image_filepath: str,
+    out_filepath: str,
+    batch_size=256,
+) -> np.ndarray:
+    """
+    Run the model (without its classifier) over the records and write
+    the normalized features to a memory-mapped float16 matrix aligned
+    with the records.
+    """
+    input_shape = (IMAGE_SIZE, IMAGE_SIZE, 1)
+    dimensions = int(np.prod(model.predict(np.zeros((1, *input_shape), dtype=np.float32)).shape[1:]))
+
+    embeddings = np.lib.format.open_memmap(
+        out_filepath,
+        mode='w+',
+        dtype=np.float16,
+        shape=(len(records), dimensions),
+    )
+
+    records = [{**record, 'record_id': record_id} for record_id, record in enumerate(records)]
+
+    pbar = tqdm(total=len(records))
+    for batch_records, png_images in iter_png_batches(records, packed_image_filepath, batch_size):
+        features = model.predict(decode_images(png_images, input_shape)).reshape(len(png_images), -1)
+        features /= np.maximum(np.linalg.norm(features, axis=1, keepdims=True), 1e-12)
+
+        record_ids = [record['record_id'] for record in batch_records]
+        embeddings[record_ids] = features.astype(np.float16)
+        pbar.update(len(batch_records))
+
+    pbar.close()
+    embeddings.flush()
+
+    return embeddings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Extract the embeddings of the records with a trained model and index them.',
+    )
+
+    parser.add_argument(
+        'model',
+        nargs='?',
+        default=None,
+        help='The Keras model (.h5) file. Not needed with --index-only.',
+    )
+
+    parser.add_argument(
+        '--metadata',
+        dest='metadata_filepath',
+        default='metadata.json',
+        help='Default is \'metadata.json\'.',
+    )
+
+    parser.add_argument(
+        '--images',
+        dest='packed_image_filepath',
+        default='images.bin',
+        help=(
+            f'The packed images (\'images.bin\') or the serialized dataset '
+            f'({repr(SERIALIZED_DATASET_FILENAME)}). Default is \'images.bin\'.'
+        ),
+    )
+
+    parser.add_argument(
+        '--batch-size',
+        dest='batch_size',
+        type=positive_int,
+        default=256,
+    )
+
+    parser.add_argument(
+        '--lists',
+        dest='num_lists',
+        type=positive_int,
+        default=None,
+        help='Number of inverted lists. Default is 4 times the square root of the number of records.',
+    )
+
+    parser.add_argument(
+        '--subquantizers',
+        dest='num_subquantizers',
+        type=positive_int,
+        default=16,
+        help=(
+            'Number of sub-quantizers (bytes per record), it must divide '
+            'the embedding dimensions. Default is 16.'
+        ),
+    )
+
+    parser.add_argument(
+        '--index-only',
+        dest='index_only',
+        action='store_true',
+        help='Only build the index from the existing embeddings.',
+    )
+
+    args = parser.parse_args()
+    print(args)
+
+    if args.model is None and not args.index_only:
+        raise Exception('The model is required to extract the embeddings (or use --index-only)!')
+
+    out_dir = os.path.dirname(args.metadata_filepath)
+    embeddings_filepath = os.path.join(out_dir, EMBEDDINGS_FILENAME)
+    index_filepath = os.path.join(out_dir, EMBEDDING_INDEX_FILENAME)
+
+    records = load_dataset_metadata(args.metadata_filepath)['records']
+
+    start_time = time.time()
+
+    if args.index_only:
+        if not os.path.exists(embeddings_filepath):
+            raise Exception(embeddings_filepath + ' does not exist!')
+
+        embeddings = np.load(embeddings_filepath, mmap_mode='r')
+        if len(embeddings) != len(records):
+            raise Exception(f'{embeddings_filepath} doesn\'t have an embedding for every record!')
+    else:
+        if not os.path.exists(args.model):
+            raise Exception(args.model + ' does not exist!')
+
+        if not os.path.exists(args.packed_image_filepath):
+            raise Exception(args.packed_image_filepath + ' does not exist!')
+
+        import numpy_inference
+        model = numpy_inference.load_model(args.model).penultimate()
+
+        if os.path.exists(embeddings_filepath):
+            backup_file_by_modified_date(embeddings_filepath)
+
+        embeddings = extract_embeddings(model, records, args.packed_image_filepath, embeddings_filepath, args.batch_size)  # noqa
+        info(f'Extracted {embeddings.shape} embeddings in {time.time() - start_time:.1f}s.')
+
+    num_lists = args.num_lists or max(1, int(4 * np.sqrt(len(records))))
+    index = IVFPQIndex.build(embeddings, num_lists, args.num_subquantizers)
+
+    if os.path.exists(index_filepath):
+        backup_file_by_modified_date(index_filepath)
+
+    index.save(index_filepath)
+
+    info(f'Indexed {len(index)} records in {index.num_lists} lists in {time.time() - start_time:.1f}s.')
+    info(f'The embeddings are saved in {repr(embeddings_filepath)} and the index in {repr(index_filepath)}.')
+
+
+if __name__ == '__main__':
+    main()
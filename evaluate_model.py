@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# Evaluate a trained model over the whole dataset without loading all
+# the images (or all the model outputs) into memory.
+import os
+import time
+import argparse
+from typing import Callable, Dict, List
+
+from tqdm import tqdm
+import numpy as np
+
+from constants import *
+from logger import *
+from utils import *
+from argtypes import *
+
+
+class EvaluationResult:
+    def __init__(self, num_classes: int, font_names: List[str]):
+        self.num_classes = num_classes
+        self.font_names = font_names
+        # flattened (true label, predicted label) counts
+        self.confusion_counts = np.zeros(num_classes * num_classes, dtype=np.int64)
+        self.font_correct = np.zeros(len(font_names), dtype=np.int64)
+        self.font_total = np.zeros(len(font_names), dtype=np.int64)
+
+    @property
+    def confusion_matrix(self) -> np.ndarray:
+        return self.confusion_counts.reshape(self.num_classes, self.num_classes)
+
+    def update(self, true_labels: np.ndarray, predicted_labels: np.ndarray, font_ids: np.ndarray):
+        self.confusion_counts += np.bincount(
+            true_labels * self.num_classes + predicted_labels,
+            minlength=self.num_classes * self.num_classes,
+        )
+
+        correct = (true_labels == predicted_labels).astype(np.int64)
+        self.font_correct += np.bincount(font_ids, weights=correct, minlength=len(self.font_names)).astype(np.int64)  # noqa
+        self.font_total += np.bincount(font_ids, minlength=len(self.font_names))
+
+    def accuracy(self):
+        total = self.confusion_counts.sum()
+        if total == 0:
+            return 0.0
+
+        return np.trace(self.confusion_matrix) / total
+
+    def label_accuracy(self):
+        """Return (number of correct predictions, number of records) for every label."""
+        confusion_matrix = self.confusion_matrix
+        return np.diagonal(confusion_matrix).copy(), confusion_matrix.sum(axis=1)
+
+    def top_confused_pairs(self, k: int):
+        """Return the `k` most frequent (true label, predicted label, count) mistakes."""
+        mistakes = self.confusion_matrix.copy()
+        np.fill_diagonal(mistakes, 0)
+        mistakes = mistakes.reshape(-1)
+
+        k = min(k, np.count_nonzero(mistakes))
+        if k == 0:
+            return []
+
+        top_indices = np.argpartition(mistakes, -k)[-k:]
+        top_indices = top_indices[np.argsort(mistakes[top_indices])[::-1]]
+
+        return [
+            (int(idx // self.num_classes), int(idx % self.num_classes), int(mistakes[idx]))
+            for idx in top_indices
+        ]
+
+
+def evaluate(
+    predict_fn: Callable[[np.ndarray], np.ndarray],
+    records: List[Dict],
+    packed_image_filepath: str,
+    label_to_index: Dict[str, int],
+    num_classes: int,
+    batch_size=256,
+    input_shape=(IMAGE_SIZE, IMAGE_SIZE, 1),
+):
+    """
+    Stream the records from the packed image file in batches and
+    accumulate the confusion matrix and per-font accuracy.
+    `predict_fn` takes a batch of images and returns the class scores.
+    """
+    records = [record for record in records if record['char'] in label_to_index]
+
+    font_names = sorted(set(record['font'] for record in records))
+    font_to_index = {font_name: idx for idx, font_name in enumerate(font_names)}
+
+    result = EvaluationResult(num_classes, font_names)
+
+    pbar = tqdm(total=len(records))
+    for batch_records, batch_image_data in iter_record_batches(records, packed_image_filepath, batch_size):
+        images = decode_images(batch_image_data, input_shape)
+        outputs = np.asarray(predict_fn(images))
+        predicted_labels = np.argmax(outputs, axis=-1)
+
+        true_labels = np.array([label_to_index[record['char']] for record in batch_records], dtype=np.int64)  # noqa
+        font_ids = np.array([font_to_index[record['font']] for record in batch_records], dtype=np.int64)  # noqa
+
+        result.update(true_labels, predicted_labels.astype(np.int64), font_ids)
+        pbar.update(len(batch_records))
+
+    pbar.close()
+    return result
+
+
+def write_tsv(filepath: str, header: tuple, rows: list):
+    with open(filepath, mode='w', encoding='utf-8') as outfile:
+        outfile.write('\t'.join(header) + '\n')
+        for row in rows:
+            outfile.write('\t'.join(str(x) for x in row) + '\n')
+
+
+def write_report(result: EvaluationResult, label_list: List[Dict], out_dir: str, num_confused_pairs: int):
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    np.save(os.path.join(out_dir, 'confusion_matrix.npy'), result.confusion_matrix)
+
+    label_correct, label_total = result.label_accuracy()
+    label_rows = []
+    for idx, label_entry in enumerate(label_list):
+        total = label_total[idx]
+        if total == 0:
+            continue
+
+        label_rows.append((idx, label_entry['label_chars'], label_correct[idx], total, f'{label_correct[idx] / total:.6f}'))  # noqa
+
+    # worst labels first
+    label_rows.sort(key=lambda row: float(row[4]))
+    write_tsv(
+        os.path.join(out_dir, 'label_accuracy.tsv'),
+        ('index', 'label', 'correct', 'total', 'accuracy'),
+        label_rows,
+    )
+
+    font_rows = []
+    for idx, font_name in enumerate(result.font_names):
+        total = result.font_total[idx]
+        if total == 0:
+            continue
+
+        font_rows.append((font_name, result.font_correct[idx], total, f'{result.font_correct[idx] / total:.6f}'))  # noqa
+
+    font_rows.sort(key=lambda row: float(row[3]))
+    write_tsv(
+        os.path.join(out_dir, 'font_accuracy.tsv'),
+        ('font', 'correct', 'total', 'accuracy'),
+        font_rows,
+    )
+
+    confused_rows = []
+    for true_idx, predicted_idx, count in result.top_confused_pairs(num_confused_pairs):
+        confused_rows.append((
+            label_list[true_idx]['label_chars'],
+            label_list[predicted_idx]['label_chars'],
+            count,
+        ))
+
+    write_tsv(
+        os.path.join(out_dir, 'confused_pairs.tsv'),
+        ('label', 'predicted', 'count'),
+        confused_rows,
+    )
+
+    return label_rows, font_rows, confused_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Evaluate a trained model on the packed dataset.',
+    )
+
+    parser.add_argument('model', help='The Keras model (.h5) file.')
+
+    parser.add_argument(
+        '--metadata',
+        dest='metadata_filepath',
+        default='metadata.json',
+        help='Default is \'metadata.json\'.',
+    )
+
+    parser.add_argument(
+        '--images',
+        dest='packed_image_filepath',
+        default='images.bin',
+        help='Default is \'images.bin\'.',
+    )
+
+    parser.add_argument(
+        '--labels',
+        dest='labeling_filepath',
+        default='japanese-characters.txt',
+        help='Default is \'japanese-characters.txt\'.',
+    )
+
+    parser.add_argument(
+        '--batch-size',
+        dest='batch_size',
+        type=positive_int,
+        default=256,
+    )
+
+    parser.add_argument(
+        '--num-confused-pairs',
+        dest='num_confused_pairs',
+        type=positive_int,
+        default=50,
+        help='Number of the most confused label pairs to report. Default is 50.',
+    )
+
+    parser.add_argument(
+        '--out-dir',
+        dest='out_dir',
+        default=None,
+        help='Default is \'evaluation-<timestamp>\'.',
+    )
+
+    args = parser.parse_args()
+    print(args)
+
+    if not os.path.exists(args.model):
+        raise Exception(args.model + ' does not exist!')
+
+    if not os.path.exists(args.packed_image_filepath):
+        raise Exception(args.packed_image_filepath + ' does not exist!')
+
+    out_dir = args.out_dir
+    if out_dir is None:
+        out_dir = f'evaluation-{timestamp_to_datetime(time.time())}'
+
+    label_list, label_to_index = load_labels(args.labeling_filepath)
+    dataset_metadata = load_dataset_metadata(args.metadata_filepath)
+
+    import tensorflow as tf
+    model = tf.keras.models.load_model(args.model)
+
+    result = evaluate(
+        predict_fn=model.predict_on_batch,
+        records=dataset_metadata['records'],
+        packed_image_filepath=args.packed_image_filepath,
+        label_to_index=label_to_index,
+        num_classes=len(label_list),
+        batch_size=args.batch_size,
+    )
+
+    label_rows, font_rows, confused_rows = write_report(
+        result=result,
+        label_list=label_list,
+        out_dir=out_dir,
+        num_confused_pairs=args.num_confused_pairs,
+    )
+
+    info(f'Accuracy: {result.accuracy():.6f}')
+
+    info('Worst labels:')
+    for row in label_rows[:10]:
+        print(*row, sep='\t')
+
+    info('Worst fonts:')
+    for row in font_rows[:10]:
+        print(*row, sep='\t')
+
+    info('Most confused pairs:')
+    for row in confused_rows[:10]:
+        print(*row, sep='\t')
+
+    info(f'The report is saved in {repr(out_dir)}.')
+
+
+if __name__ == '__main__':
+    main()
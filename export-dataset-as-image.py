@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 # encoding=utf-8
+# Export the images of every label as a single montage image (and the
+# records of the label as JSON) to look through the dataset quickly.
+#
+# The packed images are read once in file order. A label is composed and
+# written in a worker process as soon as all of its images have been
+# read so only the labels in flight are kept in memory (the records are
+# created label by label so that is usually just a few labels).
 import os
 import io
-import gc
 import json
 import math
+import argparse
 import collections
-import traceback
+import multiprocessing
 from typing import Dict, List
 
 from tqdm import tqdm
@@ -15,42 +22,114 @@ import numpy as np
 import PIL
 import PIL.Image
 
+from constants import *
+from logger import *
+from argtypes import *
 import utils
 
 def find_appropriate_width(n: int):
     x = math.sqrt(n)
     return math.ceil(x)
 
-def fetch_image_data(records: List[Dict], packed_image_filepath: str):
-    sorted_records = [*records]
-    sorted_records.sort(key=lambda record: record['seek_start'])
+def checkerboard(height: int, width: int):
+    # the pattern marks the empty image slots that are not filled
+    canvas = np.zeros(shape=(height, width), dtype=np.uint8)
+    canvas[0::2, 0::2] = 255
+    canvas[1::2, 1::2] = 255
+    return canvas
 
-    with open(packed_image_filepath, mode='rb') as infile:
-        last_seek_end = -1
-        for record in sorted_records:
-            seek_start: int = record['seek_start']
-            seek_end: int = record['seek_end']
-            image_data_size = seek_end - seek_start
+def compose_montage(png_images: List[bytes], image_width=IMAGE_SIZE, image_height=IMAGE_SIZE):
+    num_images = len(png_images)
+    # the number of images in a row of the montage
+    num_rows = find_appropriate_width(num_images)
+    num_cols = math.ceil(num_images / num_rows)
 
-            if last_seek_end != seek_start:
-                infile.seek(seek_start)
+    # the empty slots at the end keep the checkerboard
+    tiles = np.empty(shape=(num_rows * num_cols, image_height, image_width), dtype=np.uint8)
+    tiles[num_images:] = checkerboard(image_height, image_width)
 
-            image_data = infile.read(image_data_size)
-            record['image_data'] = image_data
+    for image_idx, png_image in enumerate(png_images):
+        pil_image = PIL.Image.open(io.BytesIO(png_image))
+        tiles[image_idx] = np.asarray(pil_image, dtype=np.uint8)
 
-            last_seek_end = seek_end
+    # (num_cols, num_rows, height, width) -> (num_cols * height, num_rows * width)
+    canvas = tiles.reshape(num_cols, num_rows, image_height, image_width)
+    canvas = canvas.transpose(0, 2, 1, 3).reshape(num_cols * image_height, num_rows * image_width)
 
+    return canvas
 
-def free_image_data_for_memory(records: List[Dict]):
-    for record in records:
-        if 'image_data' in record:
-            del record['image_data']
+def export_label(args):
+    """Compose and write the montage and the records of a label (in a worker process)."""
+    label_char, records, png_images, basepath = args
+
+    canvas = compose_montage(png_images)
+
+    buffer = io.BytesIO()
+    pil_image = PIL.Image.fromarray(canvas)
+    pil_image.save(buffer, format='PNG')
+
+    open(basepath + '.png', mode='wb').write(buffer.getvalue())
+    with open(basepath + '.json', mode='wb') as outfile:
+        json_str = json.dumps(records, ensure_ascii=False, indent='\t')
+        if json_str[-1] != '\n':
+            json_str += '\n'
+
+        json_bs = json_str.encode('utf-8')
 
-    gc.collect()
+        outfile.write(json_bs)
+
+    return label_char, len(records)
 
 def main():
-    metadata_filepath = 'metadata.json'
-    packed_image_filepath = 'images.bin'
+    parser = argparse.ArgumentParser(
+        description='Export the images of every label as a montage image.',
+    )
+
+    parser.add_argument(
+        '--metadata',
+        dest='metadata_filepath',
+        default='metadata.json',
+        help='Default is \'metadata.json\'.',
+    )
+
+    parser.add_argument(
+        '--images',
+        dest='packed_image_filepath',
+        default='images.bin',
+        help=(
+            f'The packed images (\'images.bin\') or the serialized dataset '
+            f'({repr(SERIALIZED_DATASET_FILENAME)}). Default is \'images.bin\'.'
+        ),
+    )
+
+    parser.add_argument(
+        '--out-dir',
+        dest='export_dir_filepath',
+        default='exported_images',
+        help='Default is \'exported_images\'.',
+    )
+
+    parser.add_argument(
+        '--workers',
+        dest='num_workers',
+        type=positive_int,
+        default=os.cpu_count() or 1,
+        help='Number of processes for composing the montages. Default is the number of CPUs.',
+    )
+
+    parser.add_argument(
+        '--batch-size',
+        dest='batch_size',
+        type=positive_int,
+        default=4096,
+        help='Number of images read at once. Default is 4096.',
+    )
+
+    args = parser.parse_args()
+    print(args)
+
+    metadata_filepath = args.metadata_filepath
+    packed_image_filepath = args.packed_image_filepath
 
     if not os.path.exists(metadata_filepath):
         raise Exception(metadata_filepath + ' does not exist!')
@@ -58,100 +137,79 @@ def main():
     if not os.path.exists(packed_image_filepath):
         raise Exception(packed_image_filepath + ' does not exist!')
 
-    metadata_bs = open(metadata_filepath, mode='rb').read()
-    metadata_json_str = metadata_bs.decode('utf-8')
-    dataset_metadata: Dict[str, List[dict]] = json.loads(metadata_json_str)
+    dataset_metadata: Dict[str, List[dict]] = utils.load_dataset_metadata(metadata_filepath)
     records = dataset_metadata['records']
 
     categorized_records = collections.defaultdict(list)
 
     unicode_codepoints = []
 
+    # the position of every record in the montage of its label
+    record_positions = []
+
     for record in records:
         char = record['char']
+        record_positions.append(len(categorized_records[char]))
         categorized_records[char].append(record)
         unicode_codepoints.append(ord(char))
 
+    if len(records) == 0:
+        warn(f'{metadata_filepath} does not have any records!')
+        return
+
     tmp = map(lambda x: len(repr(x)), unicode_codepoints)
     num_pads = max(tmp)
 
-    export_dir_filepath = 'exported_images'
+    export_dir_filepath = args.export_dir_filepath
     if os.path.exists(export_dir_filepath):
         utils.backup_file_by_modified_date(export_dir_filepath)
 
     os.makedirs(export_dir_filepath)
 
-    categories = list(categorized_records.keys())
-    pbar = tqdm(categories)
-    for category in pbar:
-        records = categorized_records[category]
-        num_images = len(records)
-
-        pbar.set_description(f'{category} - {num_images}')
-
-        num_rows = find_appropriate_width(num_images)
-        num_cols = math.ceil(num_images / num_rows)
-        image_width = 64
-        image_height = 64
-        canvas_width = num_rows * image_width
-        canvas_height = num_cols * image_height
-        canvas = np.zeros(shape=(canvas_height, canvas_width), dtype=np.uint8)
-
-        # make pattern to detect empty image slots that are not filled
-        for i in range(canvas_height):
-            for j in range(canvas_width):
-                if (i % 2) == 0:
-                    if (j % 2) == 0:
-                        canvas[i,j] = 255
-                else:
-                    if (j % 2) != 0:
-                        canvas[i,j] = 255
-
-        fetch_image_data(records, packed_image_filepath)
-
-        image_idx = 0
-        for record in records:
-            row = image_idx % num_rows
-            col = math.floor(image_idx / num_rows)
-
-            image_data: bytes = record['image_data']
-            buffer = io.BytesIO(image_data)
-            pil_image = PIL.Image.open(buffer)
-            np_image = np.array(pil_image, dtype=np.uint8)
-
-            top = col * image_height
-            bottom = (col + 1) * image_width
-            left = row * image_width
-            right = (row+1) * image_width
-
-            canvas[top:bottom, left:right] = np_image
-
-            image_idx += 1
-
-        free_image_data_for_memory(records)
-
-        buffer = io.BytesIO()
-        pil_image = PIL.Image.fromarray(canvas)
-        pil_image.save(buffer, format='PNG')
-
-        del canvas
-        gc.collect()
-
-        label_char = category
-        unicode_codepoint = ord(label_char)
-        basename = repr(unicode_codepoint).zfill(num_pads) + '_' + label_char
-        image_filepath = os.path.join(export_dir_filepath, basename + '.png')
-        records_metadata_filepath = os.path.join(export_dir_filepath, basename + '.json')
-
-        open(image_filepath, mode='wb').write(buffer.getvalue())
-        with open(records_metadata_filepath, mode='wb') as outfile:
-            json_str = json.dumps(records, ensure_ascii=False, indent='\t')
-            if json_str[-1] != '\n':
-                json_str += '\n'
-
-            json_bs = json_str.encode('utf-8')
-
-            outfile.write(json_bs)
+    # the images of the labels which haven't been read completely
+    label_images: Dict[str, List[bytes]] = {}
+    num_remaining = {label_char: len(label_records) for label_char, label_records in categorized_records.items()}
+
+    indexed_records = [{**record, 'record_id': record_id} for record_id, record in enumerate(records)]
+    batches = utils.iter_png_batches(indexed_records, packed_image_filepath, args.batch_size)
+
+    pbar = tqdm(total=len(categorized_records))
+
+    with multiprocessing.Pool(args.num_workers) as pool:
+        pending = collections.deque()
+
+        def wait_for_label():
+            label_char, num_images = pending.popleft().get()
+            pbar.set_description(f'{label_char} - {num_images}')
+            pbar.update(1)
+
+        for batch_records, png_images in batches:
+            for record, png_image in zip(batch_records, png_images):
+                label_char = record['char']
+                if label_char not in label_images:
+                    label_images[label_char] = [None] * len(categorized_records[label_char])
+
+                label_images[label_char][record_positions[record['record_id']]] = png_image
+                num_remaining[label_char] -= 1
+
+                if num_remaining[label_char] > 0:
+                    continue
+
+                unicode_codepoint = ord(label_char)
+                basename = repr(unicode_codepoint).zfill(num_pads) + '_' + label_char
+                basepath = os.path.join(export_dir_filepath, basename)
+
+                task = (label_char, categorized_records[label_char], label_images.pop(label_char), basepath)
+                pending.append(pool.apply_async(export_label, (task,)))
+
+                # don't keep more labels in memory than the workers can compose
+                while len(pending) > args.num_workers * 2:
+                    wait_for_label()
+
+        while len(pending) > 0:
+            wait_for_label()
+
+    pbar.close()
 
 if __name__ == '__main__':
     main()
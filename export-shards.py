@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# Export the dataset to pre-shuffled, size-capped shards for training.
+#
+# The records are shuffled once and split into shards which are written
+# in parallel straight from the packed images (no loose image files).
+# Two formats are supported:
+#
+# - `tfrecord` - `tf.train.Example`s with the PNG `image`, the `label`
+# index and the `char`, `font` and `hash` of the record
+# - `tar` - WebDataset-style tar files where every sample is
+# `<key>.png`, `<key>.cls` (the label index) and `<key>.json`
+#
+# `manifest.json` lists the shards with their number of records so the
+# training can read the shards interleaved without counting the records
+# (see `tensorflow_utils.load_shards`).
+import os
+import io
+import json
+import math
+import time
+import tarfile
+import hashlib
+import argparse
+import multiprocessing
+from typing import Dict, List
+
+from tqdm import tqdm
+import numpy as np
+
+from constants import *
+from logger import *
+from utils import *
+from argtypes import *
+
+SHARD_FORMATS = {
+    'tfrecord': '.tfrecord',
+    'tar': '.tar',
+}
+
+
+def sample_key(record: dict) -> str:
+    return f'{record["sample_id"]:09d}'
+
+
+def write_tfrecord_shard(shard_filepath: str, records: List[dict], png_images: List[bytes]):
+    # imported here so the tar shards don't need TensorFlow
+    import tensorflow as tf
+
+    def bytes_feature(value: bytes):
+        return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+    def int64_feature(value: int):
+        return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+    with tf.io.TFRecordWriter(shard_filepath) as writer:
+        for record, png_image in zip(records, png_images):
+            example = tf.train.Example(features=tf.train.Features(feature={
+                'image': bytes_feature(png_image),
+                'label': int64_feature(record['label']),
+                'char': bytes_feature(record['char'].encode('utf-8')),
+                'font': bytes_feature(record['font'].encode('utf-8')),
+                'hash': bytes_feature(record['hash'].encode('utf-8')),
+            }))
+
+            writer.write(example.SerializeToString())
+
+
+def write_tar_shard(shard_filepath: str, records: List[dict], png_images: List[bytes]):
+    def add_file(tar: tarfile.TarFile, name: str, data: bytes):
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.size = len(data)
+        tarinfo.mtime = MODULE_IMPORT_TIME
+        tar.addfile(tarinfo, io.BytesIO(data))
+
+    with tarfile.open(shard_filepath, mode='w') as tar:
+        for record, png_image in zip(records, png_images):
+            key = sample_key(record)
+            sample_info = {
+                'char': record['char'],
+                'font': record['font'],
+                'hash': record['hash'],
+            }
+
+            add_file(tar, f'{key}.png', png_image)
+            add_file(tar, f'{key}.cls', str(record['label']).encode('utf-8'))
+            add_file(tar, f'{key}.json', json.dumps(sample_info, ensure_ascii=False).encode('utf-8'))
+
+
+SHARD_WRITERS = {
+    'tfrecord': write_tfrecord_shard,
+    'tar': write_tar_shard,
+}
+
+
+def write_shard(args):
+    """Read the images of a shard in file order and write them in the shuffled order (in a worker process)."""
+    shard_filepath, shard_format, records, packed_image_filepath = args
+
+    png_images: List[bytes] = [None] * len(records)
+    records = [{**record, 'shard_position': position} for position, record in enumerate(records)]
+
+    for batch_records, batch_png_images in iter_png_batches(records, packed_image_filepath, len(records)):
+        for record, png_image in zip(batch_records, batch_png_images):
+            png_images[record['shard_position']] = png_image
+
+    SHARD_WRITERS[shard_format](shard_filepath, records, png_images)
+
+    return {
+        'filename': os.path.basename(shard_filepath),
+        'num_records': len(records),
+        'size': os.path.getsize(shard_filepath),
+    }
+
+
+def split_into_shards(records: List[dict], num_shards: int, max_shard_size: int) -> List[List[dict]]:
+    """Split the (shuffled) records into at least `num_shards` shards of about `max_shard_size` bytes at most."""
+    total_size = sum(record['seek_end'] - record['seek_start'] for record in records)
+    num_shards = max(num_shards, math.ceil(total_size / max_shard_size))
+    num_shards = max(1, min(num_shards, len(records)))
+
+    boundaries = np.linspace(0, len(records), num_shards + 1).astype(np.int64)
+    return [records[start:stop] for start, stop in zip(boundaries[:-1], boundaries[1:])]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export the dataset to shuffled TFRecord or WebDataset tar shards.',
+    )
+
+    parser.add_argument(
+        '--metadata',
+        dest='metadata_filepath',
+        default='metadata.json',
+        help='Default is \'metadata.json\'.',
+    )
+
+    parser.add_argument(
+        '--images',
+        dest='packed_image_filepath',
+        default='images.bin',
+        help=(
+            f'The packed images (\'images.bin\') or the serialized dataset '
+            f'({repr(SERIALIZED_DATASET_FILENAME)}). Default is \'images.bin\'.'
+        ),
+    )
+
+    parser.add_argument(
+        '--labels',
+        dest='labeling_filepath',
+        default='japanese-characters.txt',
+        help='Default is \'japanese-characters.txt\'.',
+    )
+
+    parser.add_argument(
+        '--format',
+        dest='shard_format',
+        choices=list(SHARD_FORMATS.keys()),
+        default='tfrecord',
+        help='Default is \'tfrecord\'.',
+    )
+
+    parser.add_argument(
+        '--num-shards',
+        dest='num_shards',
+        type=positive_int,
+        default=os.cpu_count() or 1,
+        help=(
+            'The minimum number of shards (more are written if the shards '
+            'would be larger than --max-shard-size). Default is the number of CPUs.'
+        ),
+    )
+
+    parser.add_argument(
+        '--max-shard-size',
+        dest='max_shard_size',
+        type=positive_int,
+        default=128,
+        help='The maximum size of the images in a shard (MB). Default is 128.',
+    )
+
+    parser.add_argument(
+        '--seed',
+        dest='seed',
+        type=int,
+        default=0,
+        help='The seed for shuffling the records. Default is 0.',
+    )
+
+    parser.add_argument(
+        '--workers',
+        dest='num_workers',
+        type=positive_int,
+        default=os.cpu_count() or 1,
+        help='Number of processes for writing the shards. Default is the number of CPUs.',
+    )
+
+    parser.add_argument(
+        '--out-dir',
+        dest='out_dir',
+        default=None,
+        help='Default is \'shards-<format>-<timestamp>\'.',
+    )
+
+    args = parser.parse_args()
+    print(args)
+
+    if not os.path.exists(args.packed_image_filepath):
+        raise Exception(args.packed_image_filepath + ' does not exist!')
+
+    out_dir = args.out_dir
+    if out_dir is None:
+        out_dir = f'shards-{args.shard_format}-{timestamp_to_datetime(time.time())}'
+
+    if os.path.exists(out_dir):
+        backup_file_by_modified_date(out_dir)
+
+    os.makedirs(out_dir)
+
+    label_list, label_to_index = load_labels(args.labeling_filepath)
+    records = load_dataset_metadata(args.metadata_filepath)['records']
+
+    labeled_records = [
+        {**record, 'label': label_to_index[record['char']]}
+        for record in records
+        if record['char'] in label_to_index
+    ]
+
+    num_unlabeled = len(records) - len(labeled_records)
+    if num_unlabeled > 0:
+        warn(f'Skipping {num_unlabeled} records whose characters are not in {args.labeling_filepath}!')
+
+    if len(labeled_records) == 0:
+        raise Exception('There are not any records to export!')
+
+    rng = np.random.RandomState(args.seed)
+    shuffled_records = [labeled_records[idx] for idx in rng.permutation(len(labeled_records))]
+    for sample_id, record in enumerate(shuffled_records):
+        record['sample_id'] = sample_id
+
+    shards = split_into_shards(shuffled_records, args.num_shards, args.max_shard_size * 1024 * 1024)
+
+    extension = SHARD_FORMATS[args.shard_format]
+    tasks = []
+    for shard_idx, shard_records in enumerate(shards):
+        shard_filename = f'shard-{shard_idx:05d}-of-{len(shards):05d}{extension}'
+        tasks.append((os.path.join(out_dir, shard_filename), args.shard_format, shard_records, args.packed_image_filepath))  # noqa
+
+    start_time = time.time()
+    with multiprocessing.Pool(args.num_workers) as pool:
+        shard_infos = list(tqdm(pool.imap(write_shard, tasks), total=len(tasks)))
+
+    labeling_content = open(args.labeling_filepath, mode='rb').read()
+
+    manifest = {
+        'format': args.shard_format,
+        'num_records': len(shuffled_records),
+        'num_labels': len(label_list),
+        'labeling_file': os.path.basename(args.labeling_filepath),
+        'labeling_file_sha256': hashlib.sha256(labeling_content).hexdigest(),
+        'image_shape': [IMAGE_SIZE, IMAGE_SIZE, 1],
+        'seed': args.seed,
+        'shards': shard_infos,
+    }
+
+    manifest_filepath = os.path.join(out_dir, SHARD_MANIFEST_FILENAME)
+    with open(manifest_filepath, mode='w', encoding='utf-8') as outfile:
+        json.dump(manifest, outfile, ensure_ascii=False, indent='\t')
+        outfile.write('\n')
+
+    total_size = sum(shard_info['size'] for shard_info in shard_infos)
+    info(f'Wrote {len(shuffled_records)} records to {len(shard_infos)} shards ({total_size / 1024 / 1024:.1f} MB) in {time.time() - start_time:.1f}s.')  # noqa
+    info(f'The manifest is saved in {repr(manifest_filepath)}.')
+
+
+if __name__ == '__main__':
+    main()
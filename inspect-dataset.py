@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 # encoding=utf-8
+import io
 import os
 import time
 import json
+import mmap
+import threading
 import collections
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Dict, List
 from datetime import datetime
 
@@ -16,6 +21,11 @@ import PIL.ImageTk
 
 import logger
 
+# the decoded thumbnails kept in memory (a few groups of duplicated images)
+MAX_CACHED_THUMBNAILS = 512
+THUMBNAIL_SIZE = 128
+NUM_COLUMNS = 10
+
 
 def logts(*args, **kwargs):
     """print() with timestamp"""
@@ -24,6 +34,66 @@ def logts(*args, **kwargs):
     print(*args, **kwargs)
 
 
+class ThumbnailLoader:
+    """
+    Decode the images of the records on demand from the memory-mapped
+    packed images and keep the most recently used thumbnails.
+    """
+
+    def __init__(self, packed_image_filepath: str, max_thumbnails=MAX_CACHED_THUMBNAILS):
+        self.packed_image_file = open(packed_image_filepath, mode='rb')
+        self.packed_images = mmap.mmap(self.packed_image_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.max_thumbnails = max_thumbnails
+        # by `(seek_start, seek_end)`
+        self.thumbnails: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+        # a single thread so only one group is prefetched at a time
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.prefetching: Future = None
+
+    def thumbnail(self, record: dict) -> PIL.Image.Image:
+        key = (record['seek_start'], record['seek_end'])
+
+        with self.lock:
+            if key in self.thumbnails:
+                self.thumbnails.move_to_end(key)
+                return self.thumbnails[key]
+
+        # decoded outside of the lock so the GUI doesn't wait for the prefetching
+        image_data = self.packed_images[record['seek_start']:record['seek_end']]
+        pil_image = PIL.Image.open(io.BytesIO(image_data))
+        pil_image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        pil_image.load()
+
+        with self.lock:
+            self.thumbnails[key] = pil_image
+            self.thumbnails.move_to_end(key)
+
+            while len(self.thumbnails) > self.max_thumbnails:
+                self.thumbnails.popitem(last=False)
+
+        return pil_image
+
+    def prefetch(self, records: List[dict]):
+        """Decode the thumbnails of the records in the background."""
+        # the previous group isn't needed anymore if it hasn't been started
+        if self.prefetching is not None:
+            self.prefetching.cancel()
+
+        def prefetch_records():
+            for record in records:
+                self.thumbnail(record)
+
+        self.prefetching = self.executor.submit(prefetch_records)
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.packed_images.close()
+        self.packed_image_file.close()
+
+
 def main():
     metadata_filepath = 'metadata.json'
     packed_image_filepath = 'images.bin'
@@ -57,24 +127,8 @@ def main():
         logger.warn('There are duplicated images in the dataset!')
         logger.info('Opening GUI to resolve duplicated images. Close the program when you are done.')
 
-        # === UNPACK IMAGES FOR INSPECTION === #
-        records_to_be_unpacked = []
-        for duplicated_entry in records_with_duplicated_image:
-            for record in duplicated_entry:
-                records_to_be_unpacked.append(record)
-
-        # sort records by seek position for efficient seeking to unpack the images
-        records_to_be_unpacked.sort(key=lambda record: record['seek_start'])
-
-        with open(packed_image_filepath, mode='rb') as infile:
-            for record in records_to_be_unpacked:
-                seek_start: int = record['seek_start']
-                seek_end: int = record['seek_end']
-                image_data_size = seek_end - seek_start
-
-                infile.seek(seek_start)
-                bs = infile.read(image_data_size)
-                record['image_bytes'] = bs # TODO high memory usage
+        # the images are decoded when their group is shown
+        thumbnail_loader = ThumbnailLoader(packed_image_filepath)
 
         app = tk.Tk()
         app.geometry('1600x900')
@@ -84,18 +138,55 @@ def main():
             values=hashes_with_duplicated_images,
         )
 
-        def render_duplicated_images():
-            pass
+        images_frame = ttk.Frame(app)
+        # Tk doesn't keep the images shown by the labels
+        shown_photo_images = []
+
+        def render_duplicated_images(group_idx: int):
+            for widget in images_frame.winfo_children():
+                widget.destroy()
+
+            shown_photo_images.clear()
+
+            for idx, record in enumerate(records_with_duplicated_image[group_idx]):
+                photo_image = PIL.ImageTk.PhotoImage(thumbnail_loader.thumbnail(record))
+                shown_photo_images.append(photo_image)
+
+                image_label = ttk.Label(
+                    images_frame,
+                    image=photo_image,
+                    text=f'{record["char"]}\n{record["font"]}',
+                    compound=tk.TOP,
+                )
+                image_label.grid(column=idx % NUM_COLUMNS, row=idx // NUM_COLUMNS, padx=4, pady=4)
+
+            # the next group is likely to be shown next
+            if group_idx + 1 < len(records_with_duplicated_image):
+                thumbnail_loader.prefetch(records_with_duplicated_image[group_idx + 1])
+
+        def select_group(group_idx: int):
+            if not (0 <= group_idx < len(records_with_duplicated_image)):
+                return
+
+            duplicated_entries_dropdown.current(group_idx)
+            logts(hashes_with_duplicated_images[group_idx])
+            render_duplicated_images(group_idx)
 
         def on_duplicated_entries_dropdown_value_selected(event: tk.Event):
-            selected_value = duplicated_entries_dropdown.get()
-            logts(selected_value)
+            select_group(duplicated_entries_dropdown.current())
 
-        duplicated_entries_dropdown.grid(column=0, row=0)
         duplicated_entries_dropdown.bind('<<ComboboxSelected>>', on_duplicated_entries_dropdown_value_selected)
-        duplicated_entries_dropdown.pack(fill=tk.X, expand=True)
+        duplicated_entries_dropdown.pack(fill=tk.X)
+        images_frame.pack(fill=tk.BOTH, expand=True)
+
+        # Page Down/Page Up for the next/previous group
+        app.bind('<Next>', lambda event: select_group(duplicated_entries_dropdown.current() + 1))
+        app.bind('<Prior>', lambda event: select_group(duplicated_entries_dropdown.current() - 1))
+
+        select_group(0)
 
         app.mainloop()
+        thumbnail_loader.close()
 
 
 if __name__ == '__main__':
@@ -1,16 +1,26 @@
 #!/usr/bin/env python3
 import os
+import io
 import sys
 import time
 import re
+import math
+import mmap
 import json
 import base64
+import struct
+import hashlib
 import argparse
+import itertools
 from typing import List, Dict, Iterable, Any
 import traceback
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, OrderedDict
 
 import tornado
-from tornado.ioloop import IOLoop
+import tornado.locks
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.web import Application, RequestHandler, StaticFileHandler
 import numpy as np
 
@@ -18,18 +28,652 @@ from argtypes import *
 from utils import *
 from logger import *
 from constants import *
+from serializable import *
+from review_journal import ReviewJournal, ReviewState, apply_review_action, find_review_changes, validate_review_action
+from embeddings import IVFPQIndex
+from pack_compaction import finish_compaction
+
+
+class LoadedDataset:
+    """
+    A dataset with the lookup tables that the handlers need so that
+    every request doesn't have to scan all the records.
+
+    Only the file sizes and the modified time are read when the dataset
+    is discovered. The metadata and the lookup tables are loaded on
+    first access (see `load` and `find_dataset`) and dropped again by
+    `unload` when the dataset is evicted and no request is using it (see
+    `DatasetHandler`).
+
+    - `record_by_hash` - the first record with the image hash (records
+    with duplicated images have the same hash)
+    - `record_ids_by_label` - indices in `metadata.records` by label
+    - `record_ids_by_font` - indices in `metadata.records` by font
+    - `anomaly_scores` - the scores of the records in
+    `anomaly-scores.npy` (see `anomaly_scores.py`) if it exists, the
+    records in `record_ids_by_label` are sorted by them (the most
+    suspicious first)
+    - `near_duplicate_clusters` - the records of each cluster in
+    `near-duplicates.json` (see `near_duplicates.py`) if it exists
+    - `cluster_id_by_record` - the cluster of each `(hash, font)`
+    - `embeddings` and `embedding_index` - the memory-mapped
+    `embeddings.npy` and the IVF-PQ index in `embedding-index.npz` (see
+    `embeddings.py`) if they exist, for `similar_records`
+    - `review_state` - `metadata.invalid_records`, `invalid_fonts` and
+    `completed_labels` as sets which `review` updates (they are copied
+    back to the metadata when it is saved)
+    - `review_changes` - the review actions that changed something since
+    the dataset was loaded so the clients only get what changed (see
+    `review_changes_since`)
+
+    The serialized dataset is memory-mapped (read-only) on first use
+    so reading a record is slicing a `memoryview` instead of opening,
+    seeking and reading the file for every request.
+
+    Review actions are appended to the dataset's review journal and
+    the metadata file is only rewritten when the journal is compacted
+    (see `compact`).
+
+    The blocking methods run in the thread pool (see `run_blocking`).
+    Loading, unloading, reviewing and compacting hold `lock` so the
+    writes to a dataset are serialized.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        path: str,
+        metadata_filepath: str,
+        serialized_dataset_filepath: str,
+    ):
+        self.name = name
+        self.path = path
+        self.metadata_filepath = metadata_filepath
+        self.serialized_dataset_filepath = serialized_dataset_filepath
+
+        metadata_stat = os.stat(metadata_filepath)
+        self.metadata_size = metadata_stat.st_size
+        self.serialized_dataset_size = os.path.getsize(serialized_dataset_filepath)
+        self.modified_time = metadata_stat.st_mtime
+
+        self.metadata: DatasetMetadata = None
+
+        # see `open_pack`
+        self.pack_file = None
+        self.pack_mmap = None
+        self.pack_view: memoryview = None
+        self.pack_lock = threading.Lock()
+
+        self.lock = tornado.locks.Lock()
+
+        # the requests that are using the dataset (see `DatasetHandler`),
+        # a dataset in use is never unloaded by `evict_datasets`
+        self.num_users = 0
+
+        # sprite atlases by (kind, key), see `get_atlas`
+        self.atlas_cache: OrderedDict = OrderedDict()
+
+        self.journal = ReviewJournal(os.path.join(path, REVIEW_JOURNAL_FILENAME))
+        self.num_journal_entries = 0
+
+        # see `review_changes_since`
+        self.review_epoch = 0
+        self.review_changes: List[tuple] = []
+        # the number of changes that have been dropped from the start
+        self.review_changes_offset = 0
+
+    @property
+    def is_loaded(self):
+        return self.metadata is not None
+
+    @property
+    def estimated_memory_size(self):
+        """A rough estimate of the memory used by the loaded metadata and indexes."""
+        return self.metadata_size * METADATA_MEMORY_FACTOR
+
+    def load(self):
+        if self.is_loaded:
+            return
+
+        start_time = time.time()
+
+        with open(self.metadata_filepath, mode='r', encoding='utf-8') as infile:
+            metadata = DatasetMetadata.parse_obj(json.load(infile))
+
+        review_state = ReviewState(metadata)
+
+        # pick up the reviews which haven't been compacted into the metadata
+        self.num_journal_entries = self.journal.replay(review_state)
+        if self.num_journal_entries > 0:
+            info(f'Replayed {self.num_journal_entries} review(s) of {self.name}.')
+
+        self.metadata = metadata
+        self.review_state = review_state
+        # the review cursors of the previous load are not valid anymore
+        self.review_epoch += 1
+        self.review_changes = []
+        self.review_changes_offset = 0
+        self.build_indexes()
+        self.load_anomaly_scores()
+        self.load_near_duplicates()
+        self.load_embeddings()
+
+        info(f'Loaded {self.name} in {time.time() - start_time:.3f}s.')
+
+    def unload(self):
+        if not self.is_loaded:
+            return
+
+        self.compact()
+        self.journal.close()
+        self.close_pack()
+        self.atlas_cache.clear()
+
+        self.metadata = None
+        self.review_state = None
+        self.record_by_hash = None
+        self.record_ids_by_label = None
+        self.record_ids_by_font = None
+        self.anomaly_scores = None
+        self.near_duplicate_clusters = None
+        self.cluster_id_by_record = None
+        self.record_id_by_hash = None
+        self.embeddings = None
+        self.embedding_index = None
+
+        info(f'Unloaded {self.name}.')
+
+    def build_indexes(self):
+        self.record_by_hash: Dict[str, dict] = {}
+        self.record_id_by_hash: Dict[str, int] = {}
+        self.record_ids_by_label: Dict[str, List[int]] = defaultdict(list)
+        self.record_ids_by_font: Dict[str, List[int]] = defaultdict(list)
+
+        for record_id, record in enumerate(self.metadata.records):
+            self.record_by_hash.setdefault(record['hash'], record)
+            self.record_id_by_hash.setdefault(record['hash'], record_id)
+            self.record_ids_by_label[record['char']].append(record_id)
+            self.record_ids_by_font[record['font']].append(record_id)
+
+    def load_anomaly_scores(self):
+        self.anomaly_scores: np.ndarray = None
+
+        anomaly_scores_filepath = os.path.join(self.path, ANOMALY_SCORES_FILENAME)
+        if not os.path.exists(anomaly_scores_filepath):
+            return
+
+        anomaly_scores = np.load(anomaly_scores_filepath)
+        if len(anomaly_scores) != len(self.metadata.records):
+            warn(f'Ignoring {anomaly_scores_filepath} because it doesn\'t have a score for every record!')
+            return
+
+        self.anomaly_scores = anomaly_scores
+
+        # the most suspicious records first
+        for label, record_ids in self.record_ids_by_label.items():
+            record_ids = np.array(record_ids)
+            order = np.argsort(-anomaly_scores[record_ids], kind='stable')
+            self.record_ids_by_label[label] = record_ids[order].tolist()
+
+    def anomaly_scores_of_label(self, label: str, start=0, stop=None) -> List[float]:
+        """The scores of `records_of_label` or `None` if there are no scores."""
+        if self.anomaly_scores is None:
+            return None
+
+        record_ids = self.record_ids_by_label.get(label, [])[start:stop]
+        return self.anomaly_scores[record_ids].tolist()
+
+    def load_near_duplicates(self):
+        self.near_duplicate_clusters: List[List[dict]] = []
+        self.cluster_id_by_record: Dict[tuple, int] = {}
+
+        near_duplicates_filepath = os.path.join(self.path, NEAR_DUPLICATES_FILENAME)
+        if not os.path.exists(near_duplicates_filepath):
+            return
+
+        with open(near_duplicates_filepath, mode='r', encoding='utf-8') as infile:
+            clusters = json.load(infile)['clusters']
+
+        for cluster_id, cluster in enumerate(clusters):
+            for record in cluster['records']:
+                self.cluster_id_by_record[(record['hash'], record['font'])] = cluster_id
+
+            self.near_duplicate_clusters.append([])
+
+        # the records may have been created again since the clusters were found
+        for record in self.metadata.records:
+            cluster_id = self.cluster_id_by_record.get((record['hash'], record['font']))
+            if cluster_id is not None:
+                self.near_duplicate_clusters[cluster_id].append(record)
+
+    def load_embeddings(self):
+        self.embeddings: np.ndarray = None
+        self.embedding_index: IVFPQIndex = None
+
+        embeddings_filepath = os.path.join(self.path, EMBEDDINGS_FILENAME)
+        index_filepath = os.path.join(self.path, EMBEDDING_INDEX_FILENAME)
+        if not os.path.exists(embeddings_filepath) or not os.path.exists(index_filepath):
+            return
+
+        # only the pages of the re-ranked candidates are read
+        embeddings = np.load(embeddings_filepath, mmap_mode='r')
+        embedding_index = IVFPQIndex.load(index_filepath)
+        if len(embeddings) != len(self.metadata.records) or len(embedding_index) != len(embeddings):
+            warn(f'Ignoring {embeddings_filepath} because it doesn\'t have an embedding for every record!')
+            return
+
+        self.embeddings = embeddings
+        self.embedding_index = embedding_index
+
+    def similar_records(self, hash: str, k: int, nprobe: int) -> List[tuple]:
+        """
+        Return the `k` records (and their distances) which look the most
+        like the record with the hash, the record itself first. The
+        result is empty if there are no embeddings.
+        """
+        record_id = self.record_id_by_hash.get(hash)
+        if self.embedding_index is None or record_id is None:
+            return []
+
+        record_ids, distances = self.embedding_index.search(
+            self.embeddings[record_id],
+            k,
+            nprobe=nprobe,
+            embeddings=self.embeddings,
+        )
+
+        records = self.metadata.records
+        similar_records = [(records[record_id], 0.0)]
+        for similar_record_id, distance in zip(record_ids.tolist(), distances.tolist()):
+            if similar_record_id != record_id:
+                similar_records.append((records[similar_record_id], distance))
+
+        return similar_records[:k]
+
+    def find_cluster(self, record: dict):
+        """Return the id of the near-duplicate cluster of the record or `None`."""
+        return self.cluster_id_by_record.get((record['hash'], record['font']))
+
+    def find_record(self, hash: str) -> dict:
+        return self.record_by_hash.get(hash)
+
+    def records_of_label(self, label: str, start=0, stop=None) -> List[dict]:
+        records = self.metadata.records
+        record_ids = self.record_ids_by_label.get(label, [])
+        return [records[record_id] for record_id in record_ids[start:stop]]
+
+    def count_records_of_label(self, label: str) -> int:
+        return len(self.record_ids_by_label.get(label, []))
+
+    def records_of_font(self, font: str) -> List[dict]:
+        records = self.metadata.records
+        return [records[record_id] for record_id in self.record_ids_by_font.get(font, [])]
+
+    def open_pack(self):
+        if self.pack_view is not None:
+            return
+
+        # the records may be read by several threads at the same time
+        with self.pack_lock:
+            if self.pack_view is not None:
+                return
+
+            self.pack_file = open(self.serialized_dataset_filepath, mode='rb')
+            self.pack_mmap = mmap.mmap(self.pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.pack_view = memoryview(self.pack_mmap)
+
+    def close_pack(self):
+        if self.pack_view is None:
+            return
+
+        # the mmap cannot be closed while there are exported views
+        self.pack_view.release()
+        self.pack_mmap.close()
+        self.pack_file.close()
+
+        self.pack_file = None
+        self.pack_mmap = None
+        self.pack_view = None
+
+    def record_data(self, record: dict) -> memoryview:
+        """Return the serialized record as a zero-copy slice of the pack."""
+        self.open_pack()
+        return self.pack_view[record['seek_start']:record['seek_end']]
+
+    async def review(self, actions: List[tuple]) -> int:
+        async with self.lock:
+            return await run_blocking(self.apply_reviews, actions)
+
+    def apply_reviews(self, actions: List[tuple]) -> int:
+        """
+        Apply a list of `(action, value)` (see
+        `review_journal.REVIEW_ACTIONS`) and append the ones that changed
+        something to the journal in a single write. Nothing is applied if
+        any of the actions is invalid or the journal cannot be written.
+        Return the number of changes.
+        """
+        changed_actions = find_review_changes(self.review_state, actions)
+
+        if len(changed_actions) == 0:
+            return 0
+
+        # the review state is only changed once the changes are in the
+        # journal so a failed write doesn't reach the metadata either
+        if len(changed_actions) == 1:
+            self.journal.append(*changed_actions[0])
+        else:
+            self.journal.append_batch(changed_actions)
+
+        for action, value in changed_actions:
+            apply_review_action(self.review_state, action, value)
+
+        self.num_journal_entries += len(changed_actions)
+
+        self.review_changes.extend(changed_actions)
+        if len(self.review_changes) > MAX_REVIEW_CHANGES:
+            num_dropped = len(self.review_changes) - MAX_REVIEW_CHANGES // 2
+            self.review_changes = self.review_changes[num_dropped:]
+            self.review_changes_offset += num_dropped
+
+        if self.num_journal_entries >= JOURNAL_COMPACTION_THRESHOLD:
+            self.compact()
+
+        return len(changed_actions)
+
+    @property
+    def review_cursor(self) -> str:
+        return f'{self.review_epoch}-{self.review_changes_offset + len(self.review_changes)}'
+
+    def review_changes_since(self, cursor: str):
+        """
+        Return the `(action, value)` applied after the `review_cursor`
+        was `cursor` or `None` if they are not known anymore (the dataset
+        has been reloaded or the changes have been dropped) and the
+        review lists have to be requested again.
+        """
+        epoch, _, position = cursor.partition('-')
+
+        if epoch != str(self.review_epoch) or not position.isdigit():
+            return None
+
+        start = int(position) - self.review_changes_offset
+        if start < 0 or start > len(self.review_changes):
+            return None
+
+        return self.review_changes[start:]
+
+    def compact(self):
+        """Save the metadata and empty the journal."""
+        if not self.is_loaded or self.num_journal_entries == 0:
+            return
+
+        # replaying is idempotent so crashing before the journal is
+        # cleared doesn't lose or corrupt anything
+        self.review_state.to_metadata(self.metadata)
+        save_metadata(self.metadata, self.metadata_filepath)
+        self.journal.clear()
+        self.num_journal_entries = 0
+
+    def atlas_records(self, kind: str, key: str) -> List[dict]:
+        if kind == 'label':
+            # the most suspicious records first
+            if self.anomaly_scores is not None:
+                return self.records_of_label(key)
+
+            # group the glyphs of the same font design together
+            return sorted(self.records_of_label(key), key=lambda record: record['font'])
+        elif kind == 'cluster':
+            if not key.isdigit() or int(key) >= len(self.near_duplicate_clusters):
+                return []
+
+            return self.near_duplicate_clusters[int(key)]
+        elif kind == 'similar':
+            return [record for record, _ in self.similar_records(key, SIMILAR_RECORDS_COUNT, SIMILAR_RECORDS_NPROBE)]
+        else:
+            return self.records_of_font(key)
+
+    async def find_atlas_records(self, kind: str, key: str) -> List[dict]:
+        """Like `atlas_records` but the similarity search runs in the thread pool."""
+        if kind == 'similar':
+            return await run_blocking(self.atlas_records, kind, key)
+
+        return self.atlas_records(kind, key)
+
+    def cached_atlas(self, kind: str, key: str):
+        """Return the cached atlas or `None`."""
+        cache_key = (kind, key)
+        if cache_key not in self.atlas_cache:
+            return None
+
+        self.atlas_cache.move_to_end(cache_key)
+        return self.atlas_cache[cache_key]
+
+    async def get_atlas(self, kind: str, key: str, records: List[dict] = None):
+        """
+        Return the cached sprite atlas of a label, a font, a
+        near-duplicate cluster or the records similar to a record (`kind`
+        is `'label'`, `'font'`, `'cluster'` or `'similar'`) or `None` if
+        it doesn't have any records. Pass the `records` if they have
+        already been found (see `find_atlas_records`).
+        The atlases only depend on the records so the reviews don't
+        invalidate them.
+        """
+        atlas = self.cached_atlas(kind, key)
+        if atlas is not None:
+            return atlas
+
+        if records is None:
+            records = await self.find_atlas_records(kind, key)
+
+        if len(records) == 0:
+            return None
+
+        atlas = await run_blocking(build_atlas, self, records)
+
+        self.atlas_cache[(kind, key)] = atlas
+        while len(self.atlas_cache) > MAX_CACHED_ATLASES:
+            self.atlas_cache.popitem(last=False)
+
+        return atlas
+
+
+# the metadata takes several times its file size once parsed
+METADATA_MEMORY_FACTOR = 8
+# in bytes, set by `--memory-budget`
+memory_budget = 1024 * 1024 * 1024
+
+# for the blocking work of the handlers, set by `--threads`
+executor: ThreadPoolExecutor = None
+
+
+def run_blocking(fn, *args):
+    """Run `fn` in the thread pool so it doesn't block the event loop."""
+    return IOLoop.current().run_in_executor(executor, fn, *args)
+
+
+async def write_json(handler: RequestHandler, obj):
+    """Like `handler.write(obj)` but the (large) object is encoded in the thread pool."""
+    body = await run_blocking(tornado.escape.json_encode, obj)
+    handler.set_header('Content-Type', 'application/json; charset=UTF-8')
+    handler.write(body)
+
+
+# the number of list items which are encoded and flushed at once
+STREAM_PAGE_SIZE = 1000
+
+
+def encode_json_items(items: list) -> str:
+    """Encode a list without the brackets."""
+    return tornado.escape.json_encode(items)[1:-1]
+
+
+async def stream_json_value(handler: RequestHandler, value):
+    if isinstance(value, dict):
+        handler.write('{')
+        for idx, (key, item) in enumerate(value.items()):
+            if idx > 0:
+                handler.write(',')
+
+            handler.write(tornado.escape.json_encode(key) + ':')
+            await stream_json_value(handler, item)
+
+        handler.write('}')
+
+    elif isinstance(value, list) and len(value) > STREAM_PAGE_SIZE:
+        handler.write('[')
+        for start in range(0, len(value), STREAM_PAGE_SIZE):
+            if start > 0:
+                handler.write(',')
+
+            page = value[start:start + STREAM_PAGE_SIZE]
+            handler.write(await run_blocking(encode_json_items, page))
+            await handler.flush()
+
+        handler.write(']')
+
+    else:
+        handler.write(tornado.escape.json_encode(value))
+
+
+async def stream_json(handler: RequestHandler, obj: dict):
+    """
+    Like `write_json` but the large lists are encoded and sent (chunked)
+    page by page so the whole body is never built in memory.
+    """
+    handler.set_header('Content-Type', 'application/json; charset=UTF-8')
+    await stream_json_value(handler, obj)
+
+
+def parse_page_arguments(handler: RequestHandler):
+    """
+    Return the `cursor` (the index of the first item) and the `limit`
+    (`None` for no limit) query arguments or raise `ValueError`.
+    """
+    cursor = int(handler.get_query_argument('cursor', '0'))
+    limit = handler.get_query_argument('limit', None)
+
+    if limit is not None:
+        limit = int(limit)
+
+    if cursor < 0 or (limit is not None and limit < 0):
+        raise ValueError('The cursor and the limit must not be negative!')
+
+    return cursor, limit
+
+
+def next_cursor(cursor: int, limit: int, total: int):
+    """Return the cursor of the next page or `None` if this is the last page."""
+    if limit is None or cursor + limit >= total:
+        return None
+
+    return str(cursor + limit)
+
+
+def bad_page_arguments(handler: RequestHandler, ex: Exception):
+    handler.clear()
+    handler.set_status(400)  # Bad Request
+    handler.write({'message': f'Invalid cursor or limit: {ex}'})
+
+
+# all the discovered datasets
+datasets: Dict[str, LoadedDataset] = {}
+# the loaded datasets, the least recently used first
+loaded_datasets: OrderedDict = OrderedDict()
+
+
+async def find_dataset(name: str) -> LoadedDataset:
+    """
+    Return the loaded dataset or `None` if it doesn't exist or cannot be
+    loaded. The handlers use `DatasetHandler.find_dataset` which pins the
+    dataset while the request is using it.
+    """
+    dataset = datasets.get(name)
+
+    if dataset is None:
+        return None
 
+    if name in loaded_datasets:
+        loaded_datasets.move_to_end(name)
+        return dataset
 
-datasets: List[Dataset] = []
-images_cache: List[Dict[str, str]] = []
+    try:
+        # wait for the concurrent load or unload of the same dataset
+        async with dataset.lock:
+            await run_blocking(dataset.load)
+    except Exception as ex:
+        error(f'Cannot load {name}: {repr(ex)}')
+        traceback.print_exc()
+        return None
+
+    loaded_datasets[name] = dataset
+    await evict_datasets()
+
+    return dataset
 
 
-def find_dataset(name: str) -> Dataset:
-    for dataset in datasets:
-        if name == dataset.name:
-            return dataset
+async def evict_datasets():
+    """
+    Unload the least recently used datasets until they fit in the memory
+    budget. The datasets that are in use are skipped (the budget may be
+    exceeded until they are released).
+    """
+    total_size = sum(dataset.estimated_memory_size for dataset in loaded_datasets.values())
+
+    # always keep the one that has just been used
+    for name in list(loaded_datasets.keys())[:-1]:
+        if total_size <= memory_budget:
+            break
+
+        dataset = loaded_datasets.get(name)
+        # it may have been evicted or pinned while we were unloading the others
+        if dataset is None or dataset.num_users > 0:
+            continue
+
+        del loaded_datasets[name]
+        total_size -= dataset.estimated_memory_size
 
-    return None
+        async with dataset.lock:
+            # it may have been loaded again (or be about to be) while we were waiting
+            if name not in loaded_datasets and dataset.num_users == 0:
+                await run_blocking(dataset.unload)
+
+
+def discover_datasets(datasets_dir: str) -> Dict[str, LoadedDataset]:
+    """Find the datasets without loading them."""
+    discovered_datasets = {}
+
+    for name in sorted(os.listdir(datasets_dir)):
+        dataset_dir = os.path.join(datasets_dir, name)
+        if not os.path.isdir(dataset_dir):
+            continue
+
+        try:
+            # an interrupted compaction leaves the pack and the metadata
+            # out of sync until it is finished
+            if finish_compaction(dataset_dir):
+                info(f'Finished the interrupted compaction of {name}.')
+
+            metadata_filepath = os.path.join(dataset_dir, METADATA_FILENAME)
+            if not os.path.exists(metadata_filepath):
+                raise Exception(f'{metadata_filepath} does not exist!')
+
+            serialized_dataset_filepath = os.path.join(dataset_dir, SERIALIZED_DATASET_FILENAME)  # noqa
+            if not os.path.exists(serialized_dataset_filepath):
+                raise Exception(f'{serialized_dataset_filepath} does not exist!')  # noqa
+
+            discovered_datasets[name] = LoadedDataset(
+                name=name,
+                path=dataset_dir,
+                metadata_filepath=metadata_filepath,
+                serialized_dataset_filepath=serialized_dataset_filepath,
+            )
+
+        except Exception as ex:
+            error(repr(ex))
+            warn(f'Skipping {name}!')
+            continue
+
+    return discovered_datasets
 
 
 def dataset_not_found(handler: RequestHandler, name: str):
@@ -40,6 +684,49 @@ def dataset_not_found(handler: RequestHandler, name: str):
     })
 
 
+class DatasetHandler(RequestHandler):
+    """
+    Base handler for the requests that use a dataset. The dataset found
+    by `find_dataset` is pinned until the request is finished so it is
+    not unloaded while the handler is still using it across an `await`
+    (e.g. while the images are read in the thread pool).
+    """
+
+    pinned_dataset: LoadedDataset = None
+
+    async def find_dataset(self, name: str) -> LoadedDataset:
+        dataset = datasets.get(name)
+
+        # pinned before waiting for the load so an eviction in between
+        # cannot unload it
+        if dataset is not None and self.pinned_dataset is None:
+            dataset.num_users += 1
+            self.pinned_dataset = dataset
+
+        return await find_dataset(name)
+
+    def on_finish(self):
+        if self.pinned_dataset is None:
+            return
+
+        self.pinned_dataset.num_users -= 1
+        # it may have been skipped by the eviction while it was in use
+        if self.pinned_dataset.num_users == 0:
+            IOLoop.current().spawn_callback(evict_datasets)
+
+        self.pinned_dataset = None
+
+
+async def compact_journals():
+    for dataset in list(loaded_datasets.values()):
+        try:
+            async with dataset.lock:
+                await run_blocking(dataset.compact)
+        except Exception as ex:
+            error(f'Cannot compact the review journal of {dataset.name}: {repr(ex)}')
+            traceback.print_exc()
+
+
 def save_metadata(metadata: DatasetMetadata, fpath: str):
     if os.path.exists(fpath):
         backup_file_by_modified_date(fpath)
@@ -48,9 +735,107 @@ def save_metadata(metadata: DatasetMetadata, fpath: str):
         universal_dump(metadata.__dict__, outfile)
 
 
+def decode_png_image(bs) -> bytes:
+    """Get the PNG data out of a serialized record (see `XFormat`)."""
+    record_datatype = bs[0]
+    # `XFormat` expects `bytes`, this is the only copy of the record
+    record = XFormat.deserialze_obj(bytes(bs[5:]), record_datatype)
+    return record['PNG_IMAGE']
+
+
+def read_png_images(dataset: LoadedDataset, records: List[dict]) -> Dict[str, bytes]:
+    """
+    Read the PNG data of the records in file order so the page cache
+    reads ahead instead of jumping back and forth in the pack.
+    """
+    png_images = {}
+    sorted_records = sorted(records, key=lambda record: record['seek_start'])
+
+    for record in sorted_records:
+        png_images[record['hash']] = decode_png_image(dataset.record_data(record))
+
+    return png_images
+
+
+def read_base64_images(dataset: LoadedDataset, records: List[dict]) -> Dict[str, str]:
+    png_images = read_png_images(dataset, records)
+    return {
+        record_hash: base64.encodebytes(png_image).decode('utf-8')
+        for record_hash, png_image in png_images.items()
+    }
+
+
+MAX_CACHED_ATLASES = 32
+
+# the number of similar records (and inverted lists to scan) by default
+SIMILAR_RECORDS_COUNT = 100
+SIMILAR_RECORDS_NPROBE = 8
+MAX_SIMILAR_RECORDS = 1000
+
+# the review changes kept for `LoadedDataset.review_changes_since`
+MAX_REVIEW_CHANGES = 10000
+
+# rewrite the metadata after this many reviews or this often (ms)
+JOURNAL_COMPACTION_THRESHOLD = 1000
+JOURNAL_COMPACTION_INTERVAL = 5 * 60 * 1000
+
+
+class Atlas:
+    """
+    Sprite atlas of records. Tile `i` is at column `i % columns` and row
+    `i // columns`.
+    """
+
+    def __init__(self, records: List[dict], png_image: bytes, columns: int, tile_width: int, tile_height: int):
+        self.records = records
+        self.png_image = png_image
+        self.columns = columns
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.digest = atlas_digest(records)
+
+
+def atlas_digest(records: List[dict]) -> str:
+    # the atlas content only depends on the record images
+    return hashlib.md5(''.join(record['hash'] for record in records).encode('ascii')).hexdigest()
+
+
+def compose_montage(tiles: np.ndarray, columns: int) -> np.ndarray:
+    """Arrange `(N, height, width)` tiles into a grid with `columns` columns."""
+    num_tiles, tile_height, tile_width = tiles.shape
+    rows = math.ceil(num_tiles / columns)
+
+    grid = np.zeros((rows * columns, tile_height, tile_width), dtype=tiles.dtype)
+    grid[:num_tiles] = tiles
+
+    # (rows, columns, height, width) -> (rows, height, columns, width)
+    grid = grid.reshape(rows, columns, tile_height, tile_width).transpose(0, 2, 1, 3)
+    return grid.reshape(rows * tile_height, columns * tile_width)
+
+
+def build_atlas(dataset: LoadedDataset, records: List[dict]) -> Atlas:
+    png_images = read_png_images(dataset, records)
+
+    tiles = np.zeros((len(records), IMAGE_SIZE, IMAGE_SIZE), dtype=np.uint8)
+    for idx, record in enumerate(records):
+        pil_image = Image.open(io.BytesIO(png_images[record['hash']])).convert('L')
+        np_image = np.asarray(pil_image, dtype=np.uint8)
+        height = min(IMAGE_SIZE, np_image.shape[0])
+        width = min(IMAGE_SIZE, np_image.shape[1])
+        tiles[idx, :height, :width] = np_image[:height, :width]
+
+    columns = math.ceil(math.sqrt(len(records)))
+    montage = compose_montage(tiles, columns)
+
+    buffer = io.BytesIO()
+    Image.fromarray(montage).save(buffer, format='PNG')
+
+    return Atlas(records, buffer.getvalue(), columns, IMAGE_SIZE, IMAGE_SIZE)
+
+
 class ListAvailableDatasets(RequestHandler):
     def get(self):
-        dataset_names: List[str] = list(map(lambda dataset: dataset.name, datasets))  # noqa
+        dataset_names: List[str] = list(datasets.keys())
         # put dataset with name starts with alphabet first because when
         # we create multiple datasets with the same source, they will be
         # backup by appending modified time (Unix time) as prefix
@@ -61,81 +846,196 @@ class ListAvailableDatasets(RequestHandler):
         response_list = []
         response_list.extend(latest_datasets)
         response_list.extend(remain_datasets)
-        self.write({'datasets': response_list})
 
+        dataset_details = []
+        for name in response_list:
+            dataset = datasets[name]
+            dataset_details.append({
+                'name': name,
+                'metadata_size': dataset.metadata_size,
+                'serialized_dataset_size': dataset.serialized_dataset_size,
+                'modified_time': dataset.modified_time,
+                'loaded': dataset.is_loaded,
+            })
+
+        self.write({
+            'datasets': response_list,
+            'details': dataset_details,
+        })
+
+
+class GetDatasetInfo(DatasetHandler):
+    """
+    The metadata of a dataset (without the records).
+
+    - `?list=<name>&cursor=<cursor>&limit=<limit>` - a page of one of the
+    lists (`labels`, `invalid_records`, `invalid_fonts` or
+    `completed_labels`)
+    - `?limit=<limit>` - only the first page of every list with the
+    `totals` and the `next_cursors` to request the next pages with
+    `?list=<name>`
+    - `?changes_since=<review_cursor>` - the review actions that changed
+    the review lists since the `review_cursor` of a previous response,
+    `changes` is `null` if the lists have to be requested again
+
+    The response is streamed page by page.
+    """
+
+    LISTS = ('labels', 'invalid_records', 'invalid_fonts', 'completed_labels')
 
-class GetDatasetInfo(RequestHandler):
-    def get(self, name: str):
+    def list_page(self, dataset: LoadedDataset, list_name: str, cursor: int, limit: int):
+        """Return the items from `cursor` (at most `limit`), the total and the next cursor."""
+        stop = None if limit is None else cursor + limit
+
+        if list_name == 'labels':
+            items = dataset.metadata.labels
+            page = items[cursor:stop]
+        else:
+            # the review lists are sets, only the page is copied
+            items = getattr(dataset.review_state, list_name)
+            page = list(itertools.islice(items, cursor, stop))
+
+        return page, len(items), next_cursor(cursor, limit, len(items))
+
+    async def get(self, name: str):
         debug(f'Dataset name: {repr(name)}')
 
-        dataset = find_dataset(name)
+        try:
+            cursor, limit = parse_page_arguments(self)
+        except ValueError as ex:
+            bad_page_arguments(self, ex)
+            return
+
+        list_name = self.get_query_argument('list', None)
+        changes_since = self.get_query_argument('changes_since', None)
+
+        if list_name is not None and list_name not in self.LISTS:
+            self.clear()
+            self.set_status(400)
+            self.write({'message': f'Unknown list {repr(list_name)}!'})
+            return
+
+        dataset = await self.find_dataset(name)
 
         if dataset is None:
             dataset_not_found(self, name)
             return
 
-        self.write({
+        if changes_since is not None:
+            # the changes may be dropped while a review is applied
+            async with dataset.lock:
+                changes = dataset.review_changes_since(changes_since)
+                review_cursor = dataset.review_cursor
+
+            self.write({
+                'name': dataset.name,
+                'changes': None if changes is None else [list(change) for change in changes],
+                'review_cursor': review_cursor,
+            })
+            return
+
+        if list_name is not None:
+            # the review lists must not change while they are copied
+            async with dataset.lock:
+                items, total, list_next_cursor = self.list_page(dataset, list_name, cursor, limit)
+                review_cursor = dataset.review_cursor
+
+            await stream_json(self, {
+                'name': dataset.name,
+                'list': list_name,
+                'total': total,
+                'items': items,
+                'next_cursor': list_next_cursor,
+                'review_cursor': review_cursor,
+            })
+            return
+
+        metadata = {
+            'source': dataset.metadata.source,
+            'content': dataset.metadata.content,
+        }
+        totals = {}
+        next_cursors = {}
+
+        async with dataset.lock:
+            for list_name in self.LISTS:
+                metadata[list_name], totals[list_name], next_cursors[list_name] = self.list_page(dataset, list_name, 0, limit)  # noqa
+
+            review_cursor = dataset.review_cursor
+
+        await stream_json(self, {
             'name': dataset.name,
-            'metadata': {
-                'source': dataset.metadata.source,
-                'content': dataset.metadata.content,
-                'labels': dataset.metadata.labels,
-                'invalid_records': dataset.metadata.invalid_records,
-                'invalid_fonts': dataset.metadata.invalid_fonts,
-                'completed_labels': dataset.metadata.completed_labels,
-            },
+            'metadata': metadata,
+            'totals': totals,
+            'next_cursors': next_cursors,
+            'total_labels': totals['labels'],
+            'next_cursor': next_cursors['labels'],
+            'review_cursor': review_cursor,
+            'has_embeddings': dataset.embedding_index is not None,
         })
 
 
-class GetLabelInfo(RequestHandler):
-    def get(self, name: str, label: str):
+class GetLabelInfo(DatasetHandler):
+    """
+    The records of a label (the most suspicious first if there are
+    anomaly scores). Use `?cursor=<cursor>&limit=<limit>` to get a page
+    of the records. The response is streamed page by page.
+    """
+
+    async def get(self, name: str, label: str):
 
         debug(f'Getting info for {repr(label)} in {repr(name)}')
 
-        dataset = find_dataset(name)
+        try:
+            cursor, limit = parse_page_arguments(self)
+        except ValueError as ex:
+            bad_page_arguments(self, ex)
+            return
+
+        dataset = await self.find_dataset(name)
 
         if dataset is None:
             dataset_not_found(self, name)
             return
 
-        records = []
-        for record in dataset.metadata.records:
-            if record['char'] == label:
-                records.append(record)
+        stop = None if limit is None else cursor + limit
+        records = dataset.records_of_label(label, cursor, stop)
+        anomaly_scores = dataset.anomaly_scores_of_label(label, cursor, stop)
+        total = dataset.count_records_of_label(label)
 
-        self.write({
+        await stream_json(self, {
             'dataset': name,
             'label': label,
+            'total': total,
             'records': records,
+            'anomaly_scores': anomaly_scores,
+            'next_cursor': next_cursor(cursor, limit, total),
         })
 
 
-class MarkRecordAsInvalid(RequestHandler):
+class MarkRecordAsInvalid(DatasetHandler):
     """Mark a record as invalid by its hash id."""
 
-    def get(self, name: str, hash: str):
+    async def get(self, name: str, hash: str):
 
         info(f'Marking {hash} in {name} as invalid!')
 
-        dataset = find_dataset(name)
+        dataset = await self.find_dataset(name)
 
         if dataset is None:
             dataset_not_found(self, name)
             return
 
-        metadata = dataset.metadata
-        records = metadata.records
+        record = dataset.find_record(hash)
 
-        for record in records:
-            if record['hash'] == hash:
-                metadata.invalid_records.append(hash)
-                save_metadata(metadata, dataset.metadata_filepath)
+        if record is not None:
+            await dataset.review([('invalid_record', hash)])
 
-                self.write({
-                    'record': record,
-                })
+            self.write({
+                'record': record,
+            })
 
-                return
+            return
 
         self.clear()
         self.set_status(404)
@@ -144,132 +1044,173 @@ class MarkRecordAsInvalid(RequestHandler):
         })
 
 
-class MarkRecordAsValid(RequestHandler):
+class MarkRecordAsValid(DatasetHandler):
 
-    def get(self, name: str, hash: str):
-        dataset = find_dataset(name)
+    async def get(self, name: str, hash: str):
+        dataset = await self.find_dataset(name)
 
         if dataset is None:
             dataset_not_found(self, name)
             return
 
-        metadata = dataset.metadata
-        invalid_records = metadata.invalid_records
-        metadata.invalid_records = list(filter(lambda x: x != hash, invalid_records))  # noqa
-        save_metadata(metadata, dataset.metadata_filepath)
+        await dataset.review([('valid_record', hash)])
 
         self.write({
             'message': f'Marked {repr(hash)} as valid record.',
         })
 
 
-class MarkFontAsInvalid(RequestHandler):
+class MarkFontAsInvalid(DatasetHandler):
 
-    def get(self, name: str, font: str):
-        dataset = find_dataset(name)
+    async def get(self, name: str, font: str):
+        dataset = await self.find_dataset(name)
 
         if dataset is None:
             dataset_not_found(self, name)
             return
 
-        metadata = dataset.metadata
-        if font not in metadata.invalid_fonts:
-            metadata.invalid_fonts.append(font)
-            save_metadata(metadata, dataset.metadata_filepath)
+        await dataset.review([('invalid_font', font)])
 
         self.write({
             'message': f'Marked {font} as invalid.',
         })
 
 
-class MarkFontAsValid(RequestHandler):
+class MarkFontAsValid(DatasetHandler):
 
-    def get(self, name: str, font: str):
-        dataset = find_dataset(name)
+    async def get(self, name: str, font: str):
+        dataset = await self.find_dataset(name)
 
         if dataset is None:
             dataset_not_found(self, name)
             return
 
-        metadata = dataset.metadata
-        invalid_fonts = metadata.invalid_fonts
-        metadata.invalid_fonts = list(filter(lambda x: x != font, invalid_fonts))  # noqa
-        save_metadata(metadata, dataset.metadata_filepath)
+        await dataset.review([('valid_font', font)])
 
         self.write({
             'message': f'Marked {font} as valid.',
         })
 
 
-class MarkLabelAsCompleted(RequestHandler):
+class MarkLabelAsCompleted(DatasetHandler):
 
-    def get(self, name: str, label: str):
-        dataset = find_dataset(name)
+    async def get(self, name: str, label: str):
+        dataset = await self.find_dataset(name)
 
         if dataset is None:
             dataset_not_found(self, name)
             return
 
-        metadata = dataset.metadata
-        if label not in metadata.completed_labels:
-            metadata.completed_labels.append(label)
-            save_metadata(metadata, dataset.metadata_filepath)
+        await dataset.review([('complete_label', label)])
 
         self.write({
             'message': f'Marked label {repr(label)} as done.',
         })
 
 
-class MarkLabelAsIncompleted(RequestHandler):
+class MarkLabelAsIncompleted(DatasetHandler):
 
-    def get(self, name: str, label: str):
-        dataset = find_dataset(name)
+    async def get(self, name: str, label: str):
+        dataset = await self.find_dataset(name)
 
         if dataset is None:
             dataset_not_found(self, name)
             return
 
-        metadata = dataset.metadata
-        completed_labels = metadata.completed_labels
-        metadata.completed_labels = list(filter(lambda x: x != label, completed_labels))  # noqa
-        save_metadata(metadata, dataset.metadata_filepath)
+        await dataset.review([('incomplete_label', label)])
 
         self.write({
             'messsage': f'Marked label {repr(label)} as not fully inspected.',
         })
 
 
-class GetImageByHash(RequestHandler):
-    """Pull out a single image from TFRecord file."""
+class ReviewDataset(DatasetHandler):
+    """
+    Apply a batch of review actions at once. The body is a JSON list of
+    `{"action": ..., "value": ...}` where the action is one of
+    `review_journal.REVIEW_ACTIONS`. Either all or none of the actions
+    are applied.
+    """
 
-    def get(self, name: str, hash: str):
+    def notify_bad_request(self, message: str):
+        self.clear()
+        self.set_status(400)  # Bad Request
+        self.write({'message': message})
 
-        dataset = find_dataset(name)
+    async def post(self, name: str):
+        try:
+            data = tornado.escape.json_decode(self.request.body)
+        except Exception as ex:
+            error(ex)
+            self.notify_bad_request('Body data is not valid JSON data!')
+            return
+
+        if not isinstance(data, list):
+            self.notify_bad_request('Body data is not a list!')
+            return
+
+        actions = []
+        for o in data:
+            if not isinstance(o, dict):
+                self.notify_bad_request('The list must only contain objects!')
+                return
+
+            action = o.get('action')
+            value = o.get('value')
+
+            try:
+                validate_review_action(action, value)
+            except Exception as ex:
+                self.notify_bad_request(str(ex))
+                return
+
+            actions.append((action, value))
+
+        dataset = await self.find_dataset(name)
 
         if dataset is None:
             dataset_not_found(self, name)
             return
 
-        record_info = None
+        unknown_hashes = [
+            value
+            for action, value in actions
+            if action == 'invalid_record' and dataset.find_record(value) is None
+        ]
 
-        for record in dataset.metadata.records:
-            if record['hash'] == hash:
-                record_info = record
-                break
+        if len(unknown_hashes) > 0:
+            self.notify_bad_request(f'Cannot find records with hashes {unknown_hashes}!')
+            return
+
+        num_changes = await dataset.review(actions)
+
+        info(f'Applied {num_changes} of {len(actions)} review action(s) to {name}.')
+
+        self.write({
+            'changed': num_changes,
+            'message': f'Applied {num_changes} of {len(actions)} review action(s).',
+        })
+
+
+class GetImageByHash(DatasetHandler):
+    """Pull out a single image from TFRecord file."""
+
+    async def get(self, name: str, hash: str):
+
+        dataset = await self.find_dataset(name)
+
+        if dataset is None:
+            dataset_not_found(self, name)
+            return
+
+        record_info = dataset.find_record(hash)
 
         if record_info is not None:
-            seek_start = record_info['seek_start']
-            seek_end = record_info['seek_end']
-
-            with open(dataset.serialized_dataset_filepath, mode='rb') as in_stream:
-                in_stream.seek(seek_start)
-                bs = in_stream.read(seek_end - seek_start)
-                record_datatype = bs[0]
-                record = XFormat.deserialze_obj(bs[5:])
-                base64_image = base64.encodebytes(record['PNG_IMAGE']).decode('utf-8')  # noqa
-                self.write({
-                    'image': base64_image,
-                })
+            base64_images = await run_blocking(read_base64_images, dataset, [record_info])
+            base64_image = base64_images[hash]
+            self.write({
+                'image': base64_image,
+            })
 
         else:
             self.clear()
@@ -283,23 +1224,21 @@ class GetImageByHash(RequestHandler):
             })
 
 
-class GetImagesByHashes(RequestHandler):
+class HashListHandler(DatasetHandler):
+    """Base handler for the requests with a JSON list of hashes as body."""
 
     def notify_bad_request(self, message: str):
         self.clear()
         self.set_status(400)  # Bad Request
         self.write({'message': message})
 
-    def post(self, name):
-        """Get images from dataset with list of image's hashes.
-
-        name : dataset's name
-        """
+    def parse_hash_list(self) -> List[str]:
+        """Return the list of hashes or `None` if the body is invalid."""
         body = self.request.body
         # debug(f'Request body: {body}')
         if len(body) == 0:
             self.notify_bad_request('Request body must be a list of string!')
-            return
+            return None
 
         try:
             data = tornado.escape.json_decode(body)
@@ -308,46 +1247,404 @@ class GetImagesByHashes(RequestHandler):
             traceback.print_exc()
 
             self.notify_bad_request('Body data is not valid JSON data!')
-            return
+            return None
 
         if not isinstance(data, list):
             self.notify_bad_request('Body data is not a list!')
-            return
+            return None
 
         for o in data:
             if not isinstance(o, str):
                 self.notify_bad_request('The list must only contain string!')
-                return
+                return None
+
+        return data
 
-        dataset = find_dataset(name)
+
+class GetImagesByHashes(HashListHandler):
+
+    async def post(self, name):
+        """Get images from dataset with list of image's hashes.
+
+        name : dataset's name
+        """
+        data = self.parse_hash_list()
+        if data is None:
+            return
+
+        dataset = await self.find_dataset(name)
 
         if dataset is None:
             dataset_not_found(self, name)
             return
 
         images = {hash_str: None for hash_str in data}
-        remain_hashes = [hash_str for hash_str in data]
-
-        with open(dataset.serialized_dataset_filepath, 'rb') as in_stream:
-            for record in dataset.metadata.records:
-                if len(remain_hashes) > 0:
-                    record_hash = record['hash']
-                    if record_hash in remain_hashes:
-                        remain_hashes.remove(record_hash)
-                        seek_start = record['seek_start']
-                        seek_end = record['seek_end']
-
-                        in_stream.seek(seek_start)
-                        bs = in_stream.read(seek_end-seek_start)
-                        record_datatype = bs[0]
-                        serialized_record = XFormat.deserialze_obj(bs[5:], record_datatype)  # noqa
-                        base64_image = base64.encodebytes(serialized_record['PNG_IMAGE']).decode('utf-8')  # noqa
-                        images[record_hash] = base64_image
-                else:
-                    break
+
+        found_records = list(filter(None, map(dataset.find_record, images.keys())))
+        images.update(await run_blocking(read_base64_images, dataset, found_records))
 
         image_list = [{'hash': key, 'data': images[key]} for key in images]
-        self.write({'images': image_list})
+        await write_json(self, {'images': image_list})
+
+
+# The record hash is the hash of the PNG data so the image of a hash
+# never changes and the browser can cache it forever.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class GetPNGImage(DatasetHandler):
+    """Serve the raw PNG data of a record by its hash."""
+
+    async def get(self, name: str, hash: str):
+        etag = f'"{hash}"'
+        self.set_header('Etag', etag)
+        self.set_header('Cache-Control', IMMUTABLE_CACHE_CONTROL)
+
+        # the browser already has this image
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        dataset = await self.find_dataset(name)
+
+        if dataset is None:
+            dataset_not_found(self, name)
+            return
+
+        record = dataset.find_record(hash)
+
+        if record is None:
+            self.clear()
+            self.set_status(404)
+            self.write({
+                'message': f'Cannot find image with hash {repr(hash)} in dataset {name}!',
+            })
+            return
+
+        png_images = await run_blocking(read_png_images, dataset, [record])
+        png_image = png_images[hash]
+
+        self.set_header('Content-Type', 'image/png')
+        self.write(png_image)
+
+
+class GetPNGImages(HashListHandler):
+    """
+    Serve the raw PNG data of multiple records in a single binary
+    response. For each found hash, the response contains:
+
+    - the byte length of the hash (uint16, little-endian)
+    - the hash (ASCII)
+    - the byte length of the PNG data (uint32, little-endian)
+    - the PNG data
+
+    Hashes which cannot be found are left out.
+    """
+
+    async def post(self, name: str):
+        data = self.parse_hash_list()
+        if data is None:
+            return
+
+        dataset = await self.find_dataset(name)
+
+        if dataset is None:
+            dataset_not_found(self, name)
+            return
+
+        found_records = list(filter(None, map(dataset.find_record, dict.fromkeys(data))))
+        png_images = await run_blocking(read_png_images, dataset, found_records)
+
+        self.set_header('Content-Type', 'application/octet-stream')
+
+        for record_hash, png_image in png_images.items():
+            hash_bs = record_hash.encode('ascii')
+            self.write(struct.pack('<H', len(hash_bs)))
+            self.write(hash_bs)
+            self.write(struct.pack('<I', len(png_image)))
+            self.write(png_image)
+
+
+class GetAtlas(DatasetHandler):
+    """
+    The tile map of the sprite atlas of a label, a font, a cluster or the
+    records similar to a record. The atlas
+    image is served by `GetAtlasImage`.
+    """
+
+    async def get(self, name: str, kind: str, key: str):
+        dataset = await self.find_dataset(name)
+
+        if dataset is None:
+            dataset_not_found(self, name)
+            return
+
+        atlas = await dataset.get_atlas(kind, key)
+
+        if atlas is None:
+            self.clear()
+            self.set_status(404)
+            self.write({
+                'message': f'Cannot find any records of {kind} {repr(key)} in dataset {name}!',
+            })
+            return
+
+        tiles = []
+        for idx, record in enumerate(atlas.records):
+            tiles.append({
+                **record,
+                'x': (idx % atlas.columns) * atlas.tile_width,
+                'y': (idx // atlas.columns) * atlas.tile_height,
+                'cluster': dataset.find_cluster(record),
+            })
+
+        image_url = '/api/atlas-image/{}/{}/{}?digest={}'.format(
+            tornado.escape.url_escape(name, plus=False),
+            kind,
+            tornado.escape.url_escape(key, plus=False),
+            atlas.digest,
+        )
+
+        await write_json(self, {
+            'dataset': name,
+            'kind': kind,
+            'key': key,
+            'image': image_url,
+            'tile_width': atlas.tile_width,
+            'tile_height': atlas.tile_height,
+            'columns': atlas.columns,
+            'records': tiles,
+        })
+
+
+class GetNearDuplicates(DatasetHandler):
+    """
+    The near-duplicate clusters found by `near_duplicates.py`, the
+    largest first. Use `?cursor=<cursor>&limit=<limit>` to get a page.
+    The records of a cluster are in its atlas (`/api/atlas/<name>/cluster/<id>`).
+    """
+
+    async def get(self, name: str):
+        try:
+            cursor, limit = parse_page_arguments(self)
+        except ValueError as ex:
+            bad_page_arguments(self, ex)
+            return
+
+        dataset = await self.find_dataset(name)
+
+        if dataset is None:
+            dataset_not_found(self, name)
+            return
+
+        clusters = dataset.near_duplicate_clusters
+        stop = None if limit is None else cursor + limit
+
+        cluster_list = []
+        for cluster_id, records in enumerate(clusters[cursor:stop], start=cursor):
+            cluster_list.append({
+                'id': cluster_id,
+                'labels': sorted(set(record['char'] for record in records)),
+                'fonts': [record['font'] for record in records],
+                'size': len(records),
+            })
+
+        await stream_json(self, {
+            'dataset': name,
+            'total': len(clusters),
+            'clusters': cluster_list,
+            'next_cursor': next_cursor(cursor, limit, len(clusters)),
+        })
+
+
+class GetSimilarRecords(DatasetHandler):
+    """
+    The records which look the most like a record by the embeddings of
+    `embeddings.py`, the record itself first. Use `?k=<k>` for the number
+    of records and `?nprobe=<nprobe>` for the number of inverted lists to
+    scan. The atlas of the records is `/api/atlas/<name>/similar/<hash>`.
+    """
+
+    async def get(self, name: str, hash: str):
+        try:
+            k = int(self.get_query_argument('k', str(SIMILAR_RECORDS_COUNT)))
+            nprobe = int(self.get_query_argument('nprobe', str(SIMILAR_RECORDS_NPROBE)))
+            if k <= 0 or nprobe <= 0:
+                raise ValueError('k and nprobe must be positive!')
+        except ValueError as ex:
+            self.clear()
+            self.set_status(400)  # Bad Request
+            self.write({'message': f'Invalid k or nprobe: {ex}'})
+            return
+
+        dataset = await self.find_dataset(name)
+
+        if dataset is None:
+            dataset_not_found(self, name)
+            return
+
+        if dataset.embedding_index is None:
+            self.clear()
+            self.set_status(404)
+            self.write({'message': f'Dataset {name} doesn\'t have the embedding index!'})
+            return
+
+        if dataset.find_record(hash) is None:
+            self.clear()
+            self.set_status(404)
+            self.write({'message': f'Cannot find record {hash} in dataset {name}!'})
+            return
+
+        similar_records = await run_blocking(dataset.similar_records, hash, min(k, MAX_SIMILAR_RECORDS), nprobe)
+
+        await write_json(self, {
+            'dataset': name,
+            'hash': hash,
+            'records': [{**record, 'distance': distance} for record, distance in similar_records],
+        })
+
+
+class GetAtlasImage(DatasetHandler):
+
+    async def get(self, name: str, kind: str, key: str):
+        dataset = await self.find_dataset(name)
+
+        if dataset is None:
+            dataset_not_found(self, name)
+            return
+
+        atlas = dataset.cached_atlas(kind, key)
+
+        if atlas is not None:
+            digest = atlas.digest
+        else:
+            # found once and reused for composing the atlas
+            records = await dataset.find_atlas_records(kind, key)
+
+            if len(records) == 0:
+                self.clear()
+                self.set_status(404)
+                self.write({
+                    'message': f'Cannot find any records of {kind} {repr(key)} in dataset {name}!',
+                })
+                return
+
+            digest = atlas_digest(records)
+
+        # check the cache validator before composing the atlas
+        self.set_header('Etag', f'"{digest}"')
+        self.set_header('Cache-Control', IMMUTABLE_CACHE_CONTROL)
+
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        if atlas is None:
+            atlas = await dataset.get_atlas(kind, key, records)
+
+        self.set_header('Content-Type', 'image/png')
+        self.write(atlas.png_image)
+
+
+class LatencyHistogram:
+    """The number of requests in each latency bucket (upper bounds in ms)."""
+
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, math.inf)
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.status_counts: Dict[int, int] = defaultdict(int)
+
+    def observe(self, latency_ms: float, status: int):
+        bucket_idx = next(idx for idx, bound in enumerate(self.BUCKETS) if latency_ms <= bound)
+        self.bucket_counts[bucket_idx] += 1
+        self.count += 1
+        self.total_ms += latency_ms
+        self.max_ms = max(self.max_ms, latency_ms)
+        self.status_counts[status] += 1
+
+    def quantile(self, q: float) -> float:
+        """The upper bound of the bucket which contains the `q` quantile."""
+        if self.count == 0:
+            return 0.0
+
+        rank = q * self.count
+        cumulative_count = 0
+        for bound, bucket_count in zip(self.BUCKETS, self.bucket_counts):
+            cumulative_count += bucket_count
+            if cumulative_count >= rank:
+                return min(bound, self.max_ms)
+
+        return self.max_ms
+
+    def to_json(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.total_ms / max(self.count, 1),
+            'max_ms': self.max_ms,
+            'p50_ms': self.quantile(0.50),
+            'p95_ms': self.quantile(0.95),
+            'p99_ms': self.quantile(0.99),
+            'buckets': [
+                {'le': 'inf' if math.isinf(bound) else bound, 'count': bucket_count}
+                for bound, bucket_count in zip(self.BUCKETS, self.bucket_counts)
+            ],
+            'status': {str(status): count for status, count in sorted(self.status_counts.items())},
+        }
+
+
+# (method, handler name) -> latency histogram, see `log_request`
+route_metrics: Dict[tuple, LatencyHistogram] = defaultdict(LatencyHistogram)
+# the file that the requests are recorded to for `load-test.py`, set by `--record-requests`
+request_log_file = None
+
+
+def log_request(handler: RequestHandler):
+    """Called by tornado after every request (the `log_function` setting)."""
+    request = handler.request
+    status = handler.get_status()
+    latency_ms = request.request_time() * 1000
+
+    route_metrics[(request.method, type(handler).__name__)].observe(latency_ms, status)
+
+    if request_log_file is not None:
+        entry = {
+            'ts': time.time() - request.request_time(),
+            'method': request.method,
+            'uri': request.uri,
+            'status': status,
+            'latency_ms': latency_ms,
+        }
+
+        if len(request.body) > 0:
+            entry['body'] = request.body.decode('utf-8', errors='replace')
+
+        request_log_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        request_log_file.flush()
+
+    if status >= 500:
+        log_method = error
+    elif status >= 400:
+        log_method = warn
+    else:
+        log_method = debug
+
+    log_method(f'{status} {request.method} {request.uri} {latency_ms:.2f}ms')
+
+
+class GetMetrics(RequestHandler):
+    """The latency histograms of the routes (by handler)."""
+
+    def get(self):
+        self.write({
+            'routes': [
+                {'method': method, 'handler': handler_name, **histogram.to_json()}
+                for (method, handler_name), histogram in sorted(route_metrics.items())
+            ],
+        })
 
 
 class IndexHandler(RequestHandler):
@@ -362,17 +1659,26 @@ def make_app():
             (r'/api/datasets/([^/]+)', GetDatasetInfo),
             (r'/api/datasets/([^/]+)/([^/]+)', GetLabelInfo),
             (r'/api/images/([^/]+)', GetImagesByHashes),
+            (r'/api/png/([^/]+)', GetPNGImages),
+            (r'/api/png/([^/]+)/([^/]+)', GetPNGImage),
             (r'/api/record/invalid/([^/]+)/([^/]+)', MarkRecordAsInvalid),
             (r'/api/record/valid/([^/]+)/([^/]+)', MarkRecordAsValid),
             (r'/api/font/invalid/([^/]+)/([^/]+)', MarkFontAsInvalid),
             (r'/api/font/valid/([^/]+)/([^/]+)', MarkFontAsValid),
             (r'/api/label/complete/([^/]+)/([^/]+)', MarkLabelAsCompleted),
             (r'/api/label/incomplete/([^/]+)/([^/]+)', MarkLabelAsIncompleted),
+            (r'/api/review/([^/]+)', ReviewDataset),
+            (r'/api/atlas/([^/]+)/(label|font|cluster|similar)/([^/]+)', GetAtlas),
+            (r'/api/atlas-image/([^/]+)/(label|font|cluster|similar)/([^/]+)', GetAtlasImage),
+            (r'/api/near-duplicates/([^/]+)', GetNearDuplicates),
+            (r'/api/similar/([^/]+)/([^/]+)', GetSimilarRecords),
             (r'/images/([^/]+)/([^/]+)', GetImageByHash),
+            (r'/api/metrics', GetMetrics),
             (r'/', IndexHandler),
             (r'/(.*)', StaticFileHandler, {'path': './static'}),
         ],
         debug=True,
+        log_function=log_request,
     )
 
 
@@ -415,59 +1721,81 @@ def main():
         ),
     )
 
-    args = parser.parse_args()
-    datasets_dir = args.datasets_dir
-    port = args.port
-
-    dataset_dirs = os.listdir(datasets_dir)
-    for name in dataset_dirs:
-        try:
-            dataset_dir = os.path.join(datasets_dir, name)
-
-            metadata_filepath = os.path.join(dataset_dir, METADATA_FILENAME)
-            if not os.path.exists(metadata_filepath):
-                raise Exception(f'{metadata_filepath} does not exist!')
+    parser.add_argument(
+        '--record-requests',
+        dest='record_requests',
+        default=None,
+        required=False,
+        help=(
+            'Append the requests to this JSON lines file so they can be '
+            'replayed by `load-test.py`.'
+        ),
+    )
 
-            serialized_dataset_filepath = os.path.join(dataset_dir, SERIALIZED_DATASET_FILENAME)  # noqa
-            if not os.path.exists(serialized_dataset_filepath):
-                raise Exception(f'{serialized_dataset_filepath} does not exist!')  # noqa
+    parser.add_argument(
+        '--threads',
+        dest='num_threads',
+        type=positive_int,
+        default=4,
+        required=False,
+        help=(
+            'The number of threads for reading images and saving the '
+            'metadata. Default is 4.'
+        ),
+    )
 
-            json_obj = json.load(open(
-                metadata_filepath,
-                mode='r',
-                encoding='utf-8',
-            ))
+    parser.add_argument(
+        '--memory-budget',
+        dest='memory_budget',
+        type=positive_int,
+        default=1024,
+        required=False,
+        help=(
+            'The estimated memory (MB) for the loaded datasets. The least '
+            'recently used datasets are unloaded when it is exceeded. '
+            'Default is 1024.'
+        ),
+    )
 
-            metadata = DatasetMetadata.parse_obj(json_obj)
+    args = parser.parse_args()
+    datasets_dir = args.datasets_dir
+    port = args.port
 
-            dataset = Dataset(
-                name=name,
-                path=dataset_dir,
-                metadata_filepath=metadata_filepath,
-                serialized_dataset_filepath=serialized_dataset_filepath,
-                metadata=metadata,
-            )
+    global memory_budget, executor, request_log_file
+    memory_budget = args.memory_budget * 1024 * 1024
+    executor = ThreadPoolExecutor(max_workers=args.num_threads)
 
-        except Exception as ex:
-            error(repr(ex))
-            warn(f'Skipping {name}!')
-            traceback.print_exc()
-            continue
+    if args.record_requests is not None:
+        request_log_file = open(args.record_requests, mode='a', encoding='utf-8')
+        info(f'Recording requests to {repr(args.record_requests)}.')
 
-        datasets.append(dataset)
+    datasets.update(discover_datasets(datasets_dir))
+    info(f'Found {len(datasets)} dataset(s) in {repr(datasets_dir)}.')
 
     app = make_app()
     app.listen(port)
 
+    PeriodicCallback(compact_journals, JOURNAL_COMPACTION_INTERVAL).start()
+
     try:
         info(f'Server starting at http://localhost:{port}/index.html')
         IOLoop.current().start()
+    except KeyboardInterrupt:
+        pass
     except Exception as ex:
         warn(repr(ex))
 
     info('Shutting down server.')
     IOLoop.current().stop()
 
+    for dataset in list(loaded_datasets.values()):
+        dataset.unload()
+
+    executor.shutdown()
+
+    if request_log_file is not None:
+        request_log_file.close()
+
 
 if __name__ == '__main__':
     main()
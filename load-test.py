@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# Replay the requests recorded by `inspection-server.py --record-requests`
+# against a server and report the throughput and the latency percentiles.
+import os
+import sys
+import time
+import json
+import argparse
+import subprocess
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from logger import *
+from argtypes import *
+
+
+def load_request_log(filepath: str):
+    entries = []
+    with open(filepath, mode='r', encoding='utf-8') as infile:
+        for line_num, line in enumerate(infile):
+            line = line.strip()
+            if len(line) == 0:
+                continue
+
+            try:
+                entry = json.loads(line)
+            except Exception as ex:
+                warn(f'Skipping line {line_num + 1}: {repr(ex)}')
+                continue
+
+            entries.append(entry)
+
+    return entries
+
+
+def route_of(entry: dict):
+    """Group the requests by method and the path without the dataset name and the keys."""
+    path = entry['uri'].split('?')[0]
+    parts = path.split('/')
+
+    if len(parts) > 2 and parts[1] == 'api':
+        path = '/'.join(parts[:3])
+        # `/api/record/invalid/...`
+        if parts[2] in ('record', 'font', 'label') and len(parts) > 3:
+            path += '/' + parts[3]
+        # `/api/atlas/<name>/label/...` (label, font, cluster or similar)
+        elif parts[2] in ('atlas', 'atlas-image') and len(parts) > 4:
+            path += '/' + parts[4]
+    elif len(parts) > 2 and parts[1] == 'images':
+        path = '/images'
+
+    return f'{entry["method"]} {path}'
+
+
+def send_request(base_url: str, entry: dict, timeout: float):
+    """Return (status, latency in ms, number of bytes)."""
+    body = entry.get('body')
+    if body is not None:
+        body = body.encode('utf-8')
+
+    request = urllib.request.Request(base_url + entry['uri'], data=body, method=entry['method'])
+
+    start_time = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            num_bytes = len(response.read())
+            status = response.status
+    except urllib.error.HTTPError as ex:
+        num_bytes = len(ex.read())
+        status = ex.code
+    except Exception as ex:
+        num_bytes = 0
+        status = repr(ex)
+
+    return status, (time.perf_counter() - start_time) * 1000, num_bytes
+
+
+def wait_for_server(base_url: str, timeout: float):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(base_url + '/api/datasets', timeout=1):
+                return
+        except Exception:
+            time.sleep(0.1)
+
+    raise Exception(f'The server at {base_url} did not start in {timeout} seconds!')
+
+
+def percentiles(latencies: list):
+    return np.percentile(np.array(latencies), [50, 95, 99])
+
+
+def print_report(results: list, elapsed_time: float):
+    latencies_by_route = defaultdict(list)
+    errors_by_route = defaultdict(int)
+    total_bytes = 0
+
+    for route, (status, latency_ms, num_bytes) in results:
+        latencies_by_route[route].append(latency_ms)
+        total_bytes += num_bytes
+        if not isinstance(status, int) or status >= 400:
+            errors_by_route[route] += 1
+
+    all_latencies = [latency_ms for _, (_, latency_ms, _) in results]
+    num_errors = sum(errors_by_route.values())
+
+    info(f'{len(results)} requests in {elapsed_time:.3f}s ({len(results) / elapsed_time:.1f} req/s, {total_bytes / elapsed_time / 1024 / 1024:.2f} MiB/s), {num_errors} errors.')  # noqa
+
+    header = ('route', 'count', 'errors', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')
+    print(*header, sep='\t')
+
+    rows = sorted(latencies_by_route.items())
+    rows.append(('ALL', all_latencies))
+
+    for route, latencies in rows:
+        p50, p95, p99 = percentiles(latencies)
+        num_route_errors = num_errors if route == 'ALL' else errors_by_route[route]
+        print(
+            route,
+            len(latencies),
+            num_route_errors,
+            f'{p50:.2f}',
+            f'{p95:.2f}',
+            f'{p99:.2f}',
+            f'{max(latencies):.2f}',
+            sep='\t',
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay a request log against the inspection server.',
+    )
+
+    parser.add_argument(
+        'request_log',
+        help='The JSON lines file recorded with `inspection-server.py --record-requests`.',
+    )
+
+    parser.add_argument(
+        '--url',
+        dest='url',
+        default='http://localhost:3000',
+        help='Default is \'http://localhost:3000\'.',
+    )
+
+    parser.add_argument(
+        '--concurrency',
+        dest='concurrency',
+        type=positive_int,
+        default=8,
+        help='The number of requests in flight. Default is 8.',
+    )
+
+    parser.add_argument(
+        '--repeat',
+        dest='repeat',
+        type=positive_int,
+        default=1,
+        help='Replay the log this many times. Default is 1.',
+    )
+
+    parser.add_argument(
+        '--read-only',
+        dest='read_only',
+        action='store_true',
+        help='Skip the requests that change the review state.',
+    )
+
+    parser.add_argument(
+        '--start-server',
+        dest='start_server',
+        action='store_true',
+        help=(
+            'Start `inspection-server.py` at the port of `--url` and stop '
+            'it after the replay.'
+        ),
+    )
+
+    parser.add_argument(
+        '--timeout',
+        dest='timeout',
+        type=float,
+        default=60,
+        help='Timeout of each request in seconds. Default is 60.',
+    )
+
+    args = parser.parse_args()
+
+    base_url = args.url.rstrip('/')
+
+    entries = load_request_log(args.request_log)
+    if args.read_only:
+        entries = [
+            entry for entry in entries
+            if not entry['uri'].startswith(('/api/record/', '/api/font/', '/api/label/', '/api/review/'))
+        ]
+
+    entries = entries * args.repeat
+
+    if len(entries) == 0:
+        raise Exception(f'There is no request to replay in {args.request_log}!')
+
+    server_process = None
+    if args.start_server:
+        port = base_url.rsplit(':', 1)[-1]
+        server_filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inspection-server.py')
+        server_process = subprocess.Popen([sys.executable, server_filepath, port])
+
+    try:
+        if server_process is not None:
+            wait_for_server(base_url, timeout=60)
+
+        info(f'Replaying {len(entries)} requests with concurrency {args.concurrency}.')
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            futures = [
+                (route_of(entry), executor.submit(send_request, base_url, entry, args.timeout))
+                for entry in entries
+            ]
+            results = [(route, future.result()) for route, future in futures]
+
+        elapsed_time = time.perf_counter() - start_time
+
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+    print_report(results, elapsed_time)
+
+
+if __name__ == '__main__':
+    main()
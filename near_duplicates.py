@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# Find the records with nearly identical images (e.g. two fonts that
+# only differ by a pixel) with perceptual hashes. The exact duplicates
+# are already found by the md5 hash of the PNG data.
+#
+# The 64-bit hashes are indexed with multi-index hashing: the hashes are
+# split into `radius + 1` substrings and, by the pigeonhole principle,
+# two hashes within the Hamming radius have at least one identical
+# substring. Only the hashes sharing a substring are compared.
+import os
+import json
+import time
+import argparse
+import multiprocessing
+from collections import defaultdict
+from typing import Dict, List
+
+from tqdm import tqdm
+import numpy as np
+
+from constants import *
+from logger import *
+from utils import *
+from argtypes import *
+
+HASH_TYPES = ('phash', 'dhash')
+HASH_BITS = 64
+HASH_SIZE = 8
+
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(1 << 16)], dtype=np.uint8)
+
+
+def area_resize_matrix(in_size: int, out_size: int) -> np.ndarray:
+    """
+    Return the (out_size, in_size) matrix which resizes a signal by
+    averaging the input pixels that each output pixel covers.
+    """
+    edges = np.linspace(0, in_size, out_size + 1)
+    starts = np.arange(in_size)
+
+    # overlap of the input pixel [i, i + 1) with the output pixel [edges[o], edges[o + 1])
+    overlap = np.minimum(starts[None, :] + 1, edges[1:, None]) - np.maximum(starts[None, :], edges[:-1, None])
+    overlap = np.clip(overlap, 0, None)
+
+    return (overlap / overlap.sum(axis=1, keepdims=True)).astype(np.float32)
+
+
+def dct_matrix(size: int) -> np.ndarray:
+    """The orthonormal DCT-II matrix."""
+    n = np.arange(size)
+    matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size))
+    matrix[0] *= np.sqrt(1 / size)
+    matrix[1:] *= np.sqrt(2 / size)
+    return matrix.astype(np.float32)
+
+
+def pack_hash_bits(bits: np.ndarray) -> np.ndarray:
+    """Pack (N, 64) booleans into (N,) uint64."""
+    packed_bytes = np.packbits(bits.reshape(len(bits), HASH_BITS), axis=1)
+    return packed_bytes.view('>u8').reshape(-1).astype(np.uint64)
+
+
+def dhash(images: np.ndarray) -> np.ndarray:
+    """Difference hash of (N, H, W) images: the horizontal gradient signs of the 8x9 thumbnails."""
+    _, height, width = images.shape
+    rows = area_resize_matrix(height, HASH_SIZE)
+    columns = area_resize_matrix(width, HASH_SIZE + 1)
+
+    thumbnails = np.einsum('rh,nhw,cw->nrc', rows, images, columns, optimize=True)
+    return pack_hash_bits(thumbnails[:, :, 1:] > thumbnails[:, :, :-1])
+
+
+def phash(images: np.ndarray, thumbnail_size=32) -> np.ndarray:
+    """
+    Perceptual hash of (N, H, W) images: whether the lowest 8x8 DCT
+    coefficients of the 32x32 thumbnails are above their median.
+    """
+    _, height, width = images.shape
+    dct = dct_matrix(thumbnail_size)[:HASH_SIZE]
+
+    # resize and transform in a single pass
+    rows = dct @ area_resize_matrix(height, thumbnail_size)
+    columns = dct @ area_resize_matrix(width, thumbnail_size)
+
+    coefficients = np.einsum('rh,nhw,cw->nrc', rows, images, columns, optimize=True)
+    coefficients = coefficients.reshape(len(images), HASH_BITS)
+
+    # the DC coefficient is left out of the median
+    medians = np.median(coefficients[:, 1:], axis=1, keepdims=True)
+    return pack_hash_bits(coefficients > medians)
+
+
+HASH_FUNCTIONS = {
+    'phash': phash,
+    'dhash': dhash,
+}
+
+
+def hamming_distance(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    x = np.bitwise_xor(a, b)
+    distance = np.zeros(x.shape, dtype=np.int64)
+    for shift in range(0, HASH_BITS, 16):
+        distance += POPCOUNT_TABLE[(x >> np.uint64(shift)) & np.uint64(0xFFFF)]
+
+    return distance
+
+
+def hash_png_batch(args):
+    """Decode a batch of PNG images and hash them (in a worker process)."""
+    png_images, hash_type = args
+    images = decode_images(png_images, input_shape=(IMAGE_SIZE, IMAGE_SIZE))
+    return HASH_FUNCTIONS[hash_type](images)
+
+
+def compute_hashes(
+    records: List[dict],
+    packed_image_filepath: str,
+    hash_type: str,
+    batch_size=1024,
+    num_workers=1,
+) -> np.ndarray:
+    """Return the perceptual hashes (uint64) of the records in the same order."""
+    # the records are read in file order so remember where they were
+    indexed_records = [{**record, 'record_id': record_id} for record_id, record in enumerate(records)]
+    hashes = np.zeros(len(records), dtype=np.uint64)
+
+    batches = iter_png_batches(indexed_records, packed_image_filepath, batch_size)
+    # the record ids of the submitted batches
+    record_ids = []
+
+    def iter_tasks():
+        for batch_records, batch_png_images in batches:
+            record_ids.append(np.array([record['record_id'] for record in batch_records]))
+            yield batch_png_images, hash_type
+
+    pbar = tqdm(total=len(records))
+    with multiprocessing.Pool(num_workers) as pool:
+        for batch_idx, batch_hashes in enumerate(pool.imap(hash_png_batch, iter_tasks())):
+            hashes[record_ids[batch_idx]] = batch_hashes
+            pbar.update(len(batch_hashes))
+
+    pbar.close()
+    return hashes
+
+
+class MultiIndexHash:
+    def __init__(self, hashes: np.ndarray, radius: int):
+        self.hashes = hashes
+        self.radius = radius
+
+        num_substrings = min(radius + 1, HASH_BITS)
+        self.boundaries = np.linspace(0, HASH_BITS, num_substrings + 1).astype(int)
+
+    def substrings(self, substring_idx: int) -> np.ndarray:
+        start = self.boundaries[substring_idx]
+        width = self.boundaries[substring_idx + 1] - start
+        mask = np.uint64((1 << int(width)) - 1)
+        return (self.hashes >> np.uint64(start)) & mask
+
+    def near_pairs(self):
+        """Return the (i, j), i < j, pairs within the radius and their distances."""
+        pairs = []
+        distances = []
+
+        for substring_idx in range(len(self.boundaries) - 1):
+            substrings = self.substrings(substring_idx)
+
+            order = np.argsort(substrings, kind='stable')
+            sorted_substrings = substrings[order]
+            sorted_hashes = self.hashes[order]
+
+            # compare every hash with the k-th next one in the same
+            # group of identical substrings without building the groups
+            for k in range(1, len(order)):
+                same_substrings = sorted_substrings[k:] == sorted_substrings[:-k]
+                # the groups are contiguous so there are no larger k either
+                if not same_substrings.any():
+                    break
+
+                first = np.flatnonzero(same_substrings)
+                second = first + k
+
+                pair_distances = hamming_distance(sorted_hashes[first], sorted_hashes[second])
+                within_radius = pair_distances <= self.radius
+
+                first = order[first[within_radius]]
+                second = order[second[within_radius]]
+
+                pairs.append(np.stack([np.minimum(first, second), np.maximum(first, second)], axis=1))
+                distances.append(pair_distances[within_radius])
+
+        if len(pairs) == 0:
+            return np.zeros((0, 2), dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        # the same pair may share several substrings
+        pairs, unique_indices = np.unique(np.concatenate(pairs), axis=0, return_index=True)
+        distances = np.concatenate(distances)[unique_indices]
+
+        return pairs, distances
+
+
+def connected_components(num_nodes: int, pairs: np.ndarray) -> np.ndarray:
+    """Return the component id of every node (union-find)."""
+    parents = np.arange(num_nodes)
+
+    def find(x):
+        while parents[x] != x:
+            parents[x] = parents[parents[x]]
+            x = parents[x]
+
+        return x
+
+    for a, b in pairs:
+        root_a = find(a)
+        root_b = find(b)
+        if root_a != root_b:
+            parents[max(root_a, root_b)] = min(root_a, root_b)
+
+    return np.array([find(x) for x in range(num_nodes)])
+
+
+def find_near_duplicates(records: List[dict], hashes: np.ndarray, radius: int, across_labels=False):
+    """Return the clusters (lists of record ids) of the near-duplicate records."""
+    if across_labels:
+        groups = {None: np.arange(len(records))}
+    else:
+        record_ids_by_label = defaultdict(list)
+        for record_id, record in enumerate(records):
+            record_ids_by_label[record['char']].append(record_id)
+
+        groups = {label: np.array(record_ids) for label, record_ids in record_ids_by_label.items()}
+
+    clusters = []
+    for label, record_ids in tqdm(groups.items()):
+        index = MultiIndexHash(hashes[record_ids], radius)
+        pairs, distances = index.near_pairs()
+
+        if len(pairs) == 0:
+            continue
+
+        components = connected_components(len(record_ids), pairs)
+        pair_components = components[pairs[:, 0]]
+
+        for component in np.unique(pair_components):
+            members = record_ids[components == component]
+            clusters.append({
+                'label': label,
+                'record_ids': members.tolist(),
+                'max_distance': int(distances[pair_components == component].max()),
+            })
+
+    # the largest clusters first
+    clusters.sort(key=lambda cluster: len(cluster['record_ids']), reverse=True)
+    return clusters
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Find near-duplicate images with perceptual hashes.',
+    )
+
+    parser.add_argument(
+        '--metadata',
+        dest='metadata_filepath',
+        default='metadata.json',
+        help='Default is \'metadata.json\'.',
+    )
+
+    parser.add_argument(
+        '--images',
+        dest='packed_image_filepath',
+        default='images.bin',
+        help=(
+            f'The packed images (\'images.bin\') or the serialized dataset '
+            f'({repr(SERIALIZED_DATASET_FILENAME)}). Default is \'images.bin\'.'
+        ),
+    )
+
+    parser.add_argument(
+        '--hash',
+        dest='hash_type',
+        choices=HASH_TYPES,
+        default='phash',
+        help='Default is \'phash\'.',
+    )
+
+    parser.add_argument(
+        '--radius',
+        dest='radius',
+        type=int,
+        default=4,
+        help='The maximum Hamming distance between near-duplicate hashes. Default is 4.',
+    )
+
+    parser.add_argument(
+        '--across-labels',
+        dest='across_labels',
+        action='store_true',
+        help='Also compare the images of different labels.',
+    )
+
+    parser.add_argument('--batch-size', dest='batch_size', type=positive_int, default=1024)
+
+    parser.add_argument(
+        '--workers',
+        dest='num_workers',
+        type=positive_int,
+        default=os.cpu_count() or 1,
+        help='Number of processes for decoding and hashing. Default is the number of CPUs.',
+    )
+
+    parser.add_argument(
+        '--out',
+        dest='out_filepath',
+        default=None,
+        help=(
+            f'Default is {repr(NEAR_DUPLICATES_FILENAME)} next to the '
+            f'metadata file, where `inspection-server.py` looks for it.'
+        ),
+    )
+
+    args = parser.parse_args()
+    print(args)
+
+    if not os.path.exists(args.packed_image_filepath):
+        raise Exception(args.packed_image_filepath + ' does not exist!')
+
+    if args.radius < 0 or args.radius >= HASH_BITS:
+        raise Exception(f'The radius must be in [0, {HASH_BITS})!')
+
+    out_filepath = args.out_filepath
+    if out_filepath is None:
+        out_filepath = os.path.join(os.path.dirname(args.metadata_filepath), NEAR_DUPLICATES_FILENAME)
+
+    records = load_dataset_metadata(args.metadata_filepath)['records']
+
+    start_time = time.time()
+    info(f'Hashing {len(records)} images.')
+    hashes = compute_hashes(
+        records,
+        args.packed_image_filepath,
+        args.hash_type,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+    )
+
+    info('Finding near-duplicates.')
+    clusters = find_near_duplicates(records, hashes, args.radius, args.across_labels)
+
+    output = {
+        'hash_type': args.hash_type,
+        'radius': args.radius,
+        'across_labels': args.across_labels,
+        'clusters': [
+            {
+                'id': cluster_id,
+                'label': cluster['label'],
+                'max_distance': cluster['max_distance'],
+                'records': [
+                    {
+                        'hash': records[record_id]['hash'],
+                        'char': records[record_id]['char'],
+                        'font': records[record_id]['font'],
+                    }
+                    for record_id in cluster['record_ids']
+                ],
+            }
+            for cluster_id, cluster in enumerate(clusters)
+        ],
+    }
+
+    if os.path.exists(out_filepath):
+        backup_file_by_modified_date(out_filepath)
+
+    with open(out_filepath, mode='w', encoding='utf-8') as outfile:
+        json.dump(output, outfile, ensure_ascii=False, indent='\t')
+
+    num_records = sum(len(cluster['record_ids']) for cluster in clusters)
+    info(f'Found {len(clusters)} clusters ({num_records} records) in {time.time() - start_time:.1f}s.')
+
+    for cluster in output['clusters'][:10]:
+        fonts = ', '.join(record['font'] for record in cluster['records'])
+        print(cluster['label'], cluster['max_distance'], fonts, sep='\t')
+
+    info(f'The clusters are saved in {repr(out_filepath)}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# Run the trained Keras models with NumPy only.
+#
+# Importing TensorFlow and building the model takes seconds and hundreds
+# of MB of memory which is too much for classifying a 64x64 image. This
+# module reads the `.h5` files saved by `train.py` (or the weights saved
+# by `SaveModelCallBack` with its `model_config.json`) and executes the
+# forward pass with vectorized NumPy.
+import os
+import json
+import time
+import argparse
+from typing import Callable, Dict, List
+
+import numpy as np
+import h5py
+
+MODEL_CONFIG_FILENAME = 'model_config.json'
+
+
+def decode_attr(value):
+    # h5py returns either `str` or `bytes` depending on how the
+    # attribute was written
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+
+    return value
+
+
+def apply_activation(x: np.ndarray, activation: str):
+    if isinstance(activation, dict):
+        # functions like `tf.nn.softmax` are serialized as objects
+        activation = activation['config']
+
+    if isinstance(activation, str) and activation.endswith('_v2'):
+        activation = activation[:-len('_v2')]
+
+    if activation == 'linear' or activation is None:
+        return x
+    elif activation == 'relu':
+        return np.maximum(x, 0, out=x)
+    elif activation == 'softmax':
+        x = x - np.max(x, axis=-1, keepdims=True)
+        np.exp(x, out=x)
+        x /= np.sum(x, axis=-1, keepdims=True)
+        return x
+    elif activation == 'sigmoid':
+        return 1.0 / (1.0 + np.exp(-x))
+    elif activation == 'tanh':
+        return np.tanh(x)
+
+    raise Exception(f'Unsupported activation {repr(activation)}!')
+
+
+def pad_input(x: np.ndarray, kernel_size: tuple, strides: tuple, padding: str, constant_value=0.0):
+    """Pad the input the same way TensorFlow does for `'same'` padding."""
+    if padding == 'valid':
+        return x
+    elif padding != 'same':
+        raise Exception(f'Unsupported padding {repr(padding)}!')
+
+    pads = [(0, 0)]
+    for in_size, k, s in zip(x.shape[1:3], kernel_size, strides):
+        out_size = -(-in_size // s)
+        pad_total = max((out_size - 1) * s + k - in_size, 0)
+        pads.append((pad_total // 2, pad_total - pad_total // 2))
+
+    pads.append((0, 0))
+    return np.pad(x, pads, mode='constant', constant_values=constant_value)
+
+
+def extract_patches(x: np.ndarray, kernel_size: tuple, strides: tuple):
+    """
+    Return a `(N, out_height, out_width, kernel_height, kernel_width, C)`
+    view of the sliding windows without copying the input (im2col).
+    """
+    n, height, width, channels = x.shape
+    kernel_height, kernel_width = kernel_size
+    stride_y, stride_x = strides
+
+    out_height = (height - kernel_height) // stride_y + 1
+    out_width = (width - kernel_width) // stride_x + 1
+
+    sn, sh, sw, sc = x.strides
+    return np.lib.stride_tricks.as_strided(
+        x,
+        shape=(n, out_height, out_width, kernel_height, kernel_width, channels),
+        strides=(sn, sh * stride_y, sw * stride_x, sh, sw, sc),
+        writeable=False,
+    )
+
+
+def check_dilation_rate(config: Dict):
+    if tuple(config.get('dilation_rate', (1, 1))) != (1, 1):
+        raise Exception(f'{config["name"]}: dilated convolution is not supported!')
+
+
+def conv2d(x: np.ndarray, config: Dict, weights: Dict[str, np.ndarray]):
+    check_dilation_rate(config)
+    kernel = weights['kernel']
+    kernel_size = tuple(config['kernel_size'])
+    strides = tuple(config['strides'])
+
+    x = pad_input(x, kernel_size, strides, config['padding'])
+    patches = extract_patches(x, kernel_size, strides)
+    n, out_height, out_width = patches.shape[:3]
+
+    # the kernel is stored as (kernel_height, kernel_width, in, out)
+    # which matches the order of the flattened patches
+    y = patches.reshape(n * out_height * out_width, -1) @ kernel.reshape(-1, kernel.shape[-1])
+    y = y.reshape(n, out_height, out_width, -1)
+
+    if 'bias' in weights:
+        y += weights['bias']
+
+    return apply_activation(y, config.get('activation'))
+
+
+def depthwise(x: np.ndarray, depthwise_kernel: np.ndarray, config: Dict):
+    kernel_size = tuple(config['kernel_size'])
+    strides = tuple(config['strides'])
+
+    x = pad_input(x, kernel_size, strides, config['padding'])
+    patches = extract_patches(x, kernel_size, strides)
+    n, out_height, out_width = patches.shape[:3]
+
+    # depthwise kernel: (kernel_height, kernel_width, in, depth_multiplier)
+    y = np.einsum('nhwijc,ijcm->nhwcm', patches, depthwise_kernel, optimize=True)
+    return y.reshape(n, out_height, out_width, -1)
+
+
+def depthwise_conv2d(x: np.ndarray, config: Dict, weights: Dict[str, np.ndarray]):
+    check_dilation_rate(config)
+    y = depthwise(x, weights['depthwise_kernel'], config)
+
+    if 'bias' in weights:
+        y += weights['bias']
+
+    return apply_activation(y, config.get('activation'))
+
+
+def separable_conv2d(x: np.ndarray, config: Dict, weights: Dict[str, np.ndarray]):
+    check_dilation_rate(config)
+    y = depthwise(x, weights['depthwise_kernel'], config)
+
+    pointwise_kernel = weights['pointwise_kernel']
+    y = y @ pointwise_kernel.reshape(-1, pointwise_kernel.shape[-1])
+
+    if 'bias' in weights:
+        y += weights['bias']
+
+    return apply_activation(y, config.get('activation'))
+
+
+def max_pool2d(x: np.ndarray, config: Dict, weights: Dict[str, np.ndarray]):
+    pool_size = tuple(config['pool_size'])
+    strides = tuple(config['strides'] or pool_size)
+    padding = config['padding']
+
+    if padding == 'valid' and pool_size == strides:
+        # non-overlapping windows can be reduced with a reshape
+        n, height, width, channels = x.shape
+        pool_y, pool_x = pool_size
+        out_height = height // pool_y
+        out_width = width // pool_x
+        x = x[:, :out_height * pool_y, :out_width * pool_x, :]
+        return x.reshape(n, out_height, pool_y, out_width, pool_x, channels).max(axis=(2, 4))
+
+    # pad with -inf so the padded values are never picked
+    x = pad_input(x, pool_size, strides, padding, constant_value=-np.inf)
+    patches = extract_patches(x, pool_size, strides)
+    return patches.max(axis=(3, 4))
+
+
+def global_average_pooling2d(x: np.ndarray, config: Dict, weights: Dict[str, np.ndarray]):
+    return x.mean(axis=(1, 2))
+
+
+def flatten(x: np.ndarray, config: Dict, weights: Dict[str, np.ndarray]):
+    return x.reshape(x.shape[0], -1)
+
+
+def dense(x: np.ndarray, config: Dict, weights: Dict[str, np.ndarray]):
+    y = x @ weights['kernel']
+
+    if 'bias' in weights:
+        y += weights['bias']
+
+    return apply_activation(y, config.get('activation'))
+
+
+def activation(x: np.ndarray, config: Dict, weights: Dict[str, np.ndarray]):
+    return apply_activation(x, config['activation'])
+
+
+def identity(x: np.ndarray, config: Dict, weights: Dict[str, np.ndarray]):
+    return x
+
+
+LAYER_FUNCTIONS: Dict[str, Callable] = {
+    'Conv2D': conv2d,
+    'DepthwiseConv2D': depthwise_conv2d,
+    'SeparableConv2D': separable_conv2d,
+    'MaxPooling2D': max_pool2d,
+    'MaxPool2D': max_pool2d,
+    'GlobalAveragePooling2D': global_average_pooling2d,
+    'Flatten': flatten,
+    'Dense': dense,
+    'Activation': activation,
+    # these layers don't do anything at inference time
+    'InputLayer': identity,
+    'Dropout': identity,
+}
+
+
+class NumpyLayer:
+    def __init__(self, class_name: str, config: Dict, weights: Dict[str, np.ndarray]):
+        if class_name not in LAYER_FUNCTIONS:
+            raise Exception(f'Unsupported layer {class_name} ({config.get("name")})!')
+
+        self.class_name = class_name
+        self.name = config.get('name')
+        self.config = config
+        self.weights = weights
+        self.fn = LAYER_FUNCTIONS[class_name]
+
+    def __call__(self, x: np.ndarray):
+        return self.fn(x, self.config, self.weights)
+
+    def __repr__(self):
+        return repr((self.class_name, self.name))
+
+
+class NumpyModel:
+    def __init__(self, layers: List[NumpyLayer]):
+        self.layers = layers
+
+    def predict(self, x: np.ndarray):
+        x = np.asarray(x, dtype=np.float32)
+        for layer in self.layers:
+            x = layer(x)
+
+        return x
+
+    def count_macs(self, input_shape: tuple):
+        """
+        Count the multiply-accumulate operations of a single forward pass
+        (like `tensorflow_utils.count_model_macs`). Only the layers with a
+        kernel are counted.
+        """
+        total_macs = 0
+
+        x = np.zeros((1, *input_shape), dtype=np.float32)
+        for layer in self.layers:
+            x = layer(x)
+            # every kernel weight is used once per output position
+            num_positions = int(np.prod(x.shape[1:-1]))
+            for key, weight in layer.weights.items():
+                if key.endswith('kernel'):
+                    total_macs += weight.size * num_positions
+
+        return total_macs
+
+    def penultimate(self):
+        """Return the model without the last `Dense` layer (and the layers after it)."""
+        dense_indices = [idx for idx, layer in enumerate(self.layers) if layer.class_name == 'Dense']
+        if len(dense_indices) == 0:
+            raise Exception('The model does not have any Dense layer!')
+
+        return NumpyModel(self.layers[:dense_indices[-1]])
+
+    def summary(self):
+        for layer in self.layers:
+            weight_shapes = {key: value.shape for key, value in layer.weights.items()}
+            print(f'{layer.class_name:<24}{layer.name:<32}{weight_shapes}')
+
+
+def read_layer_weights(weights_group: h5py.Group, layer_name: str):
+    if layer_name not in weights_group:
+        return {}
+
+    layer_group = weights_group[layer_name]
+    weights = {}
+    for weight_name in layer_group.attrs.get('weight_names', []):
+        weight_name = decode_attr(weight_name)
+        # e.g. 'conv2d_num_01/kernel:0' -> 'kernel'
+        key = weight_name.split('/')[-1].split(':')[0]
+        weights[key] = np.asarray(layer_group[weight_name], dtype=np.float32)
+
+    return weights
+
+
+def load_model(filepath: str, config_filepath: str = None):
+    """
+    Load a Keras `.h5` file. Files saved with `model.save()` contain the
+    model config. Files saved with `model.save_weights()` need the
+    `model_config.json` which `SaveModelCallBack` writes next to them.
+    """
+    if not os.path.exists(filepath):
+        raise Exception(filepath + ' does not exist!')
+
+    with h5py.File(filepath, mode='r') as h5file:
+        if 'model_config' in h5file.attrs:
+            model_config = json.loads(decode_attr(h5file.attrs['model_config']))
+        else:
+            if config_filepath is None:
+                config_filepath = os.path.join(os.path.dirname(filepath), MODEL_CONFIG_FILENAME)
+
+            if not os.path.exists(config_filepath):
+                raise Exception(f'{filepath} does not contain the model config and {config_filepath} does not exist!')  # noqa
+
+            model_config = json.load(open(config_filepath, mode='r', encoding='utf-8'))
+
+        if model_config['class_name'] != 'Sequential':
+            raise Exception(f'Only Sequential models are supported ({model_config["class_name"]})!')
+
+        weights_group = h5file['model_weights'] if 'model_weights' in h5file else h5file
+
+        layers = []
+        for layer_config in model_config['config']['layers']:
+            class_name = layer_config['class_name']
+            config = layer_config['config']
+            weights = read_layer_weights(weights_group, config['name'])
+            layers.append(NumpyLayer(class_name, config, weights))
+
+    return NumpyModel(layers)
+
+
+def validate_against_keras(model_filepath: str, num_samples=32, seed=0):
+    """Compare the outputs with Keras on random binary glyph-like inputs."""
+    import tensorflow as tf
+
+    numpy_model = load_model(model_filepath)
+
+    keras_model = tf.keras.models.load_model(model_filepath, compile=False)
+    input_shape = keras_model.input_shape[1:]
+
+    rng = np.random.RandomState(seed)
+    inputs = (rng.rand(num_samples, *input_shape) > 0.8).astype(np.float32)
+
+    expected = keras_model.predict(inputs)
+    actual = numpy_model.predict(inputs)
+
+    max_abs_diff = float(np.max(np.abs(expected - actual)))
+    same_argmax = float(np.mean(np.argmax(expected, axis=-1) == np.argmax(actual, axis=-1)))
+
+    return max_abs_diff, same_argmax
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Classify images with a Keras model without TensorFlow.',
+    )
+
+    parser.add_argument('model', help='The Keras model (.h5) file.')
+    parser.add_argument('images', nargs='*', help='Image files to classify.')
+    parser.add_argument('--labels', dest='labeling_filepath', default='japanese-characters.txt')
+    parser.add_argument('--top-k', dest='top_k', type=int, default=5)
+    parser.add_argument(
+        '--validate',
+        action='store_true',
+        help='Compare the outputs with Keras (requires TensorFlow).',
+    )
+
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    model = load_model(args.model)
+    load_time = time.perf_counter() - start_time
+    print(f'Loaded {args.model} in {load_time * 1000:.1f} ms')
+
+    if args.validate:
+        max_abs_diff, same_argmax = validate_against_keras(args.model)
+        print(f'Max absolute difference: {max_abs_diff:.3e}')
+        print(f'Same top-1 prediction: {same_argmax:.2%}')
+
+    if len(args.images) == 0:
+        return
+
+    # imported here so loading the model stays lightweight
+    from PIL import Image
+    from utils import load_labels
+
+    label_list, _ = load_labels(args.labeling_filepath)
+
+    for image_filepath in args.images:
+        pil_image = Image.open(image_filepath).convert('L')
+        np_image = np.asarray(pil_image, dtype=np.float32) / 255.0
+        outputs = model.predict(np_image.reshape(1, *np_image.shape, 1))[0]
+
+        top_indices = np.argsort(outputs)[::-1][:args.top_k]
+        results = [f'{label_list[idx]["label_chars"]}:{outputs[idx]:.4f}' for idx in top_indices]
+        print(image_filepath, *results, sep='\t')
+
+
+if __name__ == '__main__':
+    main()
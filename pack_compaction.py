@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# Compact a dataset after it has been reviewed: drop the invalid records
+# (and the records of the invalid fonts) from the pack (`images.bin` or
+# `dataset.xformat`) and rewrite the offsets in the metadata.
+#
+# The compaction is described by a state file (`compaction.json`) next
+# to the metadata which is written before anything live is touched, so
+# an interrupted compaction is always finished (rolled forward) by
+# `finish_compaction` instead of leaving a broken dataset behind.
+# `inspection-server.py` calls it for every dataset it discovers.
+#
+# - by default, the kept records are copied (see `pack_ranges.py`) to a
+# new pack next to the live one and the new pack and the new metadata
+# are swapped in with `os.replace` once both are complete
+# - with `--in-place`, the kept records are moved towards the start of
+# the live pack and the pack is truncated so the compaction only needs
+# `--max-temp-size` MB of free disk space. The dataset cannot be used
+# until the compaction is finished. A chunk which overlaps its own
+# source is saved to a temporary file first so it can be written again
+# if the process is killed while writing it.
+#
+# The arrays aligned with the records (`anomaly-scores.npy`,
+# `embeddings.npy` and the record ids of `embedding-index.npz`) are
+# compacted too so they stay usable.
+import os
+import json
+import time
+import types
+import argparse
+from typing import List
+
+from tqdm import tqdm
+import numpy as np
+
+from constants import *
+from logger import *
+from utils import *
+from argtypes import *
+from review_journal import ReviewJournal, ReviewState
+from pack_ranges import coalesce_ranges, copy_ranges, is_record_valid
+from embeddings import IVFPQIndex
+
+COMPACTING_SUFFIX = '.compacting'
+COMPACTION_STATE_FILENAME = 'compaction.json'
+COMPACTION_RANGES_FILENAME = 'compaction-ranges.npy'
+COMPACTION_CHUNK_FILENAME = 'compaction-chunk.bin'
+
+
+def fsync_dir(dirpath: str):
+    fd = os.open(dirpath, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_file_durably(filepath: str, data: bytes):
+    with open(filepath, mode='wb') as outfile:
+        outfile.write(data)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+
+def write_state(state_filepath: str, state: dict):
+    """Replace the state file atomically."""
+    tmp_filepath = state_filepath + COMPACTING_SUFFIX
+    write_file_durably(tmp_filepath, json.dumps(state, ensure_ascii=False).encode('utf-8'))
+    os.replace(tmp_filepath, state_filepath)
+    fsync_dir(os.path.dirname(os.path.abspath(state_filepath)))
+
+
+def write_metadata(metadata: dict, filepath: str):
+    json_str = json.dumps(metadata, ensure_ascii=False, indent='\t')
+    if not json_str[-1] == '\n':
+        json_str = json_str + '\n'
+
+    write_file_durably(filepath, json_str.encode('utf-8'))
+
+
+def compact_aligned_arrays(dataset_dir: str, keep_mask: np.ndarray) -> List[List[str]]:
+    """
+    Write the compacted copies of the arrays aligned with the records.
+    Return the `[new file, live file]` pairs to swap in.
+    """
+    replacements = []
+    num_records = len(keep_mask)
+
+    anomaly_scores_filepath = os.path.join(dataset_dir, ANOMALY_SCORES_FILENAME)
+    if os.path.exists(anomaly_scores_filepath):
+        anomaly_scores = np.load(anomaly_scores_filepath)
+        if len(anomaly_scores) == num_records:
+            with open(anomaly_scores_filepath + COMPACTING_SUFFIX, mode='wb') as outfile:
+                np.save(outfile, anomaly_scores[keep_mask])
+                os.fsync(outfile.fileno())
+
+            replacements.append([anomaly_scores_filepath + COMPACTING_SUFFIX, anomaly_scores_filepath])
+
+    embeddings_filepath = os.path.join(dataset_dir, EMBEDDINGS_FILENAME)
+    index_filepath = os.path.join(dataset_dir, EMBEDDING_INDEX_FILENAME)
+    if os.path.exists(embeddings_filepath):
+        embeddings = np.load(embeddings_filepath, mmap_mode='r')
+        if len(embeddings) == num_records:
+            kept_ids = np.flatnonzero(keep_mask)
+            new_embeddings = np.lib.format.open_memmap(
+                embeddings_filepath + COMPACTING_SUFFIX,
+                mode='w+',
+                dtype=embeddings.dtype,
+                shape=(len(kept_ids), embeddings.shape[1]),
+            )
+
+            for start in range(0, len(kept_ids), 65536):
+                batch_ids = kept_ids[start:start + 65536]
+                new_embeddings[start:start + len(batch_ids)] = embeddings[batch_ids]
+
+            new_embeddings.flush()
+            del new_embeddings
+            replacements.append([embeddings_filepath + COMPACTING_SUFFIX, embeddings_filepath])
+
+            if os.path.exists(index_filepath):
+                index = IVFPQIndex.load(index_filepath)
+                if len(index) == num_records:
+                    # drop the codes of the removed records and renumber the others
+                    list_ids = np.repeat(np.arange(index.num_lists), np.diff(index.list_offsets))
+                    kept = keep_mask[index.record_ids]
+                    new_record_ids = np.cumsum(keep_mask) - 1
+
+                    index.list_offsets = np.searchsorted(list_ids[kept], np.arange(index.num_lists + 1)).astype(np.int64)  # noqa
+                    index.record_ids = new_record_ids[index.record_ids[kept]].astype(np.int64)
+                    index.codes = index.codes[kept]
+
+                    # `np.savez` adds `.npz` to the file name
+                    with open(index_filepath + COMPACTING_SUFFIX, mode='wb') as outfile:
+                        index.save(outfile)
+                        os.fsync(outfile.fileno())
+
+                    replacements.append([index_filepath + COMPACTING_SUFFIX, index_filepath])
+
+    return replacements
+
+
+def move_ranges_in_place(state_filepath: str, state: dict):
+    """
+    Move the ranges towards the start of the pack chunk by chunk from
+    the position in the state. The state is saved before every chunk.
+    """
+    dataset_dir = os.path.dirname(os.path.abspath(state_filepath))
+    pack_filepath = os.path.join(dataset_dir, state['pack'])
+    chunk_filepath = os.path.join(dataset_dir, COMPACTION_CHUNK_FILENAME)
+    ranges = np.load(os.path.join(dataset_dir, COMPACTION_RANGES_FILENAME))
+    chunk_size = state['chunk_size']
+
+    # where every range starts in the compacted pack
+    out_offsets = np.concatenate([[0], np.cumsum(ranges[:, 1] - ranges[:, 0])])
+
+    fd = os.open(pack_filepath, os.O_RDWR)
+    try:
+        pending = state.get('pending')
+        if pending is not None:
+            # the chunk may not have been written (completely)
+            if pending['source'] is None:
+                with open(chunk_filepath, mode='rb') as infile:
+                    chunk = infile.read()
+            else:
+                chunk = os.pread(fd, pending['size'], pending['source'])
+
+            os.pwrite(fd, chunk, pending['offset'])
+            os.fsync(fd)
+
+        range_idx, range_offset = state['next_range'], state['next_offset']
+
+        pbar = tqdm(total=int(out_offsets[-1]), initial=int(out_offsets[range_idx] + range_offset), unit='B', unit_scale=True)  # noqa
+        while range_idx < len(ranges):
+            start, end = ranges[range_idx]
+            src = int(start + range_offset)
+            dst = int(out_offsets[range_idx] + range_offset)
+            size = int(min(chunk_size, end - src))
+
+            next_range, next_offset = range_idx, range_offset + size
+            if src + size == end:
+                next_range, next_offset = range_idx + 1, 0
+
+            # the bytes before the first removed record don't move
+            if src != dst:
+                chunk = os.pread(fd, size, src)
+                pending = {'offset': dst, 'size': size, 'source': src}
+
+                # writing the chunk overwrites its own source so it is
+                # saved to be written again after a crash (the previous
+                # chunk is marked as done before its saved copy is replaced)
+                if dst + size > src:
+                    write_state(state_filepath, {**state, 'next_range': range_idx, 'next_offset': range_offset, 'pending': None})  # noqa
+                    write_file_durably(chunk_filepath, chunk)
+                    pending['source'] = None
+
+                write_state(state_filepath, {**state, 'next_range': next_range, 'next_offset': next_offset, 'pending': pending})  # noqa
+                os.pwrite(fd, chunk, dst)
+                os.fsync(fd)
+
+            range_idx, range_offset = next_range, next_offset
+            pbar.update(size)
+
+        pbar.close()
+
+        os.ftruncate(fd, int(out_offsets[-1]))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def finish_compaction(dataset_dir: str) -> bool:
+    """
+    Finish the interrupted compaction of the dataset (if there is any)
+    or remove the leftovers of a compaction which was interrupted before
+    it started to change the dataset. Return `True` if a compaction was
+    finished.
+    """
+    state_filepath = os.path.join(dataset_dir, COMPACTION_STATE_FILENAME)
+
+    if not os.path.exists(state_filepath):
+        for filename in os.listdir(dataset_dir):
+            if filename.endswith(COMPACTING_SUFFIX):
+                os.remove(os.path.join(dataset_dir, filename))
+
+        return False
+
+    with open(state_filepath, mode='r', encoding='utf-8') as infile:
+        state = json.load(infile)
+
+    if state['mode'] == 'in-place':
+        move_ranges_in_place(state_filepath, state)
+
+    for new_filename, live_filename in state['replacements']:
+        new_filepath = os.path.join(dataset_dir, new_filename)
+        # it has been swapped in already if it doesn't exist
+        if os.path.exists(new_filepath):
+            os.replace(new_filepath, os.path.join(dataset_dir, live_filename))
+
+    fsync_dir(dataset_dir)
+
+    # the reviews have been applied to the new metadata
+    ReviewJournal(os.path.join(dataset_dir, state['journal'])).clear()
+
+    for filename in (COMPACTION_RANGES_FILENAME, COMPACTION_CHUNK_FILENAME):
+        filepath = os.path.join(dataset_dir, filename)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+    os.remove(state_filepath)
+    fsync_dir(dataset_dir)
+
+    return True
+
+
+def compact_dataset(metadata_filepath: str, pack_filepath: str, in_place=False, max_temp_size=64 * 1024 * 1024):
+    dataset_dir = os.path.dirname(os.path.abspath(metadata_filepath))
+
+    if os.path.dirname(os.path.abspath(pack_filepath)) != dataset_dir:
+        raise Exception(f'{pack_filepath} must be in the same directory as {metadata_filepath}!')
+
+    if finish_compaction(dataset_dir):
+        info('Finished the interrupted compaction first.')
+
+    metadata = load_dataset_metadata(metadata_filepath)
+    records = metadata['records']
+
+    # the reviews which haven't been saved to the metadata yet
+    journal_filepath = os.path.join(dataset_dir, REVIEW_JOURNAL_FILENAME)
+    review_lists = types.SimpleNamespace(**{field: metadata.get(field, []) for field in ReviewState.FIELDS})
+    review_state = ReviewState(review_lists)
+    ReviewJournal(journal_filepath).replay(review_state)
+    review_state.to_metadata(review_lists)
+
+    keep_mask = np.array([
+        is_record_valid(record, review_state.invalid_records, review_state.invalid_fonts)
+        for record in records
+    ], dtype=bool)
+
+    kept_records = [record for record, keep in zip(records, keep_mask) if keep]
+    ranges, new_records = coalesce_ranges(kept_records)
+
+    old_size = os.path.getsize(pack_filepath)
+    new_size = sum(end - start for start, end in ranges)
+    info(f'Keeping {len(kept_records)} of {len(records)} records ({new_size} of {old_size} bytes) in {len(ranges)} byte ranges.')  # noqa
+
+    if len(kept_records) == len(records) and new_size == old_size:
+        info('There is nothing to compact.')
+        return
+
+    # the removed records are gone so only the invalid fonts are kept
+    new_metadata = {
+        **metadata,
+        **review_lists.__dict__,
+        'invalid_records': [],
+        'records': new_records,
+    }
+
+    new_metadata_filepath = metadata_filepath + COMPACTING_SUFFIX
+    write_metadata(new_metadata, new_metadata_filepath)
+
+    replacements = compact_aligned_arrays(dataset_dir, keep_mask)
+    replacements.append([new_metadata_filepath, metadata_filepath])
+
+    state = {
+        'journal': REVIEW_JOURNAL_FILENAME,
+        'pack': os.path.basename(pack_filepath),
+    }
+
+    if in_place:
+        np.save(os.path.join(dataset_dir, COMPACTION_RANGES_FILENAME), np.array(ranges, dtype=np.int64).reshape(-1, 2))
+        state.update({
+            'mode': 'in-place',
+            'chunk_size': max_temp_size,
+            'next_range': 0,
+            'next_offset': 0,
+            'pending': None,
+        })
+    else:
+        new_pack_filepath = pack_filepath + COMPACTING_SUFFIX
+        infd = os.open(pack_filepath, os.O_RDONLY)
+        try:
+            outfd = os.open(new_pack_filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                copy_ranges(infd, outfd, ranges)
+                os.fsync(outfd)
+            finally:
+                os.close(outfd)
+        finally:
+            os.close(infd)
+
+        replacements.insert(0, [new_pack_filepath, pack_filepath])
+        state['mode'] = 'swap'
+
+    state['replacements'] = [
+        [os.path.basename(new_filepath), os.path.basename(live_filepath)]
+        for new_filepath, live_filepath in replacements
+    ]
+
+    # from here on the compaction is finished even if it is interrupted
+    write_state(os.path.join(dataset_dir, COMPACTION_STATE_FILENAME), state)
+    finish_compaction(dataset_dir)
+
+    info(f'Reclaimed {old_size - new_size} bytes.')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Remove the invalid records from the pack and rewrite the offsets in the metadata.',
+    )
+
+    parser.add_argument(
+        '--metadata',
+        dest='metadata_filepath',
+        default='metadata.json',
+        help='Default is \'metadata.json\'.',
+    )
+
+    parser.add_argument(
+        '--images',
+        dest='packed_image_filepath',
+        default='images.bin',
+        help=(
+            f'The packed images (\'images.bin\') or the serialized dataset '
+            f'({repr(SERIALIZED_DATASET_FILENAME)}) in the same directory as '
+            f'the metadata. Default is \'images.bin\'.'
+        ),
+    )
+
+    parser.add_argument(
+        '--in-place',
+        dest='in_place',
+        action='store_true',
+        help=(
+            'Move the records inside the pack instead of writing a new pack. '
+            'Use it when there is not enough free disk space for a copy.'
+        ),
+    )
+
+    parser.add_argument(
+        '--max-temp-size',
+        dest='max_temp_size',
+        type=positive_int,
+        default=64,
+        help='The temporary disk space (MB) for the --in-place compaction. Default is 64.',
+    )
+
+    args = parser.parse_args()
+    print(args)
+
+    if not os.path.exists(args.packed_image_filepath):
+        raise Exception(args.packed_image_filepath + ' does not exist!')
+
+    start_time = time.time()
+    compact_dataset(
+        metadata_filepath=args.metadata_filepath,
+        pack_filepath=args.packed_image_filepath,
+        in_place=args.in_place,
+        max_temp_size=args.max_temp_size * 1024 * 1024,
+    )
+
+    info(f'Compacted in {time.time() - start_time:.1f}s.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# encoding=utf-8
+# Copy a subset of the records of a pack (`images.bin` or
+# `dataset.xformat`) without decoding them.
+#
+# The metadata already has the byte offsets of every record so the kept
+# records are sorted by offset, the adjacent ones are coalesced into
+# byte ranges and the ranges are copied with `os.copy_file_range` (or
+# large sequential reads and writes where it is not supported). The
+# records are returned with their offsets in the new pack.
+import os
+from typing import Callable, List, Tuple
+
+from tqdm import tqdm
+
+from logger import *
+
+# the size of a single read/write (or copy_file_range call)
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def is_record_valid(record: dict, invalid_records, invalid_fonts) -> bool:
+    return not (record['hash'] in invalid_records or record['font'] in invalid_fonts)
+
+
+def coalesce_ranges(records: List[dict]) -> Tuple[List[Tuple[int, int]], List[dict]]:
+    """
+    Return the `(start, end)` byte ranges to copy (in file order) and
+    copies of the records (in the given order) with their `seek_start`
+    and `seek_end` in the new pack where the ranges are written back to
+    back.
+    """
+    order = sorted(range(len(records)), key=lambda idx: records[idx]['seek_start'])
+
+    ranges = []
+    new_records: List[dict] = [None] * len(records)
+
+    range_start = range_end = None
+    # where the current range starts in the new pack
+    new_range_start = 0
+
+    for idx in order:
+        record = records[idx]
+        seek_start: int = record['seek_start']
+        seek_end: int = record['seek_end']
+
+        # records with the same (or overlapping) bytes share the range
+        if range_end is None or seek_start > range_end:
+            if range_end is not None:
+                ranges.append((range_start, range_end))
+                new_range_start += range_end - range_start
+
+            range_start, range_end = seek_start, seek_end
+        else:
+            range_end = max(range_end, seek_end)
+
+        new_seek_start = new_range_start + (seek_start - range_start)
+        new_records[idx] = {
+            **record,
+            'seek_start': new_seek_start,
+            'seek_end': new_seek_start + (seek_end - seek_start),
+        }
+
+    if range_end is not None:
+        ranges.append((range_start, range_end))
+
+    return ranges, new_records
+
+
+def copy_range_with_reads(infd: int, outfd: int, start: int, end: int, out_offset: int):
+    while start < end:
+        chunk = os.pread(infd, min(COPY_CHUNK_SIZE, end - start), start)
+        if len(chunk) == 0:
+            raise Exception(f'Unexpected end of file at {start}!')
+
+        written = os.pwrite(outfd, chunk, out_offset)
+        start += written
+        out_offset += written
+
+
+def copy_range(infd: int, outfd: int, start: int, end: int, out_offset: int):
+    """Copy the bytes `[start, end)` of `infd` to `out_offset` of `outfd`."""
+    if not hasattr(os, 'copy_file_range'):
+        copy_range_with_reads(infd, outfd, start, end, out_offset)
+        return
+
+    try:
+        while start < end:
+            copied = os.copy_file_range(infd, outfd, min(COPY_CHUNK_SIZE, end - start), start, out_offset)
+            if copied == 0:
+                raise Exception(f'Unexpected end of file at {start}!')
+
+            start += copied
+            out_offset += copied
+
+    except OSError:
+        # e.g. the file system doesn't support it, the rest of the range
+        # is copied with reads and writes
+        copy_range_with_reads(infd, outfd, start, end, out_offset)
+
+
+def copy_ranges(infd: int, outfd: int, ranges: List[Tuple[int, int]], out_offset=0):
+    """Copy the ranges back to back from `out_offset`. Return the end offset."""
+    pbar = tqdm(total=sum(end - start for start, end in ranges), unit='B', unit_scale=True)
+
+    for start, end in ranges:
+        copy_range(infd, outfd, start, end, out_offset)
+        out_offset += end - start
+        pbar.update(end - start)
+
+    pbar.close()
+    return out_offset
+
+
+def filter_pack(
+    records: List[dict],
+    in_filepath: str,
+    out_filepath: str,
+    keep: Callable[[dict], bool],
+) -> List[dict]:
+    """
+    Write the records for which `keep` returns `True` to a new pack.
+    Return the kept records (in the given order) with their new offsets.
+    """
+    kept_records = [record for record in records if keep(record)]
+    ranges, new_records = coalesce_ranges(kept_records)
+
+    info(f'Copying {len(kept_records)} of {len(records)} records in {len(ranges)} byte ranges.')
+
+    infd = os.open(in_filepath, os.O_RDONLY)
+    try:
+        outfd = os.open(out_filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            end_offset = copy_ranges(infd, outfd, ranges)
+            os.ftruncate(outfd, end_offset)
+            os.fsync(outfd)
+        finally:
+            os.close(outfd)
+    finally:
+        os.close(infd)
+
+    return new_records
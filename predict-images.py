@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# Classify a large number of image files and write the top-k results as
+# JSON lines.
+#
+# The image paths are discovered lazily and only `--prefetch` batches
+# are in flight at any time so the memory usage doesn't depend on the
+# number of files.
+import os
+import sys
+import json
+import glob
+import argparse
+import itertools
+import collections
+import multiprocessing
+from typing import Iterable, List
+
+import numpy as np
+from PIL import Image
+
+from constants import *
+from logger import *
+from argtypes import *
+from utils import load_labels
+import numpy_inference
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff')
+
+
+def iter_image_paths(inputs: List[str], list_filepaths: List[str]):
+    """Yield image paths from directories, glob patterns, files and list files."""
+    for input_path in inputs:
+        if os.path.isdir(input_path):
+            for dirpath, dirnames, filenames in os.walk(input_path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                        yield os.path.join(dirpath, filename)
+
+        elif os.path.isfile(input_path):
+            yield input_path
+
+        else:
+            matched = False
+            for filepath in glob.iglob(input_path, recursive=True):
+                if os.path.isfile(filepath):
+                    matched = True
+                    yield filepath
+
+            if not matched:
+                warn(f'{repr(input_path)} does not match any file!')
+
+    for list_filepath in list_filepaths:
+        with open(list_filepath, mode='r', encoding='utf-8') as infile:
+            for line in infile:
+                filepath = line.strip()
+                if len(filepath) > 0:
+                    yield filepath
+
+
+def iter_batches(iterable: Iterable, batch_size: int):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if len(batch) == 0:
+            return
+
+        yield batch
+
+
+def load_image(filepath: str, image_size: int, invert: bool):
+    pil_image = Image.open(filepath).convert('L')
+
+    if pil_image.size != (image_size, image_size):
+        pil_image = pil_image.resize((image_size, image_size), Image.BICUBIC)
+
+    np_image = np.asarray(pil_image, dtype=np.float32) / 255.0
+
+    # the dataset images are white characters on black background
+    if invert:
+        np_image = 1.0 - np_image
+
+    return np_image
+
+
+def load_batch(filepaths: List[str], image_size: int, invert: bool):
+    """Decode and normalize a batch of images (in a worker process)."""
+    images = np.empty((len(filepaths), image_size, image_size, 1), dtype=np.float32)
+    loaded_filepaths = []
+    errors = []
+
+    for filepath in filepaths:
+        try:
+            images[len(loaded_filepaths), :, :, 0] = load_image(filepath, image_size, invert)
+            loaded_filepaths.append(filepath)
+        except Exception as ex:
+            errors.append((filepath, repr(ex)))
+
+    return loaded_filepaths, images[:len(loaded_filepaths)], errors
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Classify images in directories, glob patterns or file lists.',
+    )
+
+    parser.add_argument('model', help='The Keras model (.h5) file.')
+    parser.add_argument('inputs', nargs='*', help='Directories, image files or glob patterns.')
+
+    parser.add_argument(
+        '--list',
+        dest='list_filepaths',
+        action='append',
+        default=[],
+        help='A file with one image path per line. Can be repeated.',
+    )
+
+    parser.add_argument('--labels', dest='labeling_filepath', default='japanese-characters.txt')
+    parser.add_argument('--output', dest='output', default='-', help='JSON lines output file. Default is stdout.')
+    parser.add_argument('--top-k', dest='top_k', type=positive_int, default=5)
+    parser.add_argument('--batch-size', dest='batch_size', type=positive_int, default=256)
+
+    parser.add_argument(
+        '--workers',
+        dest='num_workers',
+        type=positive_int,
+        default=os.cpu_count() or 1,
+        help='Number of processes for decoding images. Default is the number of CPUs.',
+    )
+
+    parser.add_argument(
+        '--prefetch',
+        dest='prefetch',
+        type=positive_int,
+        default=None,
+        help='Number of batches to decode ahead. Default is twice the number of workers.',
+    )
+
+    parser.add_argument(
+        '--invert',
+        action='store_true',
+        help='Invert the images (for dark characters on light background).',
+    )
+
+    args = parser.parse_args()
+
+    if len(args.inputs) == 0 and len(args.list_filepaths) == 0:
+        parser.error('No input!')
+
+    prefetch = args.prefetch or args.num_workers * 2
+
+    label_list, _ = load_labels(args.labeling_filepath)
+    model = numpy_inference.load_model(args.model)
+
+    if args.output == '-':
+        outfile = sys.stdout
+    else:
+        outfile = open(args.output, mode='w', encoding='utf-8')
+
+    num_predicted = 0
+    num_errors = 0
+
+    batches = iter_batches(iter_image_paths(args.inputs, args.list_filepaths), args.batch_size)
+
+    with multiprocessing.Pool(args.num_workers) as pool:
+        pending = collections.deque()
+
+        def submit_next_batch():
+            batch = next(batches, None)
+            if batch is None:
+                return False
+
+            pending.append(pool.apply_async(load_batch, (batch, IMAGE_SIZE, args.invert)))
+            return True
+
+        while len(pending) < prefetch and submit_next_batch():
+            pass
+
+        while len(pending) > 0:
+            filepaths, images, errors = pending.popleft().get()
+            # keep the workers busy while the model is running
+            submit_next_batch()
+
+            for filepath, message in errors:
+                outfile.write(json.dumps({'path': filepath, 'error': message}, ensure_ascii=False) + '\n')
+
+            num_errors += len(errors)
+
+            if len(filepaths) == 0:
+                continue
+
+            outputs = model.predict(images)
+            top_k = min(args.top_k, outputs.shape[1])
+            top_indices = np.argpartition(outputs, -top_k, axis=1)[:, -top_k:]
+
+            for row_idx, filepath in enumerate(filepaths):
+                indices = top_indices[row_idx]
+                indices = indices[np.argsort(outputs[row_idx, indices])[::-1]]
+
+                result = {
+                    'path': filepath,
+                    'predictions': [
+                        {
+                            'label': label_list[idx]['label_chars'],
+                            'index': int(idx),
+                            'score': float(outputs[row_idx, idx]),
+                        }
+                        for idx in indices
+                    ],
+                }
+
+                outfile.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+            num_predicted += len(filepaths)
+
+    if outfile is not sys.stdout:
+        outfile.close()
+
+    # stdout may be the output file
+    print(f'Classified {num_predicted} images ({num_errors} errors).', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# Propose a grouped labeling file (see `custom-labeling-file.md`) by
+# merging the labels that the trained model confuses with each other
+# instead of grouping the similar characters by eye.
+#
+# The confusion matrix is computed by `evaluate_model.evaluate` with the
+# NumPy model (or read from the `confusion_matrix.npy` of an evaluation
+# report). Two labels are linked by their confusion rate
+#
+#   (confusions of a as b + confusions of b as a) / (records of a + records of b)
+#
+# and the links are merged from the strongest one (single linkage) as
+# long as the group doesn't grow larger than `--max-group-size`.
+import os
+import argparse
+from typing import Dict, List
+
+import numpy as np
+
+from constants import *
+from logger import *
+from utils import *
+from argtypes import *
+import evaluate_model
+import numpy_inference
+
+
+def confusion_rates(confusion_matrix: np.ndarray) -> np.ndarray:
+    """Return the symmetric confusion rate of every pair of labels."""
+    confusion_matrix = confusion_matrix.astype(np.float64)
+    mistakes = confusion_matrix + confusion_matrix.T
+    np.fill_diagonal(mistakes, 0)
+
+    label_totals = confusion_matrix.sum(axis=1)
+    pair_totals = label_totals[:, None] + label_totals[None, :]
+
+    return np.divide(mistakes, pair_totals, out=np.zeros_like(mistakes), where=pair_totals > 0)
+
+
+def group_labels(rates: np.ndarray, threshold: float, max_group_size: int) -> List[List[int]]:
+    """
+    Merge the labels whose confusion rate is at least `threshold`, the
+    most confused pairs first. Return the groups (label indices in their
+    original order) in the order of their first label.
+    """
+    num_labels = len(rates)
+    parents = np.arange(num_labels)
+    group_sizes = np.ones(num_labels, dtype=np.int64)
+
+    def find(label_idx: int):
+        while parents[label_idx] != label_idx:
+            parents[label_idx] = parents[parents[label_idx]]
+            label_idx = parents[label_idx]
+
+        return label_idx
+
+    # only the upper triangle, the rates are symmetric
+    rows, columns = np.nonzero(np.triu(rates >= threshold, k=1))
+    order = np.argsort(-rates[rows, columns], kind='stable')
+
+    for a, b in zip(rows[order], columns[order]):
+        root_a, root_b = find(a), find(b)
+        if root_a == root_b or group_sizes[root_a] + group_sizes[root_b] > max_group_size:
+            continue
+
+        parents[root_b] = root_a
+        group_sizes[root_a] += group_sizes[root_b]
+
+    groups: Dict[int, List[int]] = {}
+    for label_idx in range(num_labels):
+        groups.setdefault(find(label_idx), []).append(label_idx)
+
+    return list(groups.values())
+
+
+def grouped_label_lines(label_list: List[Dict], groups: List[List[int]]) -> List[str]:
+    """
+    Format the groups as label lines. `create-dataset.py` only renders
+    the first character of a line so the labels of a group are written
+    in their order in the labeling file: the first character is the one
+    that was rendered for the first label of the group and the images of
+    the other labels are not created anymore.
+    """
+    lines = []
+    for group in groups:
+        group = sorted(group)
+        main_label_chars = ''.join(label_list[idx]['main_label_chars'] for idx in group)
+        sub_label_chars = ''.join(label_list[idx]['sub_label_chars'] for idx in group)
+
+        if len(sub_label_chars) > 0:
+            lines.append(f'{main_label_chars}\t{sub_label_chars}')
+        else:
+            lines.append(main_label_chars)
+
+    return lines
+
+
+def projected_accuracy(confusion_matrix: np.ndarray, groups: List[List[int]]) -> float:
+    """The accuracy if the confusions within a group became correct predictions."""
+    total = confusion_matrix.sum()
+    if total == 0:
+        return 0.0
+
+    correct = sum(confusion_matrix[np.ix_(group, group)].sum() for group in groups)
+    return correct / total
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Propose a grouped labeling file from the confusions of a trained model.',
+    )
+
+    parser.add_argument('model', help='The Keras model (.h5) file.')
+
+    parser.add_argument(
+        '--metadata',
+        dest='metadata_filepath',
+        default='metadata.json',
+        help='Default is \'metadata.json\'.',
+    )
+
+    parser.add_argument(
+        '--images',
+        dest='packed_image_filepath',
+        default='images.bin',
+        help='Default is \'images.bin\'.',
+    )
+
+    parser.add_argument(
+        '--labels',
+        dest='labeling_filepath',
+        default='japanese-characters.txt',
+        help='Default is \'japanese-characters.txt\'.',
+    )
+
+    parser.add_argument(
+        '--confusion-matrix',
+        dest='confusion_matrix_filepath',
+        default=None,
+        help=(
+            'The \'confusion_matrix.npy\' of an `evaluate_model.py` report '
+            'of the model. Default is to evaluate the model.'
+        ),
+    )
+
+    parser.add_argument(
+        '--batch-size',
+        dest='batch_size',
+        type=positive_int,
+        default=256,
+    )
+
+    parser.add_argument(
+        '--threshold',
+        dest='threshold',
+        type=float,
+        default=0.05,
+        help='The minimum confusion rate of two labels to group them. Default is 0.05.',
+    )
+
+    parser.add_argument(
+        '--max-group-size',
+        dest='max_group_size',
+        type=positive_int,
+        default=4,
+        help='The maximum number of labels in a group. Default is 4.',
+    )
+
+    parser.add_argument(
+        '--out',
+        dest='out_filepath',
+        default=None,
+        help='Default is \'grouped-<labeling file name>\'.',
+    )
+
+    args = parser.parse_args()
+    print(args)
+
+    label_list, label_to_index = load_labels(args.labeling_filepath)
+    num_classes = len(label_list)
+
+    model = numpy_inference.load_model(args.model)
+
+    if args.confusion_matrix_filepath is not None:
+        if not os.path.exists(args.confusion_matrix_filepath):
+            raise Exception(args.confusion_matrix_filepath + ' does not exist!')
+
+        confusion_matrix = np.load(args.confusion_matrix_filepath)
+    else:
+        if not os.path.exists(args.packed_image_filepath):
+            raise Exception(args.packed_image_filepath + ' does not exist!')
+
+        result = evaluate_model.evaluate(
+            predict_fn=model.predict,
+            records=load_dataset_metadata(args.metadata_filepath)['records'],
+            packed_image_filepath=args.packed_image_filepath,
+            label_to_index=label_to_index,
+            num_classes=num_classes,
+            batch_size=args.batch_size,
+        )
+
+        confusion_matrix = result.confusion_matrix
+
+    if confusion_matrix.shape != (num_classes, num_classes):
+        raise Exception(f'The confusion matrix {confusion_matrix.shape} doesn\'t match the {num_classes} labels!')
+
+    groups = group_labels(confusion_rates(confusion_matrix), args.threshold, args.max_group_size)
+    lines = grouped_label_lines(label_list, groups)
+
+    out_filepath = args.out_filepath
+    if out_filepath is None:
+        parent, basename = os.path.split(args.labeling_filepath)
+        out_filepath = os.path.join(parent, f'grouped-{basename}')
+
+    if os.path.exists(out_filepath):
+        backup_file_by_modified_date(out_filepath)
+
+    with open(out_filepath, mode='w', encoding='utf-8') as outfile:
+        outfile.write('\n'.join(lines) + '\n')
+
+    info('Proposed groups:')
+    for group, line in zip(groups, lines):
+        if len(group) > 1:
+            print(line)
+
+    # only the classifier layer depends on the number of labels
+    input_shape = (IMAGE_SIZE, IMAGE_SIZE, 1)
+    total_macs = model.count_macs(input_shape)
+    classifier_inputs = model.penultimate().predict(np.zeros((1, *input_shape), dtype=np.float32)).shape[-1]
+    saved_macs = classifier_inputs * (num_classes - len(groups))
+
+    accuracy = np.trace(confusion_matrix) / max(confusion_matrix.sum(), 1)
+
+    info(f'Labels: {num_classes} -> {len(groups)} ({1 - len(groups) / num_classes:.2%} fewer outputs)')
+    info(f'Classifier parameters saved: {(classifier_inputs + 1) * (num_classes - len(groups))}')
+    info(f'MACs per image: {total_macs} -> {total_macs - saved_macs} ({saved_macs / max(total_macs, 1):.2%} saved)')
+    info(f'Accuracy: {accuracy:.6f} -> {projected_accuracy(confusion_matrix, groups):.6f} (projected)')
+    info(f'The proposed labeling file is saved in {repr(out_filepath)}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,12 @@
 
 # After inspecting dataset and marking invalid records or fonts, we will
 # need to remove them from the training/testing dataset.
+#
+# The records to keep are decided from the metadata (and the reviews in
+# the review journal which haven't been saved to the metadata yet) so
+# the records are never decoded. The kept records are copied as byte
+# ranges (see `pack_ranges.py`) to the inspected dataset and its
+# metadata is written with the new offsets.
 
 import os
 import time
@@ -10,16 +16,13 @@ import json
 import argparse
 from typing import List
 
-from tqdm import tqdm
-import tensorflow as tf  # noqa: E402
-# disable GPU because it takes too long for loading
-tf.config.experimental.set_visible_devices([], 'GPU')  # noqa: E402
-
 from constants import *
 from argtypes import *
 from logger import *
 from utils import *
-from tensorflow_utils import *
+from serializable import *
+from review_journal import ReviewJournal, ReviewState
+from pack_ranges import filter_pack, is_record_valid
 
 
 def list_datasets(datasets: List[Dataset]):
@@ -27,36 +30,43 @@ def list_datasets(datasets: List[Dataset]):
         print(f'{idx} - {ds.name}')
 
 
-def remove_invalid_records(ds: Dataset, outfile: str):
-    invalid_fonts = ds.metadata.invalid_fonts
-    invalid_records = ds.metadata.invalid_records
-
-    if os.path.exists(outfile):
-        backup_file_by_modified_date(outfile)
+def remove_invalid_records(ds: Dataset, outfile: str, metadata_outfile: str):
+    metadata = ds.metadata
 
-    with tf.io.TFRecordWriter(outfile) as tfrecord_writer:
-        # TODO shuffle records
+    review_state = ReviewState(metadata)
+    num_reviews = ReviewJournal(os.path.join(ds.path, REVIEW_JOURNAL_FILENAME)).replay(review_state)
+    if num_reviews > 0:
+        info(f'Replayed {num_reviews} review(s) which have not been saved to the metadata.')
 
-        raw_dataset = tf.data.TFRecordDataset(ds.serialized_dataset_filepath)
+    invalid_records = review_state.invalid_records
+    invalid_fonts = review_state.invalid_fonts
 
-        pbar = tqdm(raw_dataset)
-        for raw_record in pbar:
-            record = TFRSerDes.read_record(raw_record)
+    for filepath in (outfile, metadata_outfile):
+        if os.path.exists(filepath):
+            backup_file_by_modified_date(filepath)
 
-            hash_feature = record[TFRSerDes.HASH_KEY]
-            hash_bytes: bytes = hash_feature.numpy()
-            record_hash = hash_bytes.decode(TFRSerDes.ENCODING)
+    start_time = time.time()
 
-            font_name_feature = record[TFRSerDes.FONT_NAME_KEY]
-            font_name_bytes: bytes = font_name_feature.numpy()
-            font_name = font_name_bytes.decode(TFRSerDes.ENCODING)
+    records = filter_pack(
+        records=metadata.records,
+        in_filepath=ds.serialized_dataset_filepath,
+        out_filepath=outfile,
+        keep=lambda record: is_record_valid(record, invalid_records, invalid_fonts),
+    )
 
-            pbar.set_description(record_hash)
+    # the invalid records and fonts are not in the inspected dataset
+    inspected_metadata = {
+        **metadata.__dict__,
+        'records': records,
+        'invalid_records': [],
+        'invalid_fonts': [],
+        'completed_labels': list(review_state.completed_labels),
+    }
 
-            if (font_name in invalid_fonts) or (record_hash in invalid_records):
-                continue
+    with open(metadata_outfile, mode='w', encoding='utf-8') as outfile:
+        universal_dump(inspected_metadata, outfile)
 
-            tfrecord_writer.write(raw_record.numpy())
+    info(f'Removed {len(metadata.records) - len(records)} invalid records in {time.time() - start_time:.1f}s.')
 
 
 def main():
@@ -131,6 +141,7 @@ def main():
         remove_invalid_records(
             ds=ds,
             outfile=os.path.join(ds.path, INSPECTED_DATASET_FILENAME),
+            metadata_outfile=os.path.join(ds.path, INSPECTED_METADATA_FILENAME),
         )
 
 
@@ -0,0 +1,184 @@
+# encoding=utf-8
+# Append-only journal of the review actions in the inspection server.
+#
+# Rewriting the whole metadata file for every click is O(dataset) disk
+# I/O. Instead, every review action is appended to the journal (one JSON
+# array per line) and the journal is replayed on top of the metadata
+# when the dataset is loaded. The metadata file is only rewritten when
+# the journal is compacted.
+import os
+import json
+import time
+
+from logger import *
+
+# action -> (field of `ReviewState`, whether the value is added or removed)
+REVIEW_ACTIONS = {
+    'invalid_record': ('invalid_records', True),
+    'valid_record': ('invalid_records', False),
+    'invalid_font': ('invalid_fonts', True),
+    'valid_font': ('invalid_fonts', False),
+    'complete_label': ('completed_labels', True),
+    'incomplete_label': ('completed_labels', False),
+}
+
+# a journal line with a list of actions which are applied together
+BATCH_ACTION = 'batch'
+
+
+class ReviewState:
+    """
+    The review lists of the metadata (`invalid_records`,
+    `invalid_fonts` and `completed_labels`) as insertion-ordered sets
+    (dicts with `None` values) so checking, adding and removing a value
+    doesn't scan the list.
+    """
+
+    FIELDS = ('invalid_records', 'invalid_fonts', 'completed_labels')
+
+    def __init__(self, metadata):
+        for field in self.FIELDS:
+            setattr(self, field, dict.fromkeys(getattr(metadata, field)))
+
+    def to_metadata(self, metadata):
+        """Write the review lists back to the metadata before saving it."""
+        for field in self.FIELDS:
+            setattr(metadata, field, list(getattr(self, field)))
+
+
+def validate_review_action(action, value):
+    if action not in REVIEW_ACTIONS:
+        raise Exception(f'Unknown review action {repr(action)}!')
+
+    if not isinstance(value, str):
+        raise Exception(f'The value of {repr(action)} must be a string!')
+
+
+def apply_review_action(state: ReviewState, action: str, value: str):
+    """
+    Apply a review action to the review state. Return `False` if the
+    action doesn't change anything so replaying an action twice is
+    harmless.
+    """
+    validate_review_action(action, value)
+
+    field, is_added = REVIEW_ACTIONS[action]
+    values = getattr(state, field)
+
+    if (value in values) == is_added:
+        return False
+
+    if is_added:
+        values[value] = None
+    else:
+        del values[value]
+
+    return True
+
+
+def find_review_changes(state: ReviewState, actions: list) -> list:
+    """
+    Return the `(action, value)` which would change the review state if
+    they were applied in order, without changing it.
+    """
+    # (field, value) -> whether the value would be in the field
+    pending = {}
+    changed_actions = []
+
+    for action, value in actions:
+        validate_review_action(action, value)
+
+        field, is_added = REVIEW_ACTIONS[action]
+        key = (field, value)
+        is_present = pending[key] if key in pending else value in getattr(state, field)
+
+        if is_present == is_added:
+            continue
+
+        pending[key] = is_added
+        changed_actions.append((action, value))
+
+    return changed_actions
+
+
+class ReviewJournal:
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        # opened on the first append so we don't create journal files
+        # for datasets that nobody reviews
+        self.outfile = None
+
+    def read_entries(self):
+        """Return the list of `(action, value)` in the journal."""
+        if not os.path.exists(self.filepath):
+            return []
+
+        entries = []
+        with open(self.filepath, mode='r', encoding='utf-8') as infile:
+            for line_num, line in enumerate(infile):
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+
+                try:
+                    action, value = json.loads(line)[:2]
+                except Exception as ex:
+                    # the last line may be cut off if the process was
+                    # killed while writing it
+                    warn(f'Skipping line {line_num + 1} of {self.filepath}: {repr(ex)}')
+                    continue
+
+                if action == BATCH_ACTION:
+                    entries.extend((batch_action, batch_value) for batch_action, batch_value in value)
+                else:
+                    entries.append((action, value))
+
+        return entries
+
+    def replay(self, state: ReviewState):
+        """Apply the journal to the review state. Return the number of entries."""
+        entries = self.read_entries()
+        for action, value in entries:
+            try:
+                apply_review_action(state, action, value)
+            except Exception as ex:
+                warn(f'Skipping review {repr(action)} in {self.filepath}: {repr(ex)}')
+
+        return len(entries)
+
+    def write_line(self, entry: list):
+        if self.outfile is None:
+            self.outfile = open(self.filepath, mode='a', encoding='utf-8')
+
+        line = json.dumps(entry, ensure_ascii=False)
+        self.outfile.write(line + '\n')
+        self.outfile.flush()
+        os.fsync(self.outfile.fileno())
+
+    def append(self, action: str, value: str):
+        validate_review_action(action, value)
+        self.write_line([action, value, time.time()])
+
+    def append_batch(self, actions: list):
+        """
+        Append a list of `(action, value)` as a single line so either all
+        or none of them are replayed after a crash.
+        """
+        for action, value in actions:
+            validate_review_action(action, value)
+
+        self.write_line([BATCH_ACTION, [list(x) for x in actions], time.time()])
+
+    def clear(self):
+        """Empty the journal after its entries have been saved to the metadata."""
+        self.close()
+
+        if os.path.exists(self.filepath):
+            with open(self.filepath, mode='w', encoding='utf-8') as outfile:
+                outfile.flush()
+                os.fsync(outfile.fileno())
+
+    def close(self):
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
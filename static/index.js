@@ -5,7 +5,22 @@ const inspectionMenu = document.getElementById('inspection-menu')
 const loadingScreen = document.getElementById('loading')
 const SELECTED_LABEL_CLASSNAME = 'active'
 const SELECTED_IMAGE_CLASSNAME = 'selected-image'
+const MULTI_SELECTED_IMAGE_CLASSNAME = 'multi-selected-image'
 const COMPLETED_LABEL_CLASSNAME = 'completed'
+// the number of labels which are requested at once
+const LABEL_PAGE_SIZE = 500
+// the number of items of a review list which are requested at once
+const REVIEW_LIST_PAGE_SIZE = 10000
+const REVIEW_LISTS = ['invalid_records', 'invalid_fonts', 'completed_labels']
+// action -> [review list, whether the value is added], see `review_journal.REVIEW_ACTIONS`
+const REVIEW_ACTIONS = {
+    invalid_record: ['invalid_records', true],
+    valid_record: ['invalid_records', false],
+    invalid_font: ['invalid_fonts', true],
+    valid_font: ['invalid_fonts', false],
+    complete_label: ['completed_labels', true],
+    incomplete_label: ['completed_labels', false],
+}
 
 /** @type {{
  *   name: string, 
@@ -24,23 +39,62 @@ var workingDataset
 /** @type {HTMLElement[]} */
 var showingLabelElements = []
 
+/**
+ * The cursor of the next page of labels or `null` if all the labels have been loaded.
+ * 
+ * @type {string | null}
+ */
+var nextLabelsCursor = null
+
+/** @type {boolean} */
+var isLoadingLabels = false
+
+/**
+ * The `review_cursor` of the review lists in `workingDataset`, the
+ * changes after it are requested with `requestReviewChanges`.
+ * 
+ * @type {string | null}
+ */
+var reviewCursor = null
+
+/** @type {boolean} */
+var isRefreshingReviews = false
+
+/**
+ * Whether there have been more reviews while the changes were requested.
+ * 
+ * @type {boolean}
+ */
+var needsReviewRefresh = false
+
 /** @type {{
  *   dataset: string,
+ *   kind: string,
+ *   key: string,
  *   label: string,
+ *   image: string,
+ *   tile_width: number,
+ *   tile_height: number,
  *   records: {
  *     hash: string,
  *     char: string,
- *     font: string
+ *     font: string,
+ *     x: number,
+ *     y: number
  *   }[]
  * }}
  */
 var workingLabel
 
-/** @type {HTMLImageElement[]} */
+/** @type {HTMLElement[]} */
 var showingImageElements = []
 
-/** @type {{hash: string, data: string}[]} */
-var workingImageData = []
+/**
+ * The hashes of the images selected with Ctrl/Shift + click.
+ * 
+ * @type {Set<string>}
+ */
+var multiSelectedHashes = new Set()
 
 /**
  * Clear all children node of the element.
@@ -176,6 +230,39 @@ function markRecordAsValid(name, hash, cb) {
     xhr.send()
 }
 
+/**
+ * Apply a list of review actions at once. Either all or none of them are applied.
+ * 
+ * @param {string} name the name of the dataset
+ * @param {{action: string, value: string}[]} actions the review actions (e.g. `invalid_record`, `valid_record`)
+ * @param {(res: {changed: number, message: string}) => void} cb the callback after the actions have been applied
+ */
+function applyReviewActions(name, actions, cb) {
+    showLoadingScreen()
+
+    let url = `/api/review/${encodeURIComponent(name)}`
+    let xhr = new XMLHttpRequest()
+
+    xhr.addEventListener('loadend', function (ev) {
+        if (this.status === 200) {
+            let res = JSON.parse(this.responseText)
+            console.log(res)
+
+            if (cb && (typeof cb === 'function')) {
+                cb(res)
+            }
+        } else {
+            console.error(this.responseText)
+        }
+
+        hideLoadingScreen(`Applied ${actions.length} review actions.`)
+    })
+
+    xhr.open('POST', url)
+    xhr.setRequestHeader('Content-Type', 'application/json')
+    xhr.send(JSON.stringify(actions))
+}
+
 /**
  * @param {string} name dataset name
  * @param {string} label 
@@ -288,17 +375,70 @@ function setLabelElementClassList(element) {
     }
 }
 
+function refreshLabelsAndImagesClasses() {
+    showingLabelElements.forEach(function (element) {
+        setLabelElementClassList(element)
+    })
+
+    showingImageElements.forEach(function (element) {
+        setImageClasses(element)
+    })
+}
+
+/**
+ * Apply a review action to the review lists of `workingDataset`.
+ * 
+ * @param {string} action
+ * @param {string} value
+ */
+function applyReviewChange(action, value) {
+    let [listName, isAdded] = REVIEW_ACTIONS[action]
+    let items = workingDataset.metadata[listName]
+    let idx = items.indexOf(value)
+
+    if (isAdded && idx === -1) {
+        items.push(value)
+    } else if (!isAdded && idx !== -1) {
+        items.splice(idx, 1)
+    }
+}
+
 function reloadLabelsAndImagesClasses() {
-    requestDatasetInfo(workingDataset.name, function (res) {
-        workingDataset = res
+    // one request at a time so the changes are applied in order
+    if (isRefreshingReviews) {
+        needsReviewRefresh = true
+        return
+    }
 
-        showingLabelElements.forEach(function (element) {
-            setLabelElementClassList(element)
-        })
+    isRefreshingReviews = true
+    needsReviewRefresh = false
 
-        showingImageElements.forEach(function (element) {
-            setImageClasses(element)
-        })
+    let name = workingDataset.name
+
+    // only the reviews since the last refresh (of every reviewer), the
+    // review lists are only requested again if the server doesn't have
+    // the changes anymore
+    requestReviewChanges(name, reviewCursor, function (res) {
+        isRefreshingReviews = false
+
+        if (!workingDataset || workingDataset.name !== name) {
+            return
+        }
+
+        if (res === null || res.changes === null) {
+            loadReviewLists(name)
+        } else {
+            res.changes.forEach(function ([action, value]) {
+                applyReviewChange(action, value)
+            })
+
+            reviewCursor = res.review_cursor
+            refreshLabelsAndImagesClasses()
+        }
+
+        if (needsReviewRefresh) {
+            reloadLabelsAndImagesClasses()
+        }
     })
 }
 
@@ -308,6 +448,10 @@ function reloadLabelsAndImagesClasses() {
 function populateInspectionMenuItemsForRecordImage(record) {
     clearChildNodes(inspectionMenu)
 
+    if (multiSelectedHashes.size > 0) {
+        populateInspectionMenuItemsForSelection()
+    }
+
     let isRecordValid = workingDataset.metadata.invalid_records.indexOf(record.hash) === -1
     let isFontValid = workingDataset.metadata.invalid_fonts.indexOf(record.font) === -1
 
@@ -366,6 +510,105 @@ function populateInspectionMenuItemsForRecordImage(record) {
 
         inspectionMenu.appendChild(menuItem)
     }
+
+    // Show all the images of the font
+    let fontMenuItem = document.createElement('button')
+    fontMenuItem.textContent = `Show all images of font ${record.font}.`
+    fontMenuItem.addEventListener('click', function (ev) {
+        closeInspectionMenu()
+        loadFontRecords(record.font)
+    })
+
+    inspectionMenu.appendChild(fontMenuItem)
+
+    if (record.cluster !== undefined) {
+        // Show the near-duplicates of the image
+        let clusterMenuItem = document.createElement('button')
+        clusterMenuItem.textContent = `Show the near-duplicates of this image.`
+        clusterMenuItem.addEventListener('click', function (ev) {
+            closeInspectionMenu()
+            loadNearDuplicateRecords(record.cluster)
+        })
+
+        inspectionMenu.appendChild(clusterMenuItem)
+    }
+
+    if (workingDataset.has_embeddings) {
+        // Show the images which look like this image
+        let similarMenuItem = document.createElement('button')
+        similarMenuItem.textContent = `Show the images similar to this image.`
+        similarMenuItem.addEventListener('click', function (ev) {
+            closeInspectionMenu()
+            loadSimilarRecords(record.hash)
+        })
+
+        inspectionMenu.appendChild(similarMenuItem)
+    }
+}
+
+/**
+ * Add the menu items to review all the selected images at once.
+ */
+function populateInspectionMenuItemsForSelection() {
+    let hashes = Array.from(multiSelectedHashes)
+
+    let markItems = [
+        ['invalid_record', `Mark the ${hashes.length} selected images as invalid.`],
+        ['valid_record', `Mark the ${hashes.length} selected images as valid.`],
+    ]
+
+    markItems.forEach(function ([action, text]) {
+        let menuItem = document.createElement('button')
+        menuItem.textContent = text
+        menuItem.addEventListener('click', function (ev) {
+            closeInspectionMenu()
+
+            let actions = hashes.map(function (hash) {
+                return {action: action, value: hash}
+            })
+
+            applyReviewActions(workingDataset.name, actions, function (res) {
+                clearMultiSelection()
+                reloadLabelsAndImagesClasses()
+            })
+        })
+
+        inspectionMenu.appendChild(menuItem)
+    })
+
+    let clearMenuItem = document.createElement('button')
+    clearMenuItem.textContent = `Clear the selection.`
+    clearMenuItem.addEventListener('click', function (ev) {
+        closeInspectionMenu()
+        clearMultiSelection()
+    })
+
+    inspectionMenu.appendChild(clearMenuItem)
+}
+
+/**
+ * Add or remove the image from the multi-selection.
+ * 
+ * @param {HTMLElement} element the image element
+ */
+function toggleMultiSelection(element) {
+    let hash = element.dataset.hash
+
+    if (multiSelectedHashes.has(hash)) {
+        multiSelectedHashes.delete(hash)
+        element.classList.remove(MULTI_SELECTED_IMAGE_CLASSNAME)
+    } else {
+        multiSelectedHashes.add(hash)
+        element.classList.add(MULTI_SELECTED_IMAGE_CLASSNAME)
+    }
+}
+
+function clearMultiSelection() {
+    multiSelectedHashes.clear()
+
+    showingImageElements.forEach(function (e) {
+        e.classList.remove(MULTI_SELECTED_IMAGE_CLASSNAME)
+    })
 }
 
 /**
@@ -455,26 +698,23 @@ function requestImage(datasetName, hash, cb) {
 }
 
 /**
- * Add record's hash, font name, dataset name to the ImageElement.
+ * Add record's hash, font name, dataset name to the element.
  * 
  * Reference: https://developer.mozilla.org/en-US/docs/Learn/HTML/Howto/Use_data_attributes
  * 
- * @param {string} imageHash the image hash to retrieve relevant data from `workingLabel`
- * @param {HTMLImageElement} imageElement the image element
- */
-function attachDataToImage(imageHash, imageElement) {
-    if (workingDataset && workingLabel) {
-        let records = workingLabel.records
-        for (let i = 0, n = records.length; i < n; i++) {
-            let record = records[i]
-            if (imageHash === record.hash) {
-                imageElement.dataset.hash = record.hash
-                imageElement.dataset.char = record.char
-                imageElement.dataset.font = record.font
-                imageElement.title = `${record.char} - ${record.font} - ${record.hash}`
-            }
-        }
+ * @param {{hash: string, char: string, font: string}} record the record of the element
+ * @param {HTMLElement} element the image element
+ */
+function attachRecordToElement(record, element) {
+    element.dataset.hash = record.hash
+    element.dataset.char = record.char
+    element.dataset.font = record.font
+
+    // the near-duplicate cluster of the record (see `near_duplicates.py`)
+    if (record.cluster !== null && record.cluster !== undefined) {
+        element.dataset.cluster = record.cluster
     }
+    element.title = `${record.char} - ${record.font} - ${record.hash}`
 }
 
 /**
@@ -533,33 +773,46 @@ function setImageClasses(element) {
     }
 }
 
-function renderImages() {
+/**
+ * Render the records of `workingLabel` as tiles of its sprite atlas. The
+ * whole atlas is a single image so the browser only makes one request.
+ */
+function renderAtlas() {
     // let startTime = performance.now()
     // console.log(startTime)
-    if (!workingDataset || !workingLabel || !workingImageData) {
+    if (!workingDataset || !workingLabel) {
         throw Error('working variables are not correctly set!')
     }
 
     showLoadingScreen()
 
     showingImageElements = []
+    multiSelectedHashes.clear()
 
-    // sometimes, this for loop makes the UI freeze a while
-    for (let i = 0, n = workingImageData.length; i < n; i++) {
-        let image = workingImageData[i]
-        let imageHash = image.hash
-        let imageData = image.data
+    let fragment = document.createDocumentFragment()
 
-        let imageElement = document.createElement('img')
-        imageElement.classList.add('inspecting-image')
+    for (let i = 0, n = workingLabel.records.length; i < n; i++) {
+        let record = workingLabel.records[i]
 
-        attachDataToImage(imageHash, imageElement)
-        setImageClasses(imageElement)
+        let tileElement = document.createElement('div')
+        tileElement.classList.add('inspecting-image')
+        tileElement.classList.add('atlas-tile')
+        tileElement.style.width = `${workingLabel.tile_width}px`
+        tileElement.style.height = `${workingLabel.tile_height}px`
+        tileElement.style.backgroundImage = `url(${workingLabel.image})`
+        tileElement.style.backgroundPosition = `-${record.x}px -${record.y}px`
+
+        attachRecordToElement(record, tileElement)
+        setImageClasses(tileElement)
 
         // Right-click to open inspection menu
-        imageElement.addEventListener('click', function (ev) {
-            // console.log(ev)
-            // console.log(this)
+        tileElement.addEventListener('click', function (ev) {
+            // Ctrl/Shift + click to select multiple images
+            if (ev.ctrlKey || ev.metaKey || ev.shiftKey) {
+                toggleMultiSelection(this)
+                ev.preventDefault()
+                return
+            }
 
             highlightSelectedImage(this)
             populateInspectionMenuItemsForRecordImage(this.dataset)
@@ -567,17 +820,17 @@ function renderImages() {
             ev.preventDefault()
         })
 
-        showingImageElements.push(imageElement)
-
-        imageElement.src = `data:image/png;base64,${imageData}`
-        imageContainer.appendChild(imageElement)
+        showingImageElements.push(tileElement)
+        fragment.appendChild(tileElement)
     }
 
+    imageContainer.appendChild(fragment)
+
     hideLoadingScreen('All images have been rendered.')
     // let endTime = performance.now()
     // console.log(endTime)
     // let execTime = endTime - startTime
-    // console.log(`renderImages took ${execTime} milliseconds!`)
+    // console.log(`renderAtlas took ${execTime} milliseconds!`)
 }
 
 /**
@@ -585,7 +838,48 @@ function renderImages() {
  */
 
 /**
- * Request base64 encoded images data from server with records' hashes.
+ * Request the sprite atlas tile map of a label or a font.
+ * 
+ * @param {string} name the dataset name
+ * @param {'label' | 'font' | 'cluster' | 'similar'} kind
+ * @param {string} key the label or the font name
+ * @param {(res: {
+ *     dataset: string,
+ *     kind: string,
+ *     key: string,
+ *     image: string,
+ *     tile_width: number,
+ *     tile_height: number,
+ *     columns: number,
+ *     records: {hash: string, char: string, font: string, x: number, y: number}[]
+ * }) => void} cb
+ */
+function requestAtlas(name, kind, key, cb) {
+    showLoadingScreen()
+
+    let url = `/api/atlas/${encodeURIComponent(name)}/${kind}/${encodeURIComponent(key)}`
+    let xhr = new XMLHttpRequest()
+
+    xhr.addEventListener('load', function (ev) {
+        if (this.status === 200) {
+            let res = JSON.parse(this.responseText)
+            console.log(res)
+
+            if (cb && (typeof cb === 'function')) {
+                cb(res)
+            }
+        }
+
+        hideLoadingScreen(`received atlas`)
+    })
+
+    xhr.open('GET', url)
+    xhr.send()
+}
+
+/**
+ * Request base64 encoded images data from server with records' hashes. DEPRECATED
+ * Use `requestAtlas` instead.
  * 
  * @param {string} name the dataset name
  * @param {string[]} hashes list of records' hashes
@@ -664,33 +958,61 @@ function requestLabelInformation(name, label, cb) {
 }
 
 /**
- * Load the records's information by label.
+ * Load the records of a label or a font.
  * 
- * @param {string} label the label character
+ * @param {'label' | 'font' | 'cluster' | 'similar'} kind
+ * @param {string} key the label character, the font name, the cluster id or the record hash
  */
-function loadRecords(label) {
+function loadAtlas(kind, key) {
     if (workingDataset) {
-        requestLabelInformation(workingDataset.name, label, function (res) {
+        requestAtlas(workingDataset.name, kind, key, function (res) {
             workingLabel = res
+            workingLabel.label = (kind === 'label') ? key : null
 
-            let recordHashes = []
-            for (let i = 0, n = workingLabel.records.length; i < n; i++) {
-                let record = workingLabel.records[i]
-                recordHashes.push(record.hash)
-            }
-
-            requestImages(workingDataset.name, recordHashes, function (res) {
-                workingImageData = res.images
-
-                clearChildNodes(imageContainer)
-                renderImages()
-            })
+            clearChildNodes(imageContainer)
+            renderAtlas()
         })
     } else {
         throw Error('Current working dataset is not available!')
     }
 }
 
+/**
+ * Load the records's information by label.
+ * 
+ * @param {string} label the label character
+ */
+function loadRecords(label) {
+    loadAtlas('label', label)
+}
+
+/**
+ * Load the records of a near-duplicate cluster.
+ * 
+ * @param {number} clusterId the id of the cluster in `/api/near-duplicates/<name>`
+ */
+function loadNearDuplicateRecords(clusterId) {
+    loadAtlas('cluster', `${clusterId}`)
+}
+
+/**
+ * Load the records which look the most like a record (see `embeddings.py`).
+ * 
+ * @param {string} hash the hash of the record
+ */
+function loadSimilarRecords(hash) {
+    loadAtlas('similar', hash)
+}
+
+/**
+ * Load all the records rendered with a font.
+ * 
+ * @param {string} font the font name
+ */
+function loadFontRecords(font) {
+    loadAtlas('font', font)
+}
+
 /**
  * @param {string} label 
  * @param {HTMLElement[]} labelElements 
@@ -739,12 +1061,13 @@ function renderLabels(container, labels) {
  * Get the dataset information by dataset name.
  * 
  * @param {string} name the name of the dataset
+ * @param {number} labelsLimit the number of labels in the response (the next page is requested with `requestDatasetListPage`)
  * @param {(res: {}) => void}
  */
-function requestDatasetInfo(name, cb) {
+function requestDatasetInfo(name, labelsLimit, cb) {
     showLoadingScreen()
 
-    let url = `/api/datasets/${name}`
+    let url = `/api/datasets/${name}?limit=${labelsLimit}`
     let xhr = new XMLHttpRequest()
 
     xhr.addEventListener('load', function (ev) {
@@ -767,18 +1090,166 @@ function requestDatasetInfo(name, cb) {
 
 }
 
+/**
+ * Get a page of one of the lists of the dataset metadata.
+ * 
+ * @param {string} name the name of the dataset
+ * @param {'labels' | 'invalid_records' | 'invalid_fonts' | 'completed_labels'} listName
+ * @param {string} cursor the `next_cursor` of the previous page
+ * @param {number} limit the page size
+ * @param {(res: {name: string, list: string, total: number, items: string[], next_cursor: string | null}) => void} cb
+ */
+function requestDatasetListPage(name, listName, cursor, limit, cb) {
+    let url = `/api/datasets/${name}?list=${listName}&cursor=${cursor}&limit=${limit}`
+    let xhr = new XMLHttpRequest()
+
+    xhr.addEventListener('loadend', function (ev) {
+        if (this.status === 200) {
+            let res = JSON.parse(this.responseText)
+
+            if (cb && (typeof cb === 'function')) {
+                cb(res)
+            }
+        } else {
+            console.error(this.responseText)
+        }
+    })
+
+    xhr.open('GET', url)
+    xhr.send()
+}
+
+/**
+ * Get the review actions that changed the review lists after `cursor`.
+ * 
+ * @param {string} name the name of the dataset
+ * @param {string} cursor the `review_cursor` of a previous response
+ * @param {(res: {name: string, changes: [string, string][] | null, review_cursor: string} | null) => void} cb `changes` is `null` if the review lists have to be requested again
+ */
+function requestReviewChanges(name, cursor, cb) {
+    let url = `/api/datasets/${name}?changes_since=${encodeURIComponent(cursor)}`
+    let xhr = new XMLHttpRequest()
+
+    xhr.addEventListener('loadend', function (ev) {
+        if (this.status === 200) {
+            cb(JSON.parse(this.responseText))
+        } else {
+            console.error(this.responseText)
+            cb(null)
+        }
+    })
+
+    xhr.open('GET', url)
+    xhr.send()
+}
+
+/**
+ * Request all the pages of the review lists and replace the ones of
+ * `workingDataset`. The pages are requested again if the lists are
+ * changed in between.
+ * 
+ * @param {string} name the name of the dataset
+ */
+function loadReviewLists(name) {
+    let lists = {}
+    let firstReviewCursor = null
+
+    function requestPage(listIdx, cursor) {
+        // the dataset has been changed while loading
+        if (!workingDataset || workingDataset.name !== name) {
+            return
+        }
+
+        if (listIdx === REVIEW_LISTS.length) {
+            REVIEW_LISTS.forEach(function (listName) {
+                workingDataset.metadata[listName] = lists[listName]
+            })
+
+            // and catch up with the reviews since the first page
+            reviewCursor = firstReviewCursor
+            reloadLabelsAndImagesClasses()
+            return
+        }
+
+        let listName = REVIEW_LISTS[listIdx]
+        requestDatasetListPage(name, listName, cursor, REVIEW_LIST_PAGE_SIZE, function (res) {
+            if (firstReviewCursor === null) {
+                firstReviewCursor = res.review_cursor
+            } else if (res.review_cursor !== firstReviewCursor) {
+                loadReviewLists(name)
+                return
+            }
+
+            lists[listName] = (lists[listName] || []).concat(res.items)
+
+            if (res.next_cursor === null) {
+                requestPage(listIdx + 1, 0)
+            } else {
+                requestPage(listIdx, res.next_cursor)
+            }
+        })
+    }
+
+    requestPage(0, 0)
+}
+
+/**
+ * Render the next page of labels if there is any.
+ */
+function loadMoreLabels() {
+    if (!workingDataset || nextLabelsCursor === null || isLoadingLabels) {
+        return
+    }
+
+    isLoadingLabels = true
+
+    let name = workingDataset.name
+    requestDatasetListPage(name, 'labels', nextLabelsCursor, LABEL_PAGE_SIZE, function (res) {
+        isLoadingLabels = false
+
+        // the dataset has been changed while loading
+        if (!workingDataset || workingDataset.name !== name) {
+            return
+        }
+
+        workingDataset.metadata.labels = workingDataset.metadata.labels.concat(res.items)
+        nextLabelsCursor = res.next_cursor
+        showingLabelElements = showingLabelElements.concat(renderLabels(labelsContainer, res.items))
+    })
+}
+
 /**
  * @param {string} name 
  */
 function loadDataset(name) {
-    requestDatasetInfo(name, function (res) {
+    requestDatasetInfo(name, LABEL_PAGE_SIZE, function (res) {
         workingDataset = res
+        nextLabelsCursor = res.next_cursor
+        isLoadingLabels = false
+        reviewCursor = res.review_cursor
 
         clearChildNodes(labelsContainer)
         showingLabelElements = renderLabels(labelsContainer, workingDataset.metadata.labels)
+
+        // only the first page of the review lists is in the response
+        let hasMoreReviews = REVIEW_LISTS.some(function (listName) {
+            return res.next_cursors[listName] !== null
+        })
+
+        if (hasMoreReviews) {
+            loadReviewLists(name)
+        }
     })
 }
 
+// Load the next page of labels when scrolling near the end of the list
+labelsContainer.addEventListener('scroll', function (ev) {
+    let remaining = labelsContainer.scrollHeight - labelsContainer.scrollTop - labelsContainer.clientHeight
+    if (remaining < labelsContainer.clientHeight) {
+        loadMoreLabels()
+    }
+})
+
 /**
  * @param {(res: {datasets: string[]}) => void} cb 
  */
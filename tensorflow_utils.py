@@ -53,3 +53,285 @@ def generic_cnn_model(prefix: str, input_shape: tuple, num_outputs: int):
     ])
 
     return model
+
+
+def baseline_cnn_model(prefix: str, input_shape: tuple, num_outputs: int):
+    """
+    The model that `train.py` has been training with. The layer names
+    are kept without the prefix so the weights that were saved before
+    can still be loaded.
+    """
+    model = tf.keras.Sequential(layers=[
+        tf.keras.layers.Conv2D(
+            name='conv2d_num_01',
+            filters=32,
+            kernel_size=5,
+            activation='relu',
+            input_shape=input_shape,
+            data_format='channels_last',
+        ),
+        tf.keras.layers.MaxPool2D(
+            name='maxpool2d_num_01',
+            pool_size=2,
+        ),
+        tf.keras.layers.Dropout(
+            name='dropout_num_01',
+            rate=0.4,
+        ),
+        ################################################################
+        tf.keras.layers.Conv2D(
+            name='conv2d_num_02',
+            filters=32,
+            kernel_size=5,
+            activation='relu',
+        ),
+        tf.keras.layers.MaxPool2D(
+            name='maxpool2d_num_02',
+            pool_size=2,
+        ),
+        tf.keras.layers.Dropout(
+            name='dropout_num_02',
+            rate=0.4,
+        ),
+        ################################################################
+        tf.keras.layers.Conv2D(
+            name='conv2d_num_03',
+            filters=64,
+            kernel_size=5,
+            activation='relu',
+        ),
+        tf.keras.layers.MaxPool2D(
+            name='maxpool2d_num_03',
+            pool_size=2,
+        ),
+        tf.keras.layers.Dropout(
+            name='dropout_num_03',
+            rate=0.4,
+        ),
+        ################################################################
+        tf.keras.layers.Flatten(name='flatten_num_01'),
+        tf.keras.layers.Dense(
+            name='dense_num_01',
+            units=256,
+            activation='relu',
+        ),
+        tf.keras.layers.Dense(
+            name='dense_num_02_outputs',
+            units=num_outputs,
+            activation='softmax',
+        ),
+    ])
+
+    return model
+
+
+def scale_filters(filters: int, width_multiplier: float, min_filters=8):
+    """Scale the number of filters and round it to a multiple of 8."""
+    scaled_filters = int(filters * width_multiplier + 4) // 8 * 8
+    return max(min_filters, scaled_filters)
+
+
+def separable_cnn_model(
+    prefix: str,
+    input_shape: tuple,
+    num_outputs: int,
+    width_multiplier=1.0,
+    block_filters=(32, 64, 128, 256),
+):
+    """
+    Compact model for CPU inference.
+
+    - a strided 3x3 convolution halves the 64x64 input right away
+    because the glyphs are binary images and don't need the full
+    resolution in the later layers
+    - each block is a depthwise-separable convolution (a 3x3 depthwise
+    convolution followed by a 1x1 pointwise convolution) which costs
+    roughly `1/9 + 1/filters` of a regular 3x3 convolution
+    - global average pooling replaces `Flatten` so the classifier only
+    sees `block_filters[-1]` features instead of thousands
+    - `width_multiplier` scales the number of filters in every layer to
+    trade accuracy for speed
+    """
+    layers = [
+        tf.keras.layers.Conv2D(
+            filters=scale_filters(block_filters[0] // 2, width_multiplier),
+            kernel_size=3,
+            strides=2,
+            padding='same',
+            activation='relu',
+            name=f'{prefix}_Conv2D_stem',
+            input_shape=input_shape,
+            data_format='channels_last',
+        ),
+    ]
+
+    num_blocks = len(block_filters)
+    for idx, filters in enumerate(block_filters):
+        block_num = idx + 1
+        layers.append(tf.keras.layers.SeparableConv2D(
+            filters=scale_filters(filters, width_multiplier),
+            kernel_size=3,
+            padding='same',
+            activation='relu',
+            name=f'{prefix}_SeparableConv2D_{block_num}',
+        ))
+
+        # the last block goes straight to the global pooling
+        if block_num < num_blocks:
+            layers.append(tf.keras.layers.MaxPool2D(
+                pool_size=2,
+                name=f'{prefix}_MaxPool2D_{block_num}',
+            ))
+
+    layers.extend([
+        tf.keras.layers.GlobalAveragePooling2D(
+            name=f'{prefix}_GlobalAveragePooling2D',
+        ),
+        tf.keras.layers.Dropout(
+            rate=0.2,
+            name=f'{prefix}_Dropout',
+        ),
+        tf.keras.layers.Dense(
+            units=num_outputs,
+            activation='softmax',
+            name=f'{prefix}_Output_layer',
+        ),
+    ])
+
+    return tf.keras.Sequential(layers)
+
+
+# the architectures that can be selected with `train.py --model`
+MODEL_ARCHITECTURES = {
+    'baseline': baseline_cnn_model,
+    'generic': generic_cnn_model,
+    'separable': separable_cnn_model,
+}
+
+
+def build_model(
+    architecture: str,
+    input_shape: tuple,
+    num_outputs: int,
+    width_multiplier=1.0,
+    prefix='HRGN',
+):
+    if architecture not in MODEL_ARCHITECTURES:
+        raise Exception(f'Unknown model architecture {repr(architecture)}!')
+
+    if architecture == 'separable':
+        return separable_cnn_model(
+            prefix=prefix,
+            input_shape=input_shape,
+            num_outputs=num_outputs,
+            width_multiplier=width_multiplier,
+        )
+
+    if width_multiplier != 1.0:
+        warn(f'{repr(architecture)} does not support width multiplier!')
+
+    model_fn = MODEL_ARCHITECTURES[architecture]
+    return model_fn(prefix, input_shape, num_outputs)
+
+
+def count_model_macs(model: tf.keras.Model):
+    """
+    Count the multiply-accumulate operations of a single forward pass.
+    Only the layers which do the heavy lifting are counted.
+    """
+    total_macs = 0
+
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.layers.SeparableConv2D):
+            in_channels = layer.input.shape[-1]
+            _, out_height, out_width, out_channels = layer.output.shape
+            kernel_height, kernel_width = layer.kernel_size
+            depth_channels = in_channels * layer.depth_multiplier
+
+            total_macs += out_height * out_width * depth_channels * kernel_height * kernel_width  # noqa
+            total_macs += out_height * out_width * depth_channels * out_channels  # noqa
+
+        elif isinstance(layer, tf.keras.layers.DepthwiseConv2D):
+            _, out_height, out_width, out_channels = layer.output.shape
+            kernel_height, kernel_width = layer.kernel_size
+
+            total_macs += out_height * out_width * out_channels * kernel_height * kernel_width  # noqa
+
+        elif isinstance(layer, tf.keras.layers.Conv2D):
+            in_channels = layer.input.shape[-1]
+            _, out_height, out_width, out_channels = layer.output.shape
+            kernel_height, kernel_width = layer.kernel_size
+
+            total_macs += out_height * out_width * out_channels * kernel_height * kernel_width * in_channels  # noqa
+
+        elif isinstance(layer, tf.keras.layers.Dense):
+            total_macs += layer.input.shape[-1] * layer.units
+
+    return total_macs
+
+
+def measure_inference_latency(
+    model: tf.keras.Model,
+    input_shape: tuple,
+    batch_size=1,
+    num_runs=100,
+    num_warmup_runs=10,
+):
+    """Return the average inference time per image (in seconds)."""
+    inputs = np.random.rand(batch_size, *input_shape).astype(np.float32)
+
+    for _ in range(num_warmup_runs):
+        model.predict_on_batch(inputs)
+
+    start_time = time.perf_counter()
+    for _ in range(num_runs):
+        model.predict_on_batch(inputs)
+    end_time = time.perf_counter()
+
+    return (end_time - start_time) / (num_runs * batch_size)
+
+
+def load_manifest(manifest_filepath: str):
+    if not os.path.exists(manifest_filepath):
+        raise Exception(manifest_filepath + ' does not exist!')
+
+    with open(manifest_filepath, mode='r', encoding='utf-8') as infile:
+        return json.load(infile)
+
+
+def parse_tfrecord_example(serialized_example):
+    """Decode an example written by `export-shards.py` to a (normalized image, label index) pair."""
+    features = tf.io.parse_single_example(serialized_example, {
+        'image': tf.io.FixedLenFeature([], tf.string),
+        'label': tf.io.FixedLenFeature([], tf.int64),
+    })
+
+    image = tf.io.decode_png(features['image'], channels=1)
+    image = tf.cast(image, tf.float32) / 255.0
+
+    return image, features['label']
+
+
+def load_shards(manifest_filepath: str, cycle_length=8):
+    """
+    Read the TFRecord shards of `export-shards.py` interleaved in
+    parallel. Return the dataset of (image, label) pairs and the manifest
+    (which has the number of records).
+    """
+    manifest = load_manifest(manifest_filepath)
+    if manifest['format'] != 'tfrecord':
+        raise Exception(f'{manifest_filepath} is not a manifest of TFRecord shards ({manifest["format"]})!')
+
+    shards_dir = os.path.dirname(manifest_filepath)
+    shard_filepaths = [os.path.join(shards_dir, shard['filename']) for shard in manifest['shards']]
+
+    ds = tf.data.Dataset.from_tensor_slices(shard_filepaths)
+    ds = ds.interleave(
+        tf.data.TFRecordDataset,
+        cycle_length=min(cycle_length, len(shard_filepaths)),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        deterministic=False,
+    )
+    ds = ds.map(parse_tfrecord_example, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    return ds, manifest
@@ -3,6 +3,7 @@
 import os
 import io
 import json
+import argparse
 import hashlib
 import datetime
 from typing import Dict, List
@@ -13,6 +14,9 @@ import PIL.Image
 
 import tensorflow as tf
 
+from logger import *
+from tensorflow_utils import build_model, count_model_macs, measure_inference_latency, MODEL_ARCHITECTURES
+
 
 def fetch_image_data(records: List[Dict], packed_image_filepath: str):
     sorted_records = [*records]
@@ -71,10 +75,103 @@ class SaveModelCallBack(tf.keras.callbacks.Callback):
         if not os.path.exists(self.save_dir):
             os.makedirs(self.save_dir)
 
+        # the weights files don't contain the architecture so we save it
+        # once for loading them without TensorFlow (`numpy_inference.py`)
+        model_config_filepath = os.path.join(self.save_dir, 'model_config.json')
+        if not os.path.exists(model_config_filepath):
+            with open(model_config_filepath, mode='w', encoding='utf-8') as outfile:
+                outfile.write(self.model.to_json())
+
         self.model.save_weights(weights_filepath)
 
 
+def stratified_split(labels: np.ndarray, validation_split: float, seed=0):
+    """
+    Return the indices of the training and the validation images. The
+    validation images are drawn at random from every label (the records
+    are in label order so the last ones would only be a few labels).
+    """
+    rng = np.random.RandomState(seed)
+
+    train_indices = []
+    validation_indices = []
+
+    for label_idx in np.unique(labels):
+        indices = np.flatnonzero(labels == label_idx)
+        rng.shuffle(indices)
+
+        # a label with a single image is only used for training
+        num_validation = int(round(len(indices) * validation_split))
+        num_validation = min(num_validation, len(indices) - 1)
+
+        validation_indices.append(indices[:num_validation])
+        train_indices.append(indices[num_validation:])
+
+    train_indices = np.concatenate(train_indices)
+    validation_indices = np.concatenate(validation_indices)
+    rng.shuffle(train_indices)
+
+    return train_indices, validation_indices
+
+
+def write_benchmark_row(benchmark_filepath: str, row: Dict):
+    columns = list(row.keys())
+    write_header = not os.path.exists(benchmark_filepath)
+
+    with open(benchmark_filepath, mode='a', encoding='utf-8') as outfile:
+        if write_header:
+            outfile.write('\t'.join(columns) + '\n')
+
+        outfile.write('\t'.join(str(row[column]) for column in columns) + '\n')
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Train the character classification model.',
+    )
+
+    parser.add_argument(
+        '--model',
+        dest='model',
+        choices=list(MODEL_ARCHITECTURES.keys()),
+        default='baseline',
+        help='The model architecture to train. Default is \'baseline\'.',
+    )
+
+    parser.add_argument(
+        '--width-multiplier',
+        dest='width_multiplier',
+        type=float,
+        default=1.0,
+        help=(
+            'Scale the number of filters of the \'separable\' model. '
+            'Default is 1.0.'
+        ),
+    )
+
+    parser.add_argument(
+        '--validation-split',
+        dest='validation_split',
+        type=float,
+        default=0.0,
+        help=(
+            'Fraction of the records to hold out for reporting the '
+            'accuracy. The same fraction of every label is held out. '
+            'Default is 0.0 (report the training accuracy).'
+        ),
+    )
+
+    parser.add_argument(
+        '--seed',
+        dest='seed',
+        type=int,
+        default=0,
+        help='The seed for splitting the validation records. Default is 0.',
+    )
+
+    args = parser.parse_args()
+    print(args)
+
     metadata_filepath = 'metadata.json'
     packed_image_filepath = 'images.bin'
     labeling_filepath = 'japanese-characters.txt'
@@ -165,68 +262,23 @@ if __name__ == '__main__':
     train_images = np.array(train_images)
     train_labels = np.array(train_labels)
 
+    validation_data = None
+    if args.validation_split > 0:
+        train_indices, validation_indices = stratified_split(train_labels, args.validation_split, args.seed)
+        validation_data = (train_images[validation_indices], train_labels[validation_indices])
+        train_images = train_images[train_indices]
+        train_labels = train_labels[train_indices]
+
+        info(f'Holding out {len(validation_indices)} of {len(train_indices) + len(validation_indices)} images for validation.')
+
     ####################################################################
 
-    model = tf.keras.Sequential(layers=[
-        tf.keras.layers.Conv2D(
-            name='conv2d_num_01',
-            filters=32,
-            kernel_size=5,
-            activation='relu',
-            input_shape=input_shape,
-            data_format='channels_last',
-        ),
-        tf.keras.layers.MaxPool2D(
-            name='maxpool2d_num_01',
-            pool_size=2,
-        ),
-        tf.keras.layers.Dropout(
-            name='dropout_num_01',
-            rate=0.4,
-        ),
-        ################################################################
-        tf.keras.layers.Conv2D(
-            name='conv2d_num_02',
-            filters=32,
-            kernel_size=5,
-            activation='relu',
-        ),
-        tf.keras.layers.MaxPool2D(
-            name='maxpool2d_num_02',
-            pool_size=2,
-        ),
-        tf.keras.layers.Dropout(
-            name='dropout_num_02',
-            rate=0.4,
-        ),
-        ################################################################
-        tf.keras.layers.Conv2D(
-            name='conv2d_num_03',
-            filters=64,
-            kernel_size=5,
-            activation='relu',
-        ),
-        tf.keras.layers.MaxPool2D(
-            name='maxpool2d_num_03',
-            pool_size=2,
-        ),
-        tf.keras.layers.Dropout(
-            name='dropout_num_03',
-            rate=0.4,
-        ),
-        ################################################################
-        tf.keras.layers.Flatten(name='flatten_num_01'),
-        tf.keras.layers.Dense(
-            name='dense_num_01',
-            units=256,
-            activation='relu',
-        ),
-        tf.keras.layers.Dense(
-            name='dense_num_02_outputs',
-            units=num_outputs,
-            activation='softmax',
-        ),
-    ])
+    model = build_model(
+        architecture=args.model,
+        input_shape=input_shape,
+        num_outputs=num_outputs,
+        width_multiplier=args.width_multiplier,
+    )
 
     optimizer = tf.keras.optimizers.Adam(
         learning_rate=0.001,
@@ -248,6 +300,9 @@ if __name__ == '__main__':
 
     model.summary()
 
+    num_macs = count_model_macs(model)
+    info(f'{args.model} (width multiplier {args.width_multiplier}): {model.count_params()} parameters, {num_macs} MACs per image')
+
     log_dir = os.path.join('tensorboard_logs', current_dt())
     tensorboard_callback = tf.keras.callbacks.TensorBoard(
         log_dir=log_dir,
@@ -268,19 +323,43 @@ if __name__ == '__main__':
     num_epoches_per_iteration = 20
     trained_epoches = 0
 
+    # accuracy/latency trade-off of every training iteration for
+    # comparing the architectures
+    benchmark_filepath = os.path.join(model_save_dir, 'benchmark.tsv')
+
     while True:
-        model.fit(
+        history = model.fit(
             x=train_images,
             y=train_labels,
             batch_size=64,
             shuffle=True,
             epochs=num_epoches_per_iteration,
+            validation_data=validation_data,
             callbacks=[tensorboard_callback, save_movel_cb],
         )
 
         trained_epoches += num_epoches_per_iteration
         save_movel_cb.trained_epoches = trained_epoches
 
+        accuracy_key = 'val_accuracy' if validation_data is not None else 'accuracy'
+        accuracy = history.history[accuracy_key][-1]
+        latency = measure_inference_latency(model, input_shape)
+
+        benchmark_row = {
+            'model': args.model,
+            'width_multiplier': args.width_multiplier,
+            'epoch': trained_epoches,
+            'parameters': model.count_params(),
+            'macs': num_macs,
+            # the same columns in every run so the rows line up
+            'accuracy': f'{accuracy:.6f}',
+            'accuracy_of': 'validation' if validation_data is not None else 'training',
+            'latency_ms': f'{latency * 1000:.3f}',
+        }
+
+        write_benchmark_row(benchmark_filepath, benchmark_row)
+        info(f'{accuracy_key}: {accuracy:.4f} - latency: {latency * 1000:.3f} ms/image')
+
         model_filename = f'model-{current_ts()}-epoch_{trained_epoches}.h5'
         model_filepath = os.path.join(model_save_dir, model_filename)
         model.save(model_filepath)
@@ -1,6 +1,8 @@
 # encoding=utf-8
 import os
+import io
 import time
+import json
 import re
 import unicodedata
 import traceback
@@ -49,6 +51,9 @@ class Font:
     - the font file path for using with `fonttools` to check if the font
     support a specific character or not. otherwise, it may give the tofu
     shape image.
+    - the characters which draw the font's fallback glyphs (`.notdef` and
+    the replacement character) because some fonts map a codepoint in the
+    cmap but still draw the tofu shape for it.
     """
 
     def __init__(
@@ -58,12 +63,16 @@ class Font:
         size: int,
         path: str,
         supported_chars: list,
+        fallback_chars=list(),
     ):
         self.name = name
         self.font = font
         self.size = size
         self.path = path
         self.supported_chars = supported_chars
+        self.fallback_chars = fallback_chars
+        # rendered lazily by `render_fallback_images`
+        self.fallback_images = None
 
     def __repr__(self):
         return repr((self.name, self.size, self.path))
@@ -74,17 +83,23 @@ def fetch_font(font_file: str, font_size=64, characters=list()):
     pillow_font = ImageFont.truetype(font=font_file, size=font_size)
     font_name = '_'.join(pillow_font.getname())
 
-    # TODO test if this code is working or not by rendering the
-    # actual image (with some uncommon kanji)
+    # the cmap can map a codepoint to a glyph that is only the tofu shape
+    # so the rendered images are also compared with the fallback glyphs
+    # (see `is_fallback_glyph`)
     ft_font = TTFont(font_file)
-    supported_chars = []
+    codepoints = set()
     for cmap in ft_font['cmap'].tables:
         if cmap.isUnicode():
-            for c in characters:
-                if ord(c) in cmap.cmap:
-                    supported_chars.append(c)
+            codepoints.update(cmap.cmap.keys())
 
-    return Font(font_name, pillow_font, font_size, font_file, supported_chars)
+    supported_chars = [c for c in characters if ord(c) in codepoints]
+
+    # drawing a codepoint that is not in the cmap draws the `.notdef` glyph
+    fallback_chars = [c for c in NOTDEF_PROBE_CHARS if not ord(c) in codepoints][:1]
+    if ord(REPLACEMENT_CHAR) in codepoints:
+        fallback_chars.append(REPLACEMENT_CHAR)
+
+    return Font(font_name, pillow_font, font_size, font_file, supported_chars, fallback_chars)
 
 
 @measure_exec_time
@@ -175,6 +190,45 @@ def render_image(c: str, font: Font, image_size=64) -> Image:
     return canvas.crop(image_bounding_box)
 
 
+def render_fallback_images(font: Font, image_size=64) -> np.ndarray:
+    """
+    Render the fallback glyphs of the font once and cache them on the
+    font as a (number of glyphs, image_size, image_size) array.
+    """
+    if font.fallback_images is not None:
+        return font.fallback_images
+
+    images = []
+    for c in font.fallback_chars:
+        image = render_image(c, font, image_size)
+        # an empty `.notdef` glyph gives a blank image which is already
+        # handled as a blank combination
+        if image is not None:
+            images.append(np.asarray(image, dtype=np.uint8))
+
+    if len(images) == 0:
+        font.fallback_images = np.empty((0, image_size, image_size), dtype=np.uint8)
+    else:
+        font.fallback_images = np.stack(images)
+
+    return font.fallback_images
+
+
+def is_fallback_glyph(image: Image, font: Font, image_size=64, tolerance=FALLBACK_GLYPH_TOLERANCE):
+    """Check if the rendered image is (almost) one of the font's fallback glyphs."""
+    fallback_images = render_fallback_images(font, image_size)
+    if len(fallback_images) == 0:
+        return False
+
+    np_image = np.asarray(image, dtype=np.uint8)
+    if np_image.shape != fallback_images.shape[1:]:
+        return False
+
+    # compare with all the fallback glyphs at once
+    differences = np.abs(fallback_images.astype(np.int16) - np_image.astype(np.int16))
+    return bool((differences.mean(axis=(1, 2)) <= tolerance).any())
+
+
 @measure_exec_time
 def backup_file_by_modified_date(infile: str):
     if not os.path.exists(infile):
@@ -206,3 +260,127 @@ def hash_sha256(s: bytes):
     m = hashlib.sha256()
     m.update(s)
     return m.digest().hex().upper()
+
+
+def load_labels(labeling_filepath: str):
+    """
+    Parse the labeling file (see `custom-labeling-file.md`).
+
+    Return the list of label entries and the mapping from every
+    character to its label index.
+    """
+    if not os.path.exists(labeling_filepath):
+        raise Exception(labeling_filepath + ' does not exist!')
+
+    labeling_content = open(labeling_filepath, mode='rb').read()
+    labeling_content = labeling_content.decode('utf-8')
+
+    labeling_lines = labeling_content.splitlines()
+    labeling_lines = list(filter(lambda x: len(x) > 0, labeling_lines))
+
+    label_list = []
+    for line in labeling_lines:
+        rows = line.split('\t')
+        if len(rows) > 1:
+            main_label_chars = rows[0]
+            sub_label_chars = rows[1]
+            label_chars = main_label_chars + sub_label_chars
+        else:
+            main_label_chars = rows[0]
+            sub_label_chars = ''
+            label_chars = main_label_chars
+
+        label_list.append({
+            'label_chars': label_chars,
+            'main_label_chars': main_label_chars,
+            'sub_label_chars': sub_label_chars,
+        })
+
+    label_to_index = {}
+    for i, label_entry in enumerate(label_list):
+        for c in label_entry['label_chars']:
+            if c in label_to_index:
+                raise Exception(f'Duplicated character {c}!')
+            else:
+                label_to_index[c] = i
+
+    return label_list, label_to_index
+
+
+def load_dataset_metadata(metadata_filepath: str):
+    if not os.path.exists(metadata_filepath):
+        raise Exception(metadata_filepath + ' does not exist!')
+
+    metadata_content = open(metadata_filepath, mode='rb').read()
+    metadata_content = metadata_content.decode('utf-8')
+
+    return json.loads(metadata_content)
+
+
+def iter_record_batches(records: list, packed_image_filepath: str, batch_size: int):
+    """
+    Read the image data of the records in `seek_start` order and yield
+    them in batches of `(records, list of image bytes)`. Only a single
+    batch is kept in memory.
+    """
+    sorted_records = sorted(records, key=lambda record: record['seek_start'])
+
+    with open(packed_image_filepath, mode='rb') as infile:
+        last_seek_end = -1
+        batch_records = []
+        batch_image_data = []
+
+        for record in sorted_records:
+            seek_start: int = record['seek_start']
+            seek_end: int = record['seek_end']
+
+            if last_seek_end != seek_start:
+                infile.seek(seek_start)
+
+            batch_records.append(record)
+            batch_image_data.append(infile.read(seek_end - seek_start))
+            last_seek_end = seek_end
+
+            if len(batch_records) == batch_size:
+                yield batch_records, batch_image_data
+                batch_records = []
+                batch_image_data = []
+
+        if len(batch_records) > 0:
+            yield batch_records, batch_image_data
+
+
+def decode_images(image_data_list: list, input_shape=(IMAGE_SIZE, IMAGE_SIZE, 1)):
+    """Decode PNG images into a normalized float32 array for the model."""
+    images = np.empty((len(image_data_list), *input_shape), dtype=np.float32)
+
+    for idx, image_data in enumerate(image_data_list):
+        pil_image = Image.open(io.BytesIO(image_data))
+        np_image = np.asarray(pil_image, dtype=np.float32)
+        images[idx] = np.reshape(np_image, input_shape)
+
+    images /= 255.0
+    return images
+
+
+def unpack_png_image(record_data: bytes) -> bytes:
+    """Get the PNG data of a record of a serialized dataset (`dataset.xformat`)."""
+    from serializable import XFormat
+
+    record = XFormat.deserialze_obj(record_data[5:], record_data[0])
+    return record['PNG_IMAGE']
+
+
+def iter_png_batches(records: list, packed_image_filepath: str, batch_size: int):
+    """
+    Like `iter_record_batches` but yield the PNG data for both the packed
+    images (`images.bin`) and the serialized datasets (`dataset.xformat`)
+    of `inspection-server.py`.
+    """
+    is_serialized = os.path.basename(packed_image_filepath) == SERIALIZED_DATASET_FILENAME
+
+    for batch_records, batch_image_data in iter_record_batches(records, packed_image_filepath, batch_size):
+        if is_serialized:
+            batch_image_data = [unpack_png_image(bs) for bs in batch_image_data]
+
+        yield batch_records, batch_image_data